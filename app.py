@@ -1,24 +1,52 @@
 from flask import Flask, render_template, Response, request, jsonify
 from ultralytics import YOLO
 import cv2
+import numpy as np
 import os
 from datetime import datetime
 import threading
 import torch
 import json
+import base64
+import hashlib
+import gzip
+import math
 import uuid
 import time
+import shutil
+import subprocess
+import multiprocessing
+import asyncio
+import sys
+import re
+import unicodedata
+from collections import OrderedDict, deque
+from urllib.parse import urlparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import requests
 
+try:
+    import orjson  # serializador rápido opcional para respuestas compactas
+except ImportError:
+    orjson = None
+
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['OUTPUT_FOLDER'] = 'detected'
+app.config['JOBS_FOLDER'] = 'jobs'  # checkpoints de procesamiento
+app.config['THUMBNAIL_FOLDER'] = 'thumbnails'  # miniaturas y posters del historial
+app.config['TRACKS_FOLDER'] = 'tracks'  # pistas de detecciones para el reproductor
+app.config['UPLOAD_SESSIONS_FOLDER'] = 'upload_sessions'  # subidas por partes en curso
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB max
 HISTORY_FILE = 'history.json'
 
 # Crear carpetas si no existen
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
+os.makedirs(app.config['JOBS_FOLDER'], exist_ok=True)
+os.makedirs(app.config['THUMBNAIL_FOLDER'], exist_ok=True)
+os.makedirs(app.config['TRACKS_FOLDER'], exist_ok=True)
+os.makedirs(app.config['UPLOAD_SESSIONS_FOLDER'], exist_ok=True)
 
 # Detectar dispositivo automáticamente
 def get_device():
@@ -52,7 +80,6 @@ try:
         
         # Warmup: ejecutar inferencia dummy para optimizar
         print("Realizando warmup de GPU...")
-        import numpy as np
         dummy_img = np.zeros((640, 640, 3), dtype=np.uint8)
         _ = model(dummy_img, device=DEVICE, verbose=False, imgsz=640)
         
@@ -65,54 +92,865 @@ except Exception as e:
     print(f"Error al cargar el modelo: {e}")
     model = None
 
+# ==================== VARIANTES DEL MODELO ====================
+# Escalera de variantes de mayor a menor costo: los pesos entrenados a varios
+# tamaños de entrada y, si existe, un modelo reducido (destilado). Con mucha
+# carga (latencia o cola por encima del objetivo) las peticiones de tiempo
+# real e imágenes bajan de escalón; cuando la carga cae, vuelven a subir. El
+# procesamiento de videos subidos siempre usa la variante completa.
+
+MODEL_DISTILLED_PATH = os.environ.get('MODEL_DISTILLED_PATH', 'models/best_small.pt')
+MODEL_POOL_ENABLED = os.environ.get('MODEL_POOL_ENABLED', '1') != '0'
+MODEL_LATENCY_TARGETS_MS = {
+    'realtime': float(os.environ.get('REALTIME_LATENCY_TARGET_MS', 150 if DEVICE != 'cpu' else 400)),
+    'image': float(os.environ.get('IMAGE_LATENCY_TARGET_MS', 1500))
+}
+MODEL_QUEUE_LIMITS = {'realtime': 2, 'image': 4}  # peticiones en espera antes de degradar
+MODEL_DEGRADE_COOLDOWN = 2.0  # segundos mínimos entre dos bajadas de escalón
+MODEL_RECOVER_HOLD = 10.0  # segundos con carga baja antes de subir un escalón
+
+
+class ModelVariant:
+    """Un escalón de la escalera: pesos + escala del tamaño de entrada"""
+
+    def __init__(self, name, weights, scale, model=None):
+        self.name = name
+        self.weights = weights
+        self.scale = scale
+        self.model = model
+        self.ready = model is not None
+
+    def imgsz(self, base):
+        """Tamaño de entrada para un tamaño base (múltiplo de 32, mínimo 320)"""
+        return max(320, int(round(base * self.scale / 32)) * 32)
+
+
+class ModelVariantPool:
+    """Selección de variante por tipo de carga según latencia y cola medidas"""
+
+    def __init__(self, variants, targets):
+        self.variants = variants
+        self.targets = targets
+        self.usage = {v.name: 0 for v in variants}
+        self.state = {
+            workload: {'level': 0, 'ewma_ms': None, 'inflight': 0, 'switches': 0,
+                       'last_change': 0.0, 'calm_since': None, 'last_request': 0.0}
+            for workload in targets
+        }
+        self._lock = threading.Lock()
+
+    def _variant_at(self, level):
+        """Variante lista más cercana al escalón pedido (hacia la calidad completa)"""
+        for variant in reversed(self.variants[:level + 1]):
+            if variant.ready:
+                return variant
+        return self.variants[0]
+
+    def begin(self, workload):
+        """Elige la variante para una petición y la cuenta como en curso"""
+        with self._lock:
+            state = self.state[workload]
+            state['inflight'] += 1
+            variant = self._variant_at(state['level'])
+            self.usage[variant.name] += 1
+            return variant
+
+    def end(self, workload, latency_ms, queue_depth=None):
+        """Registra la latencia de una petición y ajusta el escalón"""
+        now = time.time()
+        with self._lock:
+            state = self.state[workload]
+            state['inflight'] = max(0, state['inflight'] - 1)
+            state['last_request'] = now
+            ewma = state['ewma_ms']
+            state['ewma_ms'] = latency_ms if ewma is None else 0.3 * latency_ms + 0.7 * ewma
+            depth = state['inflight'] if queue_depth is None else queue_depth
+            target = self.targets[workload]
+
+            if state['ewma_ms'] > target or depth > MODEL_QUEUE_LIMITS[workload]:
+                state['calm_since'] = None
+                cheapest = max(i for i, v in enumerate(self.variants) if v.ready)
+                if (state['level'] < cheapest
+                        and now - state['last_change'] >= MODEL_DEGRADE_COOLDOWN):
+                    self._change_level(workload, state, 1, now)
+            elif state['ewma_ms'] < 0.6 * target and depth <= 1:
+                if state['calm_since'] is None:
+                    state['calm_since'] = now
+                elif state['level'] > 0 and now - state['calm_since'] >= MODEL_RECOVER_HOLD:
+                    self._change_level(workload, state, -1, now)
+            else:
+                state['calm_since'] = None
+
+    def _change_level(self, workload, state, step, now):
+        state['level'] += step
+        state['last_change'] = now
+        state['calm_since'] = None
+        state['ewma_ms'] = None  # medir de nuevo con la variante nueva
+        state['switches'] += 1
+        print(f"Modelo ({workload}): {'degradado' if step > 0 else 'recuperado'} a "
+              f"'{self._variant_at(state['level']).name}'")
+
+    def relax_idle(self, now=None):
+        """Sube un escalón en cargas sin peticiones durante MODEL_RECOVER_HOLD.
+
+        end() solo se ejecuta cuando hay tráfico: sin este paso, tras una
+        ráfaga la carga quedaría degradada indefinidamente.
+        """
+        now = now or time.time()
+        with self._lock:
+            for workload, state in self.state.items():
+                if (state['level'] > 0 and state['inflight'] == 0
+                        and now - max(state['last_request'], state['last_change']) >= MODEL_RECOVER_HOLD):
+                    self._change_level(workload, state, -1, now)
+
+    def under_pressure(self, workload, window):
+        """Degradada y con peticiones en curso o en los últimos window segundos"""
+        with self._lock:
+            state = self.state[workload]
+            if state['level'] == 0:
+                return False
+            return state['inflight'] > 0 or time.time() - state['last_request'] < window
+
+    def current(self, workload):
+        with self._lock:
+            return self._variant_at(self.state[workload]['level']).name
+
+    def warmup(self, base_imgsz):
+        """Carga el modelo reducido (si existe) y precalienta cada variante"""
+        for variant in self.variants:
+            try:
+                if variant.model is None:
+                    if not os.path.exists(variant.weights):
+                        continue
+                    loaded = YOLO(variant.weights)
+                    if DEVICE != 'cpu':
+                        loaded.to(DEVICE)
+                    variant.model = loaded
+                imgsz = variant.imgsz(base_imgsz)
+                dummy_img = np.zeros((imgsz, imgsz, 3), dtype=np.uint8)
+                variant.model(dummy_img, device=DEVICE, verbose=False, imgsz=imgsz)
+                variant.ready = True
+            except Exception as e:
+                print(f"No se pudo preparar la variante '{variant.name}': {e}")
+        print(f"Variantes del modelo listas: {[v.name for v in self.variants if v.ready]}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'variants': [{'name': v.name, 'weights': v.weights, 'scale': v.scale,
+                              'ready': v.ready, 'requests': self.usage[v.name]}
+                             for v in self.variants],
+                'workloads': {
+                    workload: {
+                        'variant': self._variant_at(state['level']).name,
+                        'level': state['level'],
+                        'latency_ewma_ms': round(state['ewma_ms'], 1) if state['ewma_ms'] is not None else None,
+                        'target_ms': self.targets[workload],
+                        'inflight': state['inflight'],
+                        'switches': state['switches']
+                    }
+                    for workload, state in self.state.items()
+                }
+            }
+
+
+def build_model_variants():
+    variants = [ModelVariant('full', 'models/best.pt', 1.0, model)]
+    if MODEL_POOL_ENABLED and model is not None:
+        variants += [
+            ModelVariant('reduced', 'models/best.pt', 0.75, model),
+            ModelVariant('fast', 'models/best.pt', 0.5, model)
+        ]
+        if os.path.exists(MODEL_DISTILLED_PATH):
+            # Se carga y precalienta en segundo plano (warmup)
+            variants.append(ModelVariant('distilled', MODEL_DISTILLED_PATH, 0.5))
+    return variants
+
+
+model_pool = ModelVariantPool(build_model_variants(), MODEL_LATENCY_TARGETS_MS)
+
+
+def start_model_pool_warmup():
+    if len(model_pool.variants) > 1:
+        base_imgsz = 640 if DEVICE == 'cpu' else 960
+        threading.Thread(target=model_pool.warmup, args=(base_imgsz,), daemon=True, name='model-warmup').start()
+
+
+# ==================== CACHES EN MEMORIA ====================
+# Todas las caches del proceso tienen presupuesto en bytes, TTL deslizante y
+# desalojo LRU. Un gestor global impone además un techo de memoria común.
+
+CACHE_MEMORY_CEILING = int(os.environ.get('CACHE_MEMORY_CEILING_MB', 256)) * 1024 * 1024
+CACHE_SWEEP_INTERVAL = 30  # segundos entre barridos de entradas expiradas
+
+
+def estimate_size(value):
+    """Estimación aproximada en bytes de un valor cacheado"""
+    if isinstance(value, np.ndarray):
+        return value.nbytes + 112
+    if hasattr(value, 'boxes'):  # FrameDetections
+        return value.boxes.nbytes + 160
+    if isinstance(value, dict):
+        return 240 + sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, deque)):
+        return 64 + 8 * len(value) + sum(estimate_size(v) for v in value)
+    if isinstance(value, (str, bytes)):
+        return 50 + len(value)
+    return 32
+
+
+class BoundedCache:
+    """Cache thread-safe con presupuesto en bytes, TTL y desalojo LRU.
+
+    `evictable(key, value)` permite proteger entradas en uso (por ejemplo,
+    trabajos que siguen procesándose); esas entradas no expiran ni se desalojan.
+    """
+
+    def __init__(self, name, max_bytes, ttl=None, evictable=None, manager=None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.evictable = evictable
+        self.manager = manager
+        self._data = OrderedDict()  # key -> [valor, bytes, último acceso]
+        self._lock = threading.RLock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = {'lru': 0, 'ttl': 0, 'global': 0, 'trim': 0}
+        if manager is not None:
+            manager.register(self)
+
+    def _is_evictable(self, key, value):
+        return self.evictable is None or self.evictable(key, value)
+
+    def _is_expired(self, key, item, now):
+        return (self.ttl is not None and now - item[2] > self.ttl
+                and self._is_evictable(key, item[0]))
+
+    def _remove(self, key, reason=None):
+        item = self._data.pop(key)
+        self.bytes -= item[1]
+        if reason:
+            self.evictions[reason] += 1
+        return item[0]
+
+    def _lookup(self, key):
+        """Devuelve la entrada viva (y la marca como usada) o None"""
+        item = self._data.get(key)
+        if item is None:
+            return None
+        now = time.time()
+        if self._is_expired(key, item, now):
+            self._remove(key, 'ttl')
+            return None
+        item[2] = now
+        self._data.move_to_end(key)
+        return item
+
+    def _trim(self, key, item):
+        """Recorta los elementos más antiguos de una entrada secuencia que
+        supera la mitad del presupuesto, en lugar de desalojarla completa"""
+        if not self._is_evictable(key, item[0]):
+            return  # una entrada protegida se conserva completa
+        items = item[0]
+        while item[1] > self.max_bytes // 2 and len(items) > 1:
+            removed = estimate_size(items.popleft()) + 8
+            item[1] -= removed
+            self.bytes -= removed
+            self.evictions['trim'] += 1
+
+    def _evict_to_budget(self, keep=None):
+        """Desaloja entradas LRU hasta respetar el presupuesto propio"""
+        for key in list(self._data.keys()):
+            if self.bytes <= self.max_bytes:
+                break
+            if key == keep or not self._is_evictable(key, self._data[key][0]):
+                continue
+            self._remove(key, 'lru')
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def __getitem__(self, key):
+        with self._lock:
+            item = self._lookup(key)
+            if item is None:
+                self.misses += 1
+                raise KeyError(key)
+            self.hits += 1
+            return item[0]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        if isinstance(value, list):
+            value = deque(value)
+        size = estimate_size(value)
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            item = [value, size, time.time()]
+            self._data[key] = item
+            self.bytes += size
+            if isinstance(value, deque):
+                self._trim(key, item)
+            self._evict_to_budget(keep=key)
+        if self.manager is not None:
+            self.manager.enforce()
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def peek(self, key, default=None):
+        """Valor sin marcarlo como usado ni contar acierto/fallo"""
+        with self._lock:
+            item = self._data.get(key)
+            return default if item is None else item[0]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            return self._remove(key)
+
+    def append(self, key, value):
+        """Agrega un elemento a una entrada de tipo secuencia"""
+        size = estimate_size(value) + 8
+        with self._lock:
+            item = self._lookup(key)
+            if item is None:
+                item = [deque(), 64, time.time()]
+                self._data[key] = item
+                self.bytes += item[1]
+            item[0].append(value)
+            item[1] += size
+            self.bytes += size
+            self._trim(key, item)
+            self._evict_to_budget(keep=key)
+        if self.manager is not None:
+            self.manager.enforce()
+
+    def purge_expired(self):
+        """Elimina todas las entradas con TTL vencido"""
+        now = time.time()
+        with self._lock:
+            expired = [k for k, item in self._data.items() if self._is_expired(k, item, now)]
+            for key in expired:
+                self._remove(key, 'ttl')
+        return len(expired)
+
+    def oldest_access(self):
+        """Último acceso de la entrada desalojable más antigua (o None)"""
+        with self._lock:
+            for key, item in self._data.items():
+                if self._is_evictable(key, item[0]):
+                    return item[2]
+        return None
+
+    def snapshot(self, predicate=None):
+        """Copia de (clave, valor) de las entradas, sin marcarlas como usadas"""
+        with self._lock:
+            return [(key, dict(item[0]) if isinstance(item[0], dict) else item[0])
+                    for key, item in self._data.items()
+                    if predicate is None or predicate(key, item[0])]
+
+    def evict_oldest(self, reason='global'):
+        with self._lock:
+            for key, item in self._data.items():
+                if self._is_evictable(key, item[0]):
+                    self._remove(key, reason)
+                    return True
+        return False
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._data),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'evictions': dict(self.evictions)
+            }
+
+
+class CacheManager:
+    """Registro de caches con un techo global de memoria compartido"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.caches = []
+        self._lock = threading.Lock()
+
+    def register(self, cache):
+        self.caches.append(cache)
+
+    def total_bytes(self):
+        return sum(c.bytes for c in self.caches)
+
+    def enforce(self):
+        """Desaloja la entrada menos usada entre todas las caches hasta
+        quedar bajo el techo global"""
+        with self._lock:
+            while self.total_bytes() > self.max_bytes:
+                candidates = [(c.oldest_access(), c) for c in self.caches]
+                candidates = [(t, c) for t, c in candidates if t is not None]
+                if not candidates:
+                    break
+                _, victim = min(candidates, key=lambda x: x[0])
+                if not victim.evict_oldest('global'):
+                    break
+
+    def sweep(self):
+        expired = sum(c.purge_expired() for c in self.caches)
+        self.enforce()
+        return expired
+
+    def stats(self):
+        return {
+            'total_bytes': self.total_bytes(),
+            'max_bytes': self.max_bytes,
+            'caches': {c.name: c.stats() for c in self.caches}
+        }
+
+
+cache_manager = CacheManager(CACHE_MEMORY_CEILING)
+
+
+def cache_sweeper_loop():
+    """Hilo en segundo plano que purga entradas expiradas periódicamente"""
+    while True:
+        time.sleep(CACHE_SWEEP_INTERVAL)
+        try:
+            expired = cache_manager.sweep()
+            if expired:
+                print(f"Caches: {expired} entradas expiradas eliminadas")
+        except Exception as e:
+            print(f"Error al purgar caches: {e}")
+
+
+def start_cache_sweeper():
+    threading.Thread(target=cache_sweeper_loop, daemon=True, name='cache-sweeper').start()
+
+
 # Variables globales para webcam
 camera = None
 camera_active = False
 lock = threading.Lock()
 
-# Estado de procesamiento de video
-video_processing_status = {}
+# Estado de procesamiento de video (los trabajos en curso nunca se desalojan)
+video_processing_status = BoundedCache(
+    'video_status', 4 * 1024 * 1024, ttl=24 * 3600,
+    evictable=lambda key, value: value.get('status') != 'processing',
+    manager=cache_manager)
 status_lock = threading.Lock()
 
-# Almacenamiento de frames procesados para streaming en tiempo real
-video_frames_cache = {}  # {filename: [frame1, frame2, ...]}
-frames_cache_lock = threading.Lock()
-
 # Almacenamiento de detecciones con coordenadas para interacción
-detections_cache = {}  # {session_id: {'detections': [...], 'timestamp': ..., 'width': ..., 'height': ...}}
+# {session_id: {'detections': [...], 'timestamp': ..., 'width': ..., 'height': ...}}
+detections_cache = BoundedCache('detections', 32 * 1024 * 1024, ttl=3600, manager=cache_manager)
 detections_lock = threading.Lock()
-detections_frames_cache = {}  # {session_id: [{'frame': int, 'detections': [...], 'width': w, 'height': h}]}
+# {session_id: deque[FrameDetections]} (las de trabajos en curso no se recortan ni desalojan)
+detections_frames_cache = BoundedCache(
+    'frame_detections', 128 * 1024 * 1024, ttl=2 * 3600,
+    evictable=lambda key, value: (video_processing_status.peek(key) or {}).get('status') != 'processing',
+    manager=cache_manager)
 detections_frames_lock = threading.Lock()
 
+# ==================== DETECCIONES COMPACTAS ====================
+# En memoria cada frame guarda sus cajas en un array estructurado de NumPy con
+# índices a una tabla de nombres de clase, en lugar de dicts anidados.
+
+DETECTION_DTYPE = np.dtype([
+    ('cls', np.uint16), ('conf', np.float32),
+    ('x1', np.float32), ('y1', np.float32), ('x2', np.float32), ('y2', np.float32)
+])
+EMPTY_DETECTIONS = np.zeros(0, dtype=DETECTION_DTYPE)
+EMPTY_DETECTIONS.setflags(write=False)
+
+CLASS_NAMES = [model.names[i] for i in sorted(model.names)] if model is not None else []
+CLASS_INDEX = {name: i for i, name in enumerate(CLASS_NAMES)}
+
+# Tipo MIME del formato columnar que el cliente puede pedir vía Accept
+COMPACT_DETECTIONS_MIMETYPE = 'application/vnd.yolo-detections+json'
+
+
+def get_class_index(name):
+    """Índice de una clase en la tabla (se agrega si no existe)"""
+    if name not in CLASS_INDEX:
+        CLASS_INDEX[name] = len(CLASS_NAMES)
+        CLASS_NAMES.append(name)
+    return CLASS_INDEX[name]
+
+
+def pack_detections(detections):
+    """Lista de detecciones (dicts) -> array estructurado"""
+    if not len(detections):
+        return EMPTY_DETECTIONS
+    packed = np.empty(len(detections), dtype=DETECTION_DTYPE)
+    for i, det in enumerate(detections):
+        bbox = det['bbox']
+        packed[i] = (get_class_index(det['class']), det['confidence'],
+                     bbox['x1'], bbox['y1'], bbox['x2'], bbox['y2'])
+    return packed
+
+
+def unpack_detections(packed):
+    """Array estructurado -> lista de detecciones (dicts) del formato clásico"""
+    return [{
+        'class': CLASS_NAMES[int(row['cls'])],
+        'confidence': round(float(row['conf']), 2),
+        'bbox': {
+            'x1': float(row['x1']),
+            'y1': float(row['y1']),
+            'x2': float(row['x2']),
+            'y2': float(row['y2'])
+        }
+    } for row in packed]
+
+
+class FrameDetections:
+    """Detecciones compactas de un frame de video"""
+    __slots__ = ('frame', 'boxes', 'width', 'height')
+
+    def __init__(self, frame, boxes, width, height):
+        self.frame = frame
+        self.boxes = boxes
+        self.width = width
+        self.height = height
+
+    @classmethod
+    def from_dict(cls, frame_data):
+        return cls(frame_data['frame'], pack_detections(frame_data['detections']),
+                   frame_data['width'], frame_data['height'])
+
+    def to_dict(self):
+        return {
+            'frame': self.frame,
+            'detections': self.boxes,
+            'width': self.width,
+            'height': self.height
+        }
+
+
+def columnar_detections(detections):
+    """Detecciones (dicts o array estructurado) -> columnas con índices de clase.
+
+    La tabla de nombres (CLASS_NAMES) va una sola vez en el nivel superior de
+    la respuesta, no en cada lista de detecciones.
+    """
+    if not isinstance(detections, np.ndarray):
+        detections = pack_detections(detections)
+    xyxy = np.stack([detections['x1'], detections['y1'], detections['x2'], detections['y2']], axis=1)
+    return {
+        'cls': detections['cls'].tolist(),
+        'conf': detections['conf'].astype(np.float64).round(2).tolist(),
+        'xyxy': xyxy.astype(np.float64).round(1).ravel().tolist()
+    }
+
+
+def _convert_entry_detections(entry, convert):
+    """Aplica convert a 'detections' de una entrada y de sus frames_detections"""
+    entry = dict(entry)
+    if 'detections' in entry:
+        entry['detections'] = convert(entry['detections'])
+    if entry.get('frames_detections'):
+        entry['frames_detections'] = [_convert_entry_detections(f, convert) for f in entry['frames_detections']]
+    return entry
+
+
+def wants_compact_detections():
+    """True si el cliente prefiere el formato columnar compacto"""
+    best = request.accept_mimetypes.best_match(['application/json', COMPACT_DETECTIONS_MIMETYPE])
+    return best == COMPACT_DETECTIONS_MIMETYPE
+
+
+def detections_jsonify(data):
+    """jsonify que elige JSON clásico o columnar compacto según el header Accept"""
+    single = not isinstance(data, list)
+    entries = [data] if single else data
+    if wants_compact_detections():
+        entries = [_convert_entry_detections(e, columnar_detections) for e in entries]
+        # Tabla de clases una vez por respuesta; las listas van en 'entries'
+        if single:
+            payload = dict(entries[0], class_names=CLASS_NAMES)
+        else:
+            payload = {'class_names': CLASS_NAMES, 'entries': entries}
+        if orjson is not None:
+            body = orjson.dumps(payload)
+        else:
+            body = json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+        response = Response(body, mimetype=COMPACT_DETECTIONS_MIMETYPE)
+    else:
+        def to_dicts(detections):
+            return unpack_detections(detections) if isinstance(detections, np.ndarray) else detections
+        entries = [_convert_entry_detections(e, to_dicts) for e in entries]
+        response = jsonify(entries[0] if single else entries)
+    response.headers['Vary'] = 'Accept'
+    return response
+
+# ==================== ANALÍTICA DE DETECCIONES ====================
+# Agregados que el procesamiento mantiene frame a frame: conteos por clase en
+# intervalos de tiempo, pico de animales simultáneos, primera/última aparición
+# e histograma de confianza. Se guardan con el checkpoint y en el historial.
+
+ANALYTICS_BUCKET_SECONDS = 10
+ANALYTICS_CONFIDENCE_BINS = 10
+
+
+class DetectionAnalytics:
+    """Agregados incrementales de detecciones de un video"""
+
+    def __init__(self, fps, bucket_seconds=ANALYTICS_BUCKET_SECONDS):
+        self.fps = fps or 30.0
+        self.bucket_seconds = bucket_seconds
+        self.frames_analyzed = 0
+        self.frames_represented = 0  # frames del video cubiertos (con muestreo, cada análisis vale varios)
+        self.buckets = {}  # {índice: {clase: {'max': n, 'frames': n}}}
+        self.classes = {}  # {clase: estadísticas}
+        self.peak_total = 0
+        self.peak_total_frame = None
+        self._lock = threading.Lock()
+
+    def _class_stats(self, name):
+        stats = self.classes.get(name)
+        if stats is None:
+            stats = self.classes[name] = {
+                'first_frame': None,
+                'last_frame': None,
+                'peak': 0,
+                'peak_frame': None,
+                'frames': 0,
+                'detections': 0,
+                'confidence_hist': [0] * ANALYTICS_CONFIDENCE_BINS
+            }
+        return stats
+
+    def update(self, frame_index, detections, weight=1):
+        """Incorpora las detecciones de un frame analizado"""
+        with self._lock:
+            self.frames_analyzed += 1
+            self.frames_represented += weight
+            if not detections:
+                return
+            counts = {}
+            for det in detections:
+                name = det['class']
+                counts[name] = counts.get(name, 0) + 1
+                stats = self._class_stats(name)
+                stats['detections'] += 1
+                stats['confidence_hist'][min(int(det['confidence'] * ANALYTICS_CONFIDENCE_BINS),
+                                             ANALYTICS_CONFIDENCE_BINS - 1)] += 1
+            bucket = self.buckets.setdefault(int(frame_index / self.fps // self.bucket_seconds), {})
+            for name, count in counts.items():
+                stats = self.classes[name]
+                if stats['first_frame'] is None or frame_index < stats['first_frame']:
+                    stats['first_frame'] = frame_index
+                if stats['last_frame'] is None or frame_index > stats['last_frame']:
+                    stats['last_frame'] = frame_index
+                stats['frames'] += weight
+                if count > stats['peak']:
+                    stats['peak'] = count
+                    stats['peak_frame'] = frame_index
+                slot = bucket.setdefault(name, {'max': 0, 'frames': 0})
+                slot['max'] = max(slot['max'], count)
+                slot['frames'] += weight
+            if len(detections) > self.peak_total:
+                self.peak_total = len(detections)
+                self.peak_total_frame = frame_index
+
+    def merge(self, other):
+        """Combina los agregados de otro rango de frames (procesamiento paralelo)"""
+        with self._lock:
+            self.frames_analyzed += other.frames_analyzed
+            self.frames_represented += other.frames_represented
+            for index, bucket in other.buckets.items():
+                target = self.buckets.setdefault(index, {})
+                for name, slot in bucket.items():
+                    current = target.setdefault(name, {'max': 0, 'frames': 0})
+                    current['max'] = max(current['max'], slot['max'])
+                    current['frames'] += slot['frames']
+            for name, other_stats in other.classes.items():
+                stats = self._class_stats(name)
+                for key, pick in (('first_frame', min), ('last_frame', max)):
+                    values = [v for v in (stats[key], other_stats[key]) if v is not None]
+                    stats[key] = pick(values) if values else None
+                if other_stats['peak'] > stats['peak']:
+                    stats['peak'] = other_stats['peak']
+                    stats['peak_frame'] = other_stats['peak_frame']
+                stats['frames'] += other_stats['frames']
+                stats['detections'] += other_stats['detections']
+                stats['confidence_hist'] = [a + b for a, b in zip(stats['confidence_hist'], other_stats['confidence_hist'])]
+            if other.peak_total > self.peak_total:
+                self.peak_total = other.peak_total
+                self.peak_total_frame = other.peak_total_frame
+
+    def to_dict(self):
+        """Estado completo serializable (checkpoint y resultado de partes)"""
+        with self._lock:
+            return {
+                'fps': self.fps,
+                'bucket_seconds': self.bucket_seconds,
+                'frames_analyzed': self.frames_analyzed,
+                'frames_represented': self.frames_represented,
+                'buckets': {str(k): {n: dict(s) for n, s in v.items()} for k, v in self.buckets.items()},
+                'classes': {n: dict(s, confidence_hist=list(s['confidence_hist'])) for n, s in self.classes.items()},
+                'peak_total': self.peak_total,
+                'peak_total_frame': self.peak_total_frame
+            }
+
+    @classmethod
+    def from_dict(cls, data):
+        analytics = cls(data['fps'], data.get('bucket_seconds', ANALYTICS_BUCKET_SECONDS))
+        analytics.frames_analyzed = data.get('frames_analyzed', 0)
+        analytics.frames_represented = data.get('frames_represented', 0)
+        analytics.buckets = {int(k): v for k, v in data.get('buckets', {}).items()}
+        analytics.classes = data.get('classes', {})
+        analytics.peak_total = data.get('peak_total', 0)
+        analytics.peak_total_frame = data.get('peak_total_frame')
+        return analytics
+
+    def summary(self):
+        """Resumen listo para servir (tiempos en segundos)"""
+        def seconds(frame_index):
+            return round(frame_index / self.fps, 2) if frame_index is not None else None
+
+        with self._lock:
+            classes = {}
+            for name, stats in self.classes.items():
+                classes[name] = {
+                    'detections': stats['detections'],
+                    'peak_count': stats['peak'],
+                    'peak_at': seconds(stats['peak_frame']),
+                    'first_seen': seconds(stats['first_frame']),
+                    'last_seen': seconds(stats['last_frame']),
+                    'presence_seconds': round(stats['frames'] / self.fps, 2),
+                    'confidence_hist': list(stats['confidence_hist'])
+                }
+            timeline = [
+                {
+                    'start': index * self.bucket_seconds,
+                    'counts': {n: s['max'] for n, s in bucket.items()},
+                    'presence_seconds': {n: round(s['frames'] / self.fps, 2) for n, s in bucket.items()}
+                }
+                for index, bucket in sorted(self.buckets.items())
+            ]
+            return {
+                'fps': self.fps,
+                'bucket_seconds': self.bucket_seconds,
+                'analyzed_seconds': round(self.frames_represented / self.fps, 2),
+                'frames_analyzed': self.frames_analyzed,
+                'peak_simultaneous': self.peak_total,
+                'peak_simultaneous_at': seconds(self.peak_total_frame),
+                'confidence_bins': [round(i / ANALYTICS_CONFIDENCE_BINS, 2) for i in range(ANALYTICS_CONFIDENCE_BINS + 1)],
+                'classes': classes,
+                'timeline': timeline
+            }
+
+
+# Agregados en vivo de los trabajos en curso
+video_analytics = {}
+video_analytics_lock = threading.Lock()
+
+
 # ==================== HISTORIAL ====================
 history_lock = threading.Lock()
 
 
-def load_history():
-    """Carga historial desde archivo"""
-    if not os.path.exists(HISTORY_FILE):
-        return []
+# Copia parseada del historial en memoria; se invalida al escribir o si el
+# archivo cambia fuera del proceso (mtime distinto). Si el archivo no se puede
+# leer se conservan las entradas anteriores y se registra el error: un fallo
+# de lectura nunca equivale a un historial vacío.
+# (mtime -1: todavía no se ha leído). La versión es un hash del contenido del
+# archivo, así que se mantiene entre reinicios (sirve de ETag).
+_history_cache = {'mtime': -1, 'entries': [], 'version': 'empty', 'error': None}
+_history_cache_lock = threading.Lock()
+
+
+def history_content_version(raw):
+    """Versión estable del historial: hash de los bytes de history.json"""
+    return hashlib.sha1(raw).hexdigest()[:16]
+
+
+def get_history_snapshot():
+    """Entradas del historial en cache (solo lectura) y su versión"""
     try:
-        with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except Exception:
-        return []
+        mtime = os.stat(HISTORY_FILE).st_mtime_ns
+    except OSError:
+        mtime = None
+    with _history_cache_lock:
+        if _history_cache['mtime'] != mtime:
+            _history_cache['mtime'] = mtime
+            if mtime is None:
+                _history_cache['error'] = 'No existe el archivo de historial'
+                return _history_cache['entries'], _history_cache['version']
+            try:
+                with open(HISTORY_FILE, 'rb') as f:
+                    raw = f.read()
+                entries = json.loads(raw.decode('utf-8'))
+                if not isinstance(entries, list):
+                    raise ValueError('el historial no es una lista')
+            except Exception as e:
+                _history_cache['error'] = f'Historial ilegible: {e}'
+                print(f"Error al leer historial (se conservan {len(_history_cache['entries'])} entradas en memoria): {e}")
+                return _history_cache['entries'], _history_cache['version']
+            _history_cache['error'] = None
+            _history_cache['entries'] = entries
+            _history_cache['version'] = history_content_version(raw)
+        return _history_cache['entries'], _history_cache['version']
+
+
+def history_load_error():
+    """Motivo por el que el historial en disco no se pudo leer (None si está bien)"""
+    get_history_snapshot()
+    with _history_cache_lock:
+        return _history_cache['error']
+
+
+def load_history():
+    """Carga historial (copia de las entradas, para poder modificarlas)"""
+    entries, _ = get_history_snapshot()
+    return [dict(h) for h in entries]
 
 
 def save_history(history):
-    """Guarda historial en archivo"""
+    """Guarda historial en archivo y actualiza la copia en memoria"""
     try:
-        with open(HISTORY_FILE, 'w', encoding='utf-8') as f:
-            json.dump(history, f, ensure_ascii=False, indent=2)
+        with _history_cache_lock:
+            unreadable = _history_cache['error'] is not None and os.path.exists(HISTORY_FILE)
+        if unreadable:
+            # No pisar un historial que no se pudo leer (p. ej. una edición a mano rota)
+            backup_path = f"{HISTORY_FILE}.corrupt-{time.strftime('%Y%m%d_%H%M%S')}"
+            shutil.copy2(HISTORY_FILE, backup_path)
+            print(f"Historial ilegible respaldado en {backup_path}")
+        raw = json.dumps(history, ensure_ascii=False, indent=2).encode('utf-8')
+        tmp_path = HISTORY_FILE + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(raw)
+        os.replace(tmp_path, HISTORY_FILE)
+        with _history_cache_lock:
+            _history_cache['mtime'] = os.stat(HISTORY_FILE).st_mtime_ns
+            _history_cache['entries'] = [dict(h) for h in history]
+            _history_cache['error'] = None
+            _history_cache['version'] = history_content_version(raw)
     except Exception as e:
         print(f"Error al guardar historial: {e}")
 
 
 def get_history_entry(filename):
-    history = load_history()
+    history, _ = get_history_snapshot()
     for h in history:
         if h.get('output_filename') == filename:
-            return h
+            return dict(h)
     return None
 
 
@@ -134,11 +972,13 @@ def update_history_progress(output_filename, progress=None, status=None):
         updated = False
         for h in history:
             if h.get('output_filename') == output_filename:
-                if progress is not None:
+                # Solo escribir si cambia algo (se llama en cada frame)
+                if progress is not None and h.get('progress') != progress:
                     h['progress'] = progress
-                if status is not None:
+                    updated = True
+                if status is not None and h.get('status') != status:
                     h['status'] = status
-                updated = True
+                    updated = True
                 break
         if updated:
             save_history(history)
@@ -224,10 +1064,17 @@ def realtime_page():
     return render_template('realtime.html')
 
 
+# hls.js servido localmente (sin dependencias de CDN); sin él, la vista previa
+# en vivo usa el HLS nativo del navegador si lo hay
+HLS_JS_VERSION = '1.5.20'
+HLS_JS_PATH = os.path.join(app.static_folder, 'js', 'vendor', f'hls-{HLS_JS_VERSION}.min.js')
+
+
 @app.route('/video')
 def video_page():
     """Página de procesamiento de videos"""
-    return render_template('video.html')
+    hls_js = f'js/vendor/hls-{HLS_JS_VERSION}.min.js' if os.path.exists(HLS_JS_PATH) else None
+    return render_template('video.html', hls_js=hls_js)
 
 
 @app.route('/image')
@@ -235,11 +1082,443 @@ def image_page():
     """Página de análisis de imágenes"""
     return render_template('image.html')
 
+# ==================== PREPROCESADO ====================
+
+class LetterboxPreprocessor:
+    """Preprocesado con un único redimensionado por frame.
+
+    El frame de origen se reduce directamente a la resolución del modelo dentro
+    de un buffer letterbox preasignado (alineado al stride, como el modo rect de
+    Ultralytics) y reutilizado en cada frame. Las cajas se devuelven a las
+    coordenadas de salida de forma analítica, sin reescalar la imagen otra vez.
+    """
+
+    def __init__(self, src_width, src_height, imgsz, output_size=None, stride=32, pad_value=114):
+        self.imgsz = imgsz
+        self.stride = stride
+        self.pad_value = pad_value
+        self.output_size = output_size or (src_width, src_height)
+        self._configure(src_width, src_height)
+
+    def _configure(self, src_width, src_height):
+        """Prepara el buffer letterbox y las escalas para un tamaño de origen"""
+        imgsz, stride = self.imgsz, self.stride
+        self.src_size = (src_width, src_height)
+
+        r = min(imgsz / src_width, imgsz / src_height)
+        new_w = max(1, int(round(src_width * r)))
+        new_h = max(1, int(round(src_height * r)))
+        buf_w = int(math.ceil(new_w / stride) * stride)
+        buf_h = int(math.ceil(new_h / stride) * stride)
+        self.new_size = (new_w, new_h)
+        self.left = (buf_w - new_w) // 2
+        self.top = (buf_h - new_h) // 2
+        self.interpolation = cv2.INTER_AREA if r < 1 else cv2.INTER_LINEAR
+
+        self.buffer = np.full((buf_h, buf_w, 3), self.pad_value, dtype=np.uint8)
+        self.roi = self.buffer[self.top:self.top + new_h, self.left:self.left + new_w]
+        self.output_buffer = None
+
+        # Escala de coordenadas del buffer a coordenadas de salida
+        self.scale_x = self.output_size[0] / new_w
+        self.scale_y = self.output_size[1] / new_h
+
+    def letterbox(self, frame):
+        """Escribe el frame reducido en el buffer del modelo y lo devuelve"""
+        if (frame.shape[1], frame.shape[0]) != self.src_size:
+            self._configure(frame.shape[1], frame.shape[0])
+        resized = cv2.resize(frame, self.new_size, dst=self.roi, interpolation=self.interpolation)
+        if not np.shares_memory(resized, self.buffer):
+            self.roi[...] = resized  # OpenCV no pudo escribir directamente en la vista
+        return self.buffer
+
+    def output_frame(self, frame):
+        """Frame de origen a la resolución de salida (buffer reutilizado)"""
+        out_w, out_h = self.output_size
+        if (frame.shape[1], frame.shape[0]) == self.output_size:
+            return frame
+        if self.output_buffer is None:
+            self.output_buffer = np.empty((out_h, out_w, 3), dtype=np.uint8)
+        return cv2.resize(frame, self.output_size, dst=self.output_buffer, interpolation=cv2.INTER_AREA)
+
+    def to_output(self, detections):
+        """Convierte cajas del buffer del modelo a coordenadas de salida"""
+        out_w, out_h = self.output_size
+        for det in detections:
+            bbox = det['bbox']
+            bbox['x1'] = min(max((bbox['x1'] - self.left) * self.scale_x, 0.0), out_w)
+            bbox['x2'] = min(max((bbox['x2'] - self.left) * self.scale_x, 0.0), out_w)
+            bbox['y1'] = min(max((bbox['y1'] - self.top) * self.scale_y, 0.0), out_h)
+            bbox['y2'] = min(max((bbox['y2'] - self.top) * self.scale_y, 0.0), out_h)
+        return detections
+
+
+# Paleta BGR para dibujar cajas por clase
+CLASS_COLORS = [(56, 56, 255), (151, 157, 255), (31, 112, 255), (29, 178, 255), (49, 210, 207),
+                (10, 249, 72), (23, 204, 146), (134, 219, 61), (211, 188, 0), (209, 99, 0)]
+
+
+def draw_detections(image, detections):
+    """Dibuja cajas y etiquetas sobre la imagen (in situ)"""
+    line_width = max(round(sum(image.shape[:2]) / 2 * 0.003), 2)
+    font_scale = line_width / 3
+    class_ids = {name: i for i, name in model.names.items()} if model is not None else {}
+    for det in detections:
+        bbox = det['bbox']
+        color = CLASS_COLORS[class_ids.get(det['class'], 0) % len(CLASS_COLORS)]
+        p1 = (int(bbox['x1']), int(bbox['y1']))
+        p2 = (int(bbox['x2']), int(bbox['y2']))
+        cv2.rectangle(image, p1, p2, color, line_width, cv2.LINE_AA)
+
+        label = f"{det['class']} {det['confidence']:.2f}"
+        (text_w, text_h), _ = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, font_scale, max(line_width - 1, 1))
+        outside = p1[1] - text_h - 3 >= 0
+        label_p2 = (p1[0] + text_w, p1[1] - text_h - 3 if outside else p1[1] + text_h + 3)
+        cv2.rectangle(image, p1, label_p2, color, -1, cv2.LINE_AA)
+        cv2.putText(image, label, (p1[0], p1[1] - 2 if outside else p1[1] + text_h + 2),
+                    cv2.FONT_HERSHEY_SIMPLEX, font_scale, (255, 255, 255), max(line_width - 1, 1), cv2.LINE_AA)
+    return image
+
+
+# ==================== DECODIFICACIÓN DE VIDEO ====================
+# Decodificador común para el procesamiento de videos. Con PyAV (FFmpeg) se
+# decodifica con hilos a nivel de frame/slice, los frames saltados no se
+# convierten a BGR, la conversión de color y el escalado a la resolución de
+# trabajo se hacen en un solo paso, y los saltos largos buscan el keyframe
+# anterior en lugar de decodificar todo lo intermedio. Sin PyAV se usa
+# cv2.VideoCapture con la misma interfaz.
+
+try:
+    import av
+except ImportError:
+    av = None
+
+VIDEO_DECODER = os.environ.get('VIDEO_DECODER', 'auto')  # auto | pyav | opencv
+DECODER_THREADS = int(os.environ.get('DECODER_THREADS', 0))  # 0 = automático
+DECODER_SEEK_MIN_SECONDS = 2.0  # saltos más cortos se resuelven decodificando
+
+# Los procesos de trabajo en paralelo limitan los hilos de decodificación
+decoder_thread_count = DECODER_THREADS
+
+
+class OpenCVDecoder:
+    """Decodificador basado en cv2.VideoCapture"""
+
+    backend = 'opencv'
+
+    def __init__(self, path, max_dimension=None):
+        self.path = path
+        self.max_dimension = max_dimension
+        self.cap = cv2.VideoCapture(path)
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS)
+        self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.frame_count = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.output_size = get_output_size(self.width, self.height, max_dimension) if max_dimension \
+            else (self.width, self.height)
+        self.frame_size = (self.width, self.height)  # OpenCV entrega la resolución original
+        self.position = 0
+        self._frame = None
+
+    def is_opened(self):
+        return self.cap.isOpened()
+
+    def grab(self):
+        """Avanza un frame sin convertirlo"""
+        if not self.cap.grab():
+            return False
+        self.position += 1
+        return True
+
+    def read(self):
+        """Siguiente frame BGR en frame_size (None al terminar); el buffer se reutiliza"""
+        ret, self._frame = self.cap.read(self._frame)
+        if not ret:
+            return None
+        self.position += 1
+        return self._frame
+
+    def seek(self, frame_index):
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+        self.position = frame_index
+
+    def skip(self, count):
+        """Salta count frames (búsqueda directa si el salto es largo)"""
+        if count >= DECODER_SEEK_MIN_SECONDS * (self.fps or 30):
+            self.seek(self.position + count)
+            return True
+        for _ in range(count):
+            if not self.grab():
+                return False
+        return True
+
+    def release(self):
+        self.cap.release()
+
+
+class PyAVDecoder:
+    """Decodificador FFmpeg (PyAV) con hilos y escalado en la conversión de color"""
+
+    backend = 'pyav'
+
+    def __init__(self, path, max_dimension=None):
+        self.path = path
+        self.max_dimension = max_dimension
+        self._open()
+
+    def _open(self):
+        """Abre el contenedor y deja la lectura al inicio del video"""
+        self.container = av.open(self.path)
+        self.stream = self.container.streams.video[0]
+        self.stream.thread_type = 'AUTO'  # frame + slice
+        if decoder_thread_count:
+            self.stream.codec_context.thread_count = decoder_thread_count
+        rate = self.stream.average_rate or self.stream.guessed_rate
+        self.fps = float(rate) if rate else 0.0
+        self.width = self.stream.codec_context.width
+        self.height = self.stream.codec_context.height
+        self.frame_count = self.stream.frames
+        if not self.frame_count and self.stream.duration and self.fps:
+            self.frame_count = int(self.stream.duration * self.stream.time_base * self.fps)
+        if not self.frame_count and self.container.duration and self.fps:
+            # Matroska/WebM no declaran frames ni duración por stream: estimar
+            # con la duración del contenedor, como hace OpenCV
+            self.frame_count = int(self.container.duration / av.time_base * self.fps)
+        self.output_size = get_output_size(self.width, self.height, self.max_dimension) if self.max_dimension \
+            else (self.width, self.height)
+        self.frame_size = self.output_size  # el escalado se hace al convertir a BGR
+        self.position = 0
+        self._start_pts = self.stream.start_time or 0
+        self._frames = self.container.decode(self.stream)
+        self._pending = None  # frame ya decodificado por seek()
+
+    def is_opened(self):
+        return self.width > 0 and self.height > 0
+
+    def _next(self):
+        if self._pending is not None:
+            frame, self._pending = self._pending, None
+            return frame
+        try:
+            return next(self._frames)
+        except (StopIteration, av.error.FFmpegError):
+            return None
+
+    def _index_of(self, frame):
+        if frame.pts is None or not self.fps:
+            return self.position
+        return int(round(float((frame.pts - self._start_pts) * self.stream.time_base) * self.fps))
+
+    def grab(self):
+        """Decodifica un frame sin convertirlo a BGR"""
+        if self._next() is None:
+            return False
+        self.position += 1
+        return True
+
+    def read(self):
+        """Siguiente frame BGR en frame_size (None al terminar)"""
+        frame = self._next()
+        if frame is None:
+            return None
+        self.position += 1
+        width, height = self.output_size
+        # Conversión de color y escalado en una sola pasada de swscale
+        return frame.reformat(width=width, height=height, format='bgr24', interpolation='AREA').to_ndarray()
+
+    def seek(self, frame_index):
+        """Posiciona en frame_index: salta al keyframe anterior y descarta hasta el objetivo"""
+        if frame_index == self.position:
+            return
+        if not self.fps or not self.stream.time_base:
+            # Sin base de tiempo fiable: reabrir y avanzar decodificando
+            self.container.close()
+            self._open()
+            for _ in range(frame_index):
+                if not self.grab():
+                    break
+            return
+        target_pts = self._start_pts + int(frame_index / self.fps / self.stream.time_base)
+        self.container.seek(target_pts, backward=True, any_frame=False, stream=self.stream)
+        self._frames = self.container.decode(self.stream)
+        self._pending = None
+        while True:
+            frame = self._next()
+            if frame is None or self._index_of(frame) >= frame_index:
+                self._pending = frame
+                break
+        self.position = frame_index
+
+    def skip(self, count):
+        """Salta count frames (búsqueda por keyframe si el salto es largo)"""
+        if count >= DECODER_SEEK_MIN_SECONDS * (self.fps or 30):
+            self.seek(self.position + count)
+            return self._pending is not None
+        for _ in range(count):
+            if not self.grab():
+                return False
+        return True
+
+    def release(self):
+        self.container.close()
+
+
+def open_video_decoder(path, max_dimension=None):
+    """Abre el mejor decodificador disponible.
+
+    output_size es la resolución de trabajo (lado mayor limitado a
+    max_dimension); frame_size es el tamaño real de los frames de read(), que
+    con PyAV ya coincide con output_size.
+    """
+    if av is not None and VIDEO_DECODER in ('auto', 'pyav'):
+        try:
+            return PyAVDecoder(path, max_dimension)
+        except Exception as e:
+            if VIDEO_DECODER == 'pyav':
+                raise
+            print(f"PyAV no pudo abrir {path}, usando OpenCV: {e}")
+    return OpenCVDecoder(path, max_dimension)
+
+
 # ==================== DETECCIÓN EN TIEMPO REAL ====================
+# Una sola fuente (captura + inferencia + JPEG) corre en un hilo de trabajo y
+# publica cada frame en un FrameBroadcaster; los espectadores solo esperan el
+# siguiente frame, ya sea como hilos (servidor WSGI) o como tareas asyncio.
+# Cada parte MJPEG lleva en sus cabeceras el número de frame, la hora de
+# captura y las detecciones dibujadas en él: el cliente que lee el stream
+# obtiene las cajas exactas de la imagen que muestra, sin consultar aparte.
 
-def generate_frames():
-    """Genera frames optimizados para YOLO 11 en CPU"""
-    global camera, camera_active
+
+def mjpeg_part(jpeg, seq, captured_at, data=None):
+    """Parte multipart de un frame con su identidad (y detecciones) en las cabeceras"""
+    headers = [
+        b'--frame',
+        b'Content-Type: image/jpeg',
+        f'Content-Length: {len(jpeg)}'.encode('ascii'),
+        f'X-Frame-Seq: {seq}'.encode('ascii'),
+        f'X-Frame-Timestamp: {captured_at:.3f}'.encode('ascii')
+    ]
+    if data is not None:
+        # JSON con ensure_ascii: una sola línea válida como valor de cabecera
+        headers.append(b'X-Frame-Detections: ' + json.dumps(data, separators=(',', ':')).encode('ascii'))
+    return b'\r\n'.join(headers) + b'\r\n\r\n' + jpeg + b'\r\n'
+
+
+class FrameBroadcaster:
+    """Difunde el último frame de una fuente a muchos espectadores.
+
+    `producer(broadcaster)` se ejecuta en un hilo propio mientras haya
+    espectadores (o durante `idle_timeout` segundos tras el último) y llama
+    a publish() por cada frame. Sin producer la fuente es externa y su
+    estado se controla con set_running().
+    """
+
+    def __init__(self, name, producer, idle_timeout=5.0):
+        self.name = name
+        self.producer = producer
+        self.idle_timeout = idle_timeout
+        self._cond = threading.Condition()
+        self._loop_events = {}  # {event loop: asyncio.Event} para espectadores asíncronos
+        self.seq = 0
+        self.frame = None
+        self.data = None
+        self.viewers = 0
+        self.last_viewer_at = 0.0
+        self.running = False
+
+    def add_viewer(self):
+        with self._cond:
+            self.viewers += 1
+            if not self.running and self.producer is not None:
+                self.running = True
+                threading.Thread(target=self._run, daemon=True, name=f'{self.name}-producer').start()
+
+    def remove_viewer(self):
+        with self._cond:
+            self.viewers -= 1
+            self.last_viewer_at = time.time()
+
+    def set_running(self, running):
+        with self._cond:
+            self.running = running
+            self._cond.notify_all()
+        self._wake_loops()
+
+    def should_run(self):
+        """El productor debe seguir; si no, se marca detenido de forma atómica"""
+        with self._cond:
+            if self.viewers > 0 or time.time() - self.last_viewer_at < self.idle_timeout:
+                return True
+            self.running = False
+            return False
+
+    def _run(self):
+        try:
+            self.producer(self)
+        except Exception as e:
+            print(f"Error en la fuente {self.name}: {e}")
+        finally:
+            with self._cond:
+                self.running = False
+                self._cond.notify_all()
+            self._wake_loops()
+
+    def publish(self, jpeg, data=None, captured_at=None):
+        """Publica un JPEG ya codificado; data son las detecciones dibujadas en él"""
+        with self._cond:
+            self.seq += 1
+            self.frame = mjpeg_part(jpeg, self.seq, captured_at or time.time(), data)
+            self.data = data
+            self._cond.notify_all()
+        self._wake_loops()
+
+    def _wake_loops(self):
+        # Un solo aviso por event loop, no uno por espectador
+        for loop in list(self._loop_events):
+            try:
+                loop.call_soon_threadsafe(self._wake_loop, loop)
+            except RuntimeError:
+                self._loop_events.pop(loop, None)  # loop cerrado
+
+    def _wake_loop(self, loop):
+        event = self._loop_events.get(loop)
+        self._loop_events[loop] = asyncio.Event()
+        if event is not None:
+            event.set()
+
+    def wait_frame(self, last_seq, timeout=1.0):
+        """Espera (bloqueante) un frame posterior a last_seq: (frame, seq)"""
+        with self._cond:
+            self._cond.wait_for(lambda: self.seq != last_seq or not self.running, timeout)
+            if self.seq != last_seq:
+                return self.frame, self.seq
+            return None, last_seq
+
+    async def wait_frame_async(self, last_seq, timeout=1.0):
+        """Versión asyncio de wait_frame: no ocupa un hilo por espectador"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self.seq == last_seq and self.running:
+            event = self._loop_events.get(loop)
+            if event is None:
+                event = self._loop_events[loop] = asyncio.Event()
+            if self.seq != last_seq:
+                break
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        if self.seq != last_seq:
+            return self.frame, self.seq
+        return None, last_seq
+
+
+def realtime_producer(broadcaster):
+    """Captura de webcam + YOLO 11, optimizada según dispositivo"""
+    global camera
     
     # Configuración optimizada según dispositivo
     if DEVICE == 'cpu':
@@ -264,15 +1543,19 @@ def generate_frames():
             camera.set(cv2.CAP_PROP_FPS, 30 if DEVICE != 'cpu' else 15)  # 30 FPS en GPU, 15 en CPU
             # Buffer mínimo para menos latencia
             camera.set(cv2.CAP_PROP_BUFFERSIZE, 1)
-        camera_active = True
     
     frame_skip = 0
     last_results = None  # Cache para frames saltados
+    detections = []  # cajas dibujadas en el frame actual (las últimas en frames saltados)
     
-    while camera_active:
-        success, frame = camera.read()
+    while camera_active and broadcaster.should_run():
+        with lock:
+            if camera is None:
+                break
+            success, frame = camera.read()
         if not success:
             break
+        captured_at = time.time()
         
         # Redimensionar frame para procesamiento más rápido
         if frame.shape[1] != target_width or frame.shape[0] != target_height:
@@ -286,11 +1569,13 @@ def generate_frames():
             # Detección YOLO 11 (optimizada)
             if model is None:
                 continue
+            variant = model_pool.begin('realtime')
+            started = time.perf_counter()
             try:
-                # YOLO optimizado según dispositivo
-                results = model(
+                # YOLO optimizado según dispositivo (variante según la carga)
+                results = variant.model(
                     frame,
-                    imgsz=imgsz,
+                    imgsz=variant.imgsz(imgsz),
                     conf=conf_threshold,
                     iou=0.7 if DEVICE != 'cpu' else 0.5,
                     verbose=False,
@@ -312,7 +1597,7 @@ def generate_frames():
                         box = boxes.xyxy[i].cpu().numpy()  # [x1, y1, x2, y2]
                         cls = int(boxes.cls[i].cpu().numpy())
                         conf = float(boxes.conf[i].cpu().numpy())
-                        class_name = model.names[cls]
+                        class_name = variant.model.names[cls]
                         
                         detections.append({
                             'class': class_name,
@@ -331,11 +1616,16 @@ def generate_frames():
                         'detections': detections,
                         'timestamp': time.time(),
                         'width': target_width,
-                        'height': target_height
+                        'height': target_height,
+                        'model_variant': variant.name
                     }
             except Exception as e:
                 print(f"Error en detección: {e}")
                 annotated_frame = frame
+                last_results = None
+                detections = []
+            finally:
+                model_pool.end('realtime', (time.perf_counter() - started) * 1000)
         else:
             # Reutilizar detecciones anteriores para frames saltados
             if last_results is not None:
@@ -349,24 +1639,56 @@ def generate_frames():
         ret, buffer = cv2.imencode('.jpg', annotated_frame, encode_param)
         
         if ret:
-            frame_bytes = buffer.tobytes()
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+            # Se codifica una vez y se comparte con todos los espectadores
+            broadcaster.publish(buffer.tobytes(), captured_at=captured_at, data={
+                'detections': detections,
+                'width': target_width,
+                'height': target_height
+            })
 
-@app.route('/video_feed')
-def video_feed():
-    """Stream de video en tiempo real"""
-    return Response(generate_frames(),
-                    mimetype='multipart/x-mixed-replace; boundary=frame')
 
-@app.route('/start_camera', methods=['POST'])
-def start_camera():
-    """Iniciar cámara"""
+realtime_broadcaster = FrameBroadcaster('realtime', realtime_producer)
+
+
+def activate_realtime_camera():
+    """Abrir el stream activa la cámara, como antes"""
     global camera_active
     camera_active = True
-    return jsonify({'status': 'Camera started'})
 
-@app.route('/stop_camera', methods=['POST'])
+
+def generate_mjpeg(broadcaster, is_active):
+    """Espectador síncrono de un stream MJPEG (un hilo por conexión)"""
+    broadcaster.add_viewer()
+    try:
+        last_seq = 0
+        while is_active():
+            frame, last_seq = broadcaster.wait_frame(last_seq)
+            if frame is not None:
+                yield frame
+            elif not broadcaster.running:
+                break
+    finally:
+        broadcaster.remove_viewer()
+
+
+def generate_frames():
+    activate_realtime_camera()
+    return generate_mjpeg(realtime_broadcaster, lambda: camera_active)
+
+@app.route('/video_feed')
+def video_feed():
+    """Stream de video en tiempo real"""
+    return Response(generate_frames(),
+                    mimetype='multipart/x-mixed-replace; boundary=frame')
+
+@app.route('/start_camera', methods=['POST'])
+def start_camera():
+    """Iniciar cámara"""
+    global camera_active
+    camera_active = True
+    return jsonify({'status': 'Camera started'})
+
+@app.route('/stop_camera', methods=['POST'])
 def stop_camera():
     """Detener cámara"""
     global camera, camera_active
@@ -379,8 +1701,520 @@ def stop_camera():
     
     return jsonify({'status': 'Camera stopped'})
 
+# ==================== FUENTES MÚLTIPLES EN TIEMPO REAL ====================
+# Cámaras RTSP/HTTP, webcams (si se habilitan) o videos de prueba en bucle
+# desde una carpeta permitida, registrados por nombre.
+# Cada fuente tiene su hilo de captura que solo guarda el último frame; un
+# único hilo de inferencia junta el último frame de cada fuente activa en una
+# sola llamada al modelo y publica el resultado en el stream de cada fuente.
+
+REALTIME_SOURCES_FILE = 'realtime_sources.json'
+REALTIME_MAX_BATCH = int(os.environ.get('REALTIME_MAX_BATCH', 8))
+REALTIME_SOURCE_MAX_DIMENSION = 1280
+REALTIME_SOURCE_NAME_RE = re.compile(r'^[A-Za-z0-9_-]{1,40}$')
+REALTIME_SOURCE_SCHEMES = {'rtsp', 'rtsps', 'http', 'https'}
+# Hosts permitidos para streams (separados por comas). Vacío = solo el propio
+# servidor (localhost); '*' acepta cualquier host
+REALTIME_SOURCE_LOCAL_HOSTS = {'localhost', '127.0.0.1', '::1'}
+REALTIME_SOURCE_HOSTS = {h.strip().lower() for h in os.environ.get('REALTIME_SOURCE_HOSTS', '').split(',') if h.strip()}
+# Única carpeta desde la que se aceptan videos locales en bucle (pruebas)
+REALTIME_SOURCES_DIR = os.path.abspath(os.environ.get('REALTIME_SOURCES_DIR', 'sample_videos'))
+# Webcams locales por índice: solo si se habilita explícitamente
+REALTIME_ALLOW_DEVICES = os.environ.get('REALTIME_ALLOW_DEVICES', 'false').lower() in ('1', 'true', 'on')
+
+realtime_sources = {}  # {nombre: RealtimeSource}
+realtime_sources_cond = threading.Condition()  # avisa al hilo de inferencia de frames nuevos
+_realtime_inference = {'thread': None, 'batches': 0, 'frames': 0, 'total_ms': 0.0}
+
+
+class RealtimeSource:
+    """Fuente de video con su propio hilo de captura y stream MJPEG"""
+
+    def __init__(self, name, url, loop_video=None):
+        self.name = name
+        self.url = str(url)
+        self.capture_target = int(self.url) if self.url.isdigit() else self.url
+        self.is_file = isinstance(self.capture_target, str) and os.path.isfile(self.capture_target)
+        self.loop_video = self.is_file if loop_video is None else bool(loop_video)
+        self.broadcaster = FrameBroadcaster(f'source-{name}', None)
+        self.active = False
+        self.frame = None
+        self.seq = 0
+        self.captured_at = 0.0
+        self.inferred_seq = 0
+        self.width = 0
+        self.height = 0
+        self.frames_read = 0
+        self.inferences = 0
+        self.last_inference_at = 0.0
+        self.error = None
+        self.started_at = None
+
+    def start(self):
+        self.active = True
+        self.started_at = time.time()
+        self.broadcaster.set_running(True)
+        threading.Thread(target=self._capture_loop, daemon=True, name=f'capture-{self.name}').start()
+
+    def stop(self):
+        self.active = False
+        self.broadcaster.set_running(False)
+
+    def _capture_loop(self):
+        backoff = 1
+        while self.active:
+            cap = cv2.VideoCapture(self.capture_target)
+            if not cap.isOpened():
+                cap.release()
+                self.error = 'No se pudo abrir la fuente'
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)  # reconectar con espera creciente
+                continue
+            self.error = None
+            backoff = 1
+            # Los archivos se reproducen a su velocidad real; las cámaras marcan su ritmo
+            fps = cap.get(cv2.CAP_PROP_FPS) if self.is_file else 0
+            interval = 1.0 / fps if fps and fps > 0 else 0
+            next_time = time.perf_counter()
+            rewound = False
+            try:
+                while self.active:
+                    ret, frame = cap.read()
+                    if not ret:
+                        if self.loop_video and not rewound:
+                            cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                            rewound = True
+                            continue
+                        self.error = 'Fin de la fuente' if self.is_file else 'Se perdió la conexión'
+                        break
+                    rewound = False
+                    height, width = frame.shape[:2]
+                    size = get_output_size(width, height, REALTIME_SOURCE_MAX_DIMENSION)
+                    if size != (width, height):
+                        frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+                    with realtime_sources_cond:
+                        self.frame = frame
+                        self.captured_at = time.time()
+                        self.width, self.height = size
+                        self.seq += 1
+                        self.frames_read += 1
+                        realtime_sources_cond.notify()
+                    # Relanza el hilo de inferencia si terminó por un error
+                    ensure_inference_loop()
+                    if interval:
+                        next_time += interval
+                        delay = next_time - time.perf_counter()
+                        if delay > 0:
+                            time.sleep(delay)
+                        else:
+                            next_time = time.perf_counter()
+            finally:
+                cap.release()
+            if self.is_file and not self.loop_video:
+                self.stop()  # el video terminó: cerrar también los streams
+                break
+            time.sleep(backoff)
+
+    def to_dict(self):
+        uptime = time.time() - self.started_at if self.started_at else 0
+        return {
+            'name': self.name,
+            'url': self.url,
+            'loop': self.loop_video,
+            'active': self.active,
+            'width': self.width,
+            'height': self.height,
+            'capture_fps': round(self.frames_read / uptime, 1) if uptime else 0,
+            'inference_fps': round(self.inferences / uptime, 1) if uptime else 0,
+            'viewers': self.broadcaster.viewers,
+            'error': self.error,
+            'feed_url': f'/video_feed/{self.name}',
+            'detections_url': f'/get_detections/realtime/{self.name}'
+        }
+
+
+def batched_inference_loop():
+    """Hilo central: una llamada al modelo con el último frame de cada fuente"""
+    imgsz = 640 if DEVICE == 'cpu' else 960
+    try:
+        while True:
+            with realtime_sources_cond:
+                realtime_sources_cond.wait_for(
+                    lambda: any(s.active and s.seq != s.inferred_seq for s in realtime_sources.values()),
+                    timeout=1.0
+                )
+                pending = [s for s in realtime_sources.values()
+                           if s.active and s.frame is not None and s.seq != s.inferred_seq]
+                # Las fuentes atendidas hace más tiempo van primero si hay más que el lote
+                pending.sort(key=lambda s: s.last_inference_at)
+                backlog = max(0, len(pending) - REALTIME_MAX_BATCH)
+                pending = pending[:REALTIME_MAX_BATCH]
+                frames = [s.frame for s in pending]
+                captured = [s.captured_at for s in pending]
+                for s in pending:
+                    s.inferred_seq = s.seq
+            if not pending:
+                continue
+            if model is None:
+                time.sleep(1.0)
+                continue
+
+            variant = model_pool.begin('realtime')
+            started = time.perf_counter()
+            try:
+                results = variant.model(
+                    frames,
+                    imgsz=variant.imgsz(imgsz),
+                    conf=0.45,
+                    device=DEVICE,
+                    half=(DEVICE == 'cuda:0'),
+                    verbose=False
+                )
+            except Exception as e:
+                print(f"Error en inferencia por lotes: {e}")
+                model_pool.end('realtime', (time.perf_counter() - started) * 1000, backlog)
+                time.sleep(0.5)
+                continue
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            model_pool.end('realtime', elapsed_ms, backlog)
+            _realtime_inference['batches'] += 1
+            _realtime_inference['frames'] += len(frames)
+            _realtime_inference['total_ms'] += elapsed_ms
+
+            now = time.time()
+            for source, frame, captured_at, result in zip(pending, frames, captured, results):
+                try:
+                    publish_realtime_result(source, frame, captured_at, result, variant.name, now)
+                except Exception as e:
+                    # Un frame defectuoso no debe tumbar el hilo compartido por todas las fuentes
+                    source.error = f'Error al procesar el frame: {e}'
+                    print(f"Error al publicar resultado de {source.name}: {e}")
+    except Exception as e:
+        print(f"Hilo de inferencia detenido por un error: {e}")
+    finally:
+        # Permite que ensure_inference_loop lo vuelva a lanzar
+        with realtime_sources_cond:
+            _realtime_inference['thread'] = None
+
+
+def publish_realtime_result(source, frame, captured_at, result, variant_name, now):
+    """Anota el frame de una fuente, lo publica en su stream y cachea sus detecciones"""
+    detections = extract_detections(result)
+    height, width = frame.shape[:2]
+    # El frame capturado no se reutiliza: se puede anotar in situ
+    annotated = draw_detections(frame, detections)
+    ret, buffer = cv2.imencode('.jpg', annotated, [int(cv2.IMWRITE_JPEG_QUALITY), 70])
+    if ret:
+        source.broadcaster.publish(buffer.tobytes(), captured_at=captured_at, data={
+            'detections': detections,
+            'width': width,
+            'height': height
+        })
+    with detections_lock:
+        detections_cache[f'realtime:{source.name}'] = {
+            'detections': detections,
+            'timestamp': now,
+            'width': width,
+            'height': height,
+            'model_variant': variant_name
+        }
+    source.inferences += 1
+    source.last_inference_at = now
+
+
+def ensure_inference_loop():
+    with realtime_sources_cond:
+        if _realtime_inference['thread'] is None:
+            thread = threading.Thread(target=batched_inference_loop, daemon=True, name='batched-inference')
+            _realtime_inference['thread'] = thread
+            thread.start()
+
+
+def save_realtime_sources():
+    """Persiste el registro de fuentes para restaurarlo al reiniciar"""
+    data = [{'name': s.name, 'url': s.url, 'loop': s.loop_video} for s in realtime_sources.values()]
+    try:
+        tmp_path = REALTIME_SOURCES_FILE + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, REALTIME_SOURCES_FILE)
+    except Exception as e:
+        print(f"Error al guardar fuentes: {e}")
+
+
+def validate_source_url(url):
+    """Normaliza la URL de una fuente o lanza ValueError si no está permitida.
+
+    Se aceptan streams rtsp/http(s), videos dentro de REALTIME_SOURCES_DIR y,
+    con REALTIME_ALLOW_DEVICES, índices de webcam. Nada más: la ruta se abre
+    en el servidor y se persiste en realtime_sources.json.
+    """
+    url = str(url).strip()
+    if url.isdigit():
+        if not REALTIME_ALLOW_DEVICES:
+            raise ValueError('Las cámaras locales por índice no están habilitadas')
+        return url
+    parsed = urlparse(url)
+    if parsed.scheme:
+        if parsed.scheme.lower() not in REALTIME_SOURCE_SCHEMES or not parsed.netloc:
+            raise ValueError(f'Esquema no permitido. Use: {", ".join(sorted(REALTIME_SOURCE_SCHEMES))}')
+        allowed_hosts = REALTIME_SOURCE_HOSTS or REALTIME_SOURCE_LOCAL_HOSTS
+        if '*' not in allowed_hosts and (parsed.hostname or '').lower() not in allowed_hosts:
+            raise ValueError('Host de la fuente no permitido (configure REALTIME_SOURCE_HOSTS)')
+        return url
+    path = os.path.realpath(os.path.join(REALTIME_SOURCES_DIR, url))
+    if os.path.commonpath([path, REALTIME_SOURCES_DIR]) != REALTIME_SOURCES_DIR:
+        raise ValueError('Los videos locales deben estar dentro de la carpeta de fuentes permitida')
+    if os.path.splitext(path)[1].lower() not in VIDEO_EXTENSIONS or not os.path.isfile(path):
+        raise ValueError('Video local no encontrado')
+    return path
+
+
+def register_realtime_source(name, url, loop_video=None, persist=True):
+    source = RealtimeSource(name, url, loop_video)
+    with realtime_sources_cond:
+        if name in realtime_sources:
+            return None
+        realtime_sources[name] = source
+    source.start()
+    ensure_inference_loop()
+    if persist:
+        save_realtime_sources()
+    print(f"Fuente registrada: {name} ({url})")
+    return source
+
+
+def restore_realtime_sources():
+    if not os.path.exists(REALTIME_SOURCES_FILE):
+        return
+    try:
+        with open(REALTIME_SOURCES_FILE, 'r', encoding='utf-8') as f:
+            for item in json.load(f):
+                try:
+                    url = validate_source_url(item['url'])
+                except ValueError as e:
+                    print(f"Fuente {item.get('name')} descartada: {e}")
+                    continue
+                register_realtime_source(item['name'], url, item.get('loop'), persist=False)
+    except Exception as e:
+        print(f"Error al restaurar fuentes: {e}")
+
+
+@app.route('/sources', methods=['GET'])
+def list_sources():
+    """Fuentes registradas y estadísticas de la inferencia por lotes"""
+    batches = _realtime_inference['batches']
+    frames = _realtime_inference['frames']
+    total_ms = _realtime_inference['total_ms']
+    return jsonify({
+        'sources': [s.to_dict() for s in list(realtime_sources.values())],
+        'inference': {
+            'batches': batches,
+            'avg_batch_size': round(frames / batches, 2) if batches else 0,
+            'avg_batch_ms': round(total_ms / batches, 1) if batches else 0,
+            'ms_per_frame': round(total_ms / frames, 1) if frames else 0,
+            'max_batch': REALTIME_MAX_BATCH
+        }
+    })
+
+
+@app.route('/sources', methods=['POST'])
+def add_source():
+    """Registrar una fuente: {"name": ..., "url": rtsp/http(s) o video de REALTIME_SOURCES_DIR, "loop": bool}"""
+    data = request.json or {}
+    name = str(data.get('name') or '').strip()
+    url = str(data.get('url') or '').strip()
+    if not REALTIME_SOURCE_NAME_RE.match(name):
+        return jsonify({'error': 'Nombre inválido (letras, números, - y _; máximo 40)'}), 400
+    if not url:
+        return jsonify({'error': 'URL de la fuente no proporcionada'}), 400
+    try:
+        url = validate_source_url(url)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    source = register_realtime_source(name, url, data.get('loop'))
+    if source is None:
+        return jsonify({'error': f'Ya existe una fuente llamada {name}'}), 409
+    return jsonify(source.to_dict()), 201
+
+
+@app.route('/sources/<name>', methods=['DELETE'])
+def delete_source(name):
+    """Detener y eliminar una fuente"""
+    with realtime_sources_cond:
+        source = realtime_sources.pop(name, None)
+    if source is None:
+        return jsonify({'error': 'Fuente no encontrada'}), 404
+    source.stop()
+    save_realtime_sources()
+    with detections_lock:
+        detections_cache.pop(f'realtime:{name}')
+    return jsonify({'success': True, 'message': f'Fuente {name} eliminada'})
+
+
+@app.route('/video_feed/<name>')
+def source_video_feed(name):
+    """Stream MJPEG anotado de una fuente (mismo formato que /video_feed)"""
+    source = realtime_sources.get(name)
+    if source is None:
+        return jsonify({'error': 'Fuente no encontrada'}), 404
+    return Response(generate_mjpeg(source.broadcaster, lambda: source.active),
+                    mimetype='multipart/x-mixed-replace; boundary=frame')
+
+
+@app.route('/get_detections/realtime/<name>')
+def get_source_detections(name):
+    """Detecciones actuales de una fuente (mismo formato que /get_detections/realtime)"""
+    with detections_lock:
+        cache_data = detections_cache.get(f'realtime:{name}')
+    if cache_data and time.time() - cache_data['timestamp'] < 5:
+        return detections_jsonify({
+            'detections': cache_data['detections'],
+            'width': cache_data['width'],
+            'height': cache_data['height'],
+            'model_variant': cache_data.get('model_variant')
+        })
+    return detections_jsonify({'detections': [], 'width': 0, 'height': 0})
+
+# ==================== ADMISIÓN DE TRABAJOS DE VIDEO ====================
+# Cada subida se admite según los frames que faltan procesar en los trabajos en
+# curso y la velocidad medida del dispositivo (frames/s). La respuesta incluye
+# un ETA; si el atraso supera el límite configurado se responde 429 con
+# Retry-After. Una parte de la capacidad queda reservada para /upload_image:
+# mientras las imágenes estén degradadas por carga reciente, los videos nuevos
+# reciben 503.
+
+ADMISSION_MAX_BACKLOG_SECONDS = float(os.environ.get('ADMISSION_MAX_BACKLOG_SECONDS', 1800))
+ADMISSION_IMAGE_RESERVE = float(os.environ.get('ADMISSION_IMAGE_RESERVE', 0.2))
+# Velocidad supuesta hasta tener mediciones reales
+ADMISSION_DEFAULT_FPS = {'cpu': 8.0, 'mps': 20.0}.get(DEVICE, 60.0)
+ADMISSION_MIN_RETRY_AFTER = 5
+ADMISSION_RESERVED_RETRY_AFTER = 30
+ADMISSION_IMAGE_PRESSURE_WINDOW = 30  # segundos desde la última imagen que cuentan como carga
+
+
+class VideoAdmission:
+    """Control de admisión de videos con velocidad medida y ETA"""
+
+    def __init__(self):
+        self.throughput_fps = None  # EWMA de frames/s de todos los trabajos juntos
+        self.counters = {'admitted': 0, 'rejected_backlog': 0, 'rejected_reserved': 0}
+        self.decisions = deque(maxlen=50)
+        self._lock = threading.Lock()
+
+    def observe_throughput(self, fps):
+        """Velocidad agregada medida por el muestreador de métricas"""
+        if fps <= 0:
+            return
+        with self._lock:
+            if self.throughput_fps is None:
+                self.throughput_fps = fps
+            else:
+                self.throughput_fps = 0.2 * fps + 0.8 * self.throughput_fps
+
+    def capacity_fps(self):
+        """Frames/s disponibles para videos (descontando la reserva de imágenes)"""
+        rate = self.throughput_fps or ADMISSION_DEFAULT_FPS
+        return max(0.1, rate * (1 - ADMISSION_IMAGE_RESERVE))
+
+    def backlog(self):
+        """(frames pendientes, trabajos en curso)"""
+        with status_lock:
+            running = video_processing_status.snapshot(lambda k, v: v.get('status') == 'processing')
+        frames = sum(max(0, v.get('total_frames', 0) - v.get('processed_frames', 0)) for _, v in running)
+        return frames, len(running)
+
+    def job_eta(self, status_info):
+        """Segundos estimados para terminar un trabajo en curso"""
+        _, jobs = self.backlog()
+        remaining = max(0, status_info.get('total_frames', 0) - status_info.get('processed_frames', 0))
+        # Los trabajos simultáneos se reparten la capacidad
+        return round(remaining * max(1, jobs) / self.capacity_fps(), 1)
+
+    def evaluate(self, new_frames=0):
+        """Decide si se admite un video de new_frames frames"""
+        backlog_frames, jobs = self.backlog()
+        capacity = self.capacity_fps()
+        pending = backlog_frames + new_frames
+        decision = {
+            'status': 200,
+            'backlog_frames': backlog_frames,
+            'running_jobs': jobs,
+            'capacity_fps': round(capacity, 2),
+            'eta_seconds': round(pending / capacity, 1),
+            'retry_after': None
+        }
+        limit_frames = ADMISSION_MAX_BACKLOG_SECONDS * capacity
+        # Sin trabajos en curso siempre se admite (aunque el video solo supere el límite)
+        if jobs and model_pool.under_pressure('image', ADMISSION_IMAGE_PRESSURE_WINDOW):
+            decision['status'] = 503
+            decision['retry_after'] = ADMISSION_RESERVED_RETRY_AFTER
+        elif jobs and pending > limit_frames:
+            decision['status'] = 429
+            decision['retry_after'] = max(ADMISSION_MIN_RETRY_AFTER,
+                                          int(math.ceil((pending - limit_frames) / capacity)))
+        return decision
+
+    def record(self, decision, filename=None):
+        key = {200: 'admitted', 429: 'rejected_backlog', 503: 'rejected_reserved'}[decision['status']]
+        with self._lock:
+            self.counters[key] += 1
+            self.decisions.append(dict(decision, timestamp=time.time(), filename=filename))
+        if decision['status'] != 200:
+            print(f"Video rechazado ({decision['status']}): {decision['backlog_frames']} frames pendientes, "
+                  f"reintentar en {decision['retry_after']} s")
+
+    def stats(self):
+        backlog_frames, jobs = self.backlog()
+        with self._lock:
+            return {
+                'device': DEVICE,
+                'measured_fps': round(self.throughput_fps, 2) if self.throughput_fps else None,
+                'capacity_fps': round(self.capacity_fps(), 2),
+                'image_reserve': ADMISSION_IMAGE_RESERVE,
+                'max_backlog_seconds': ADMISSION_MAX_BACKLOG_SECONDS,
+                'backlog_frames': backlog_frames,
+                'running_jobs': jobs,
+                'counters': dict(self.counters),
+                'recent_decisions': list(self.decisions)
+            }
+
+
+video_admission = VideoAdmission()
+
+
+def admission_rejection(decision, **extra):
+    """Respuesta 429/503 con Retry-After para una subida no admitida"""
+    if decision['status'] == 503:
+        message = 'El servidor está priorizando el análisis de imágenes; intenta más tarde'
+    else:
+        message = 'Hay demasiados videos en cola; intenta más tarde'
+    response = jsonify(dict(
+        extra,
+        error=message,
+        retry_after=decision['retry_after'],
+        eta_seconds=decision['eta_seconds'],
+        backlog_frames=decision['backlog_frames']
+    ))
+    response.status_code = decision['status']
+    response.headers['Retry-After'] = str(decision['retry_after'])
+    return response
+
+
 # ==================== DETECCIÓN EN VIDEO ====================
 
+VIDEO_EXTENSIONS = {'.mp4', '.avi', '.mov', '.mkv', '.webm'}
+
+
+def new_video_stem():
+    """(timestamp, nombre base único) para un video subido.
+
+    Dos subidas en el mismo segundo no deben compartir original ni salida.
+    """
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    return timestamp, f"{timestamp}_{uuid.uuid4().hex[:8]}"
+
+
 @app.route('/upload_video', methods=['POST'])
 def upload_video():
     """Subir y procesar video"""
@@ -395,14 +2229,19 @@ def upload_video():
         return jsonify({'error': 'Archivo vacío'}), 400
     
     # Validar extensión
-    allowed_extensions = {'.mp4', '.avi', '.mov', '.mkv', '.webm'}
     file_ext = os.path.splitext(file.filename)[1].lower()
-    if file_ext not in allowed_extensions:
-        return jsonify({'error': f'Formato no soportado. Use: {", ".join(allowed_extensions)}'}), 400
+    if file_ext not in VIDEO_EXTENSIONS:
+        return jsonify({'error': f'Formato no soportado. Use: {", ".join(VIDEO_EXTENSIONS)}'}), 400
+    
+    # Rechazar antes de escribir a disco si la cola ya está llena
+    decision = video_admission.evaluate()
+    if decision['status'] != 200:
+        video_admission.record(decision, file.filename)
+        return admission_rejection(decision)
     
     # Guardar video original
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    filename = f"video_{timestamp}{file_ext}"
+    timestamp, stem = new_video_stem()
+    filename = f"video_{stem}{file_ext}"
     video_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
     
     try:
@@ -411,22 +2250,47 @@ def upload_video():
         return jsonify({'error': f'Error al guardar video: {str(e)}'}), 500
     
     # Verificar que el video se puede leer
-    test_cap = cv2.VideoCapture(video_path)
-    if not test_cap.isOpened():
-        test_cap.release()
+    probe = probe_video(video_path)
+    if probe is None:
         os.remove(video_path)
         return jsonify({'error': 'El archivo de video no es válido o está corrupto'}), 400
     
-    fps = test_cap.get(cv2.CAP_PROP_FPS)
-    frame_count = int(test_cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    test_cap.release()
+    fps = probe['fps']
+    frame_count = probe['frame_count']
     
     if fps <= 0 or frame_count <= 0:
         os.remove(video_path)
         return jsonify({'error': 'El video no tiene frames válidos'}), 400
     
+    # Admisión con los frames reales del video
+    decision = video_admission.evaluate(frame_count)
+    video_admission.record(decision, file.filename)
+    if decision['status'] != 200:
+        os.remove(video_path)
+        return admission_rejection(decision)
+    
+    # Procesamiento paralelo opcional (solo compensa en videos largos)
+    parallel = request.form.get('parallel', '').lower() in ('1', 'true', 'on')
+    
+    # Solo detecciones: no dibujar ni re-codificar, se sirve el original con overlay en el cliente
+    annotate = request.form.get('annotate', 'true').lower() not in ('0', 'false', 'off')
+    
+    job = start_uploaded_video(file.filename, video_path, timestamp, frame_count, parallel, annotate,
+                               workers=request.form.get('workers', type=int), stem=stem)
+    job['eta_seconds'] = decision['eta_seconds']
+    return jsonify(job)
+
+
+def start_uploaded_video(original_filename, video_path, timestamp, frame_count, parallel, annotate, workers=None,
+                         stem=None):
+    """Registra el trabajo de un video subido (estado e historial) y lo lanza"""
+    workers_count = 0
+    if parallel:
+        workers_count = workers or MAX_PARALLEL_WORKERS
+        workers_count = max(1, min(workers_count, MAX_PARALLEL_WORKERS, frame_count // PARALLEL_MIN_FRAMES_PER_PART))
+    
     # Procesar video en segundo plano
-    output_filename = f"detected_{timestamp}.mp4"
+    output_filename = f"detected_{stem or timestamp}.mp4"
     output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
     
     # Inicializar estado de procesamiento y cache de frames
@@ -438,36 +2302,426 @@ def upload_video():
             'processed_frames': 0
         }
     
-    with frames_cache_lock:
-        video_frames_cache[output_filename] = []
-    
     # Guardar en historial
     entry = {
-        'original_filename': file.filename,
+        'original_filename': original_filename,
         'output_filename': output_filename,
         'created_at': timestamp,
         'status': 'processing',
         'progress': 0,
+        'annotated': annotate,
+        'input_path': video_path,
         'url': f'/detected/{output_filename}'
     }
     upsert_history(entry)
 
     # Iniciar procesamiento en hilo separado
-    thread = threading.Thread(target=process_video, args=(video_path, output_path, output_filename))
-    thread.daemon = True
-    thread.start()
+    start_video_job(video_path, output_path, output_filename, workers=workers_count, annotate=annotate)
     
-    return jsonify({
+    return {
         'status': 'processing',
         'message': 'Video en procesamiento',
         'output_filename': output_filename,
         'total_frames': frame_count,
-        'stream_url': f'/video_stream/{output_filename}'
-    })
+        'workers': workers_count,
+        'annotated': annotate,
+        # Igual que /check_video: la playlist solo existe en trabajos secuenciales
+        # con anotación y una vez cerrado el primer segmento
+        **get_live_urls(output_filename)
+    }
+
+
+# ==================== SUBIDAS POR PARTES ====================
+# Protocolo de subida reanudable para videos grandes:
+#   POST /uploads                 -> crea la sesión (nombre, tamaño, opciones)
+#   PUT  /uploads/<id>?offset=N   -> agrega un trozo (X-Chunk-SHA256 opcional)
+#   GET  /uploads/<id>            -> offset recibido, para continuar tras un corte
+# La cabecera del contenedor se analiza en cuanto llegan suficientes bytes; en
+# MP4/MOV con el índice al inicio el procesamiento arranca sobre lo recibido y
+# espera al resto de los datos a medida que llegan.
+
+CHUNKED_UPLOAD_MAX_BYTES = int(os.environ.get('CHUNKED_UPLOAD_MAX_MB', 2048)) * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024  # tamaño sugerido al cliente
+UPLOAD_CHUNK_MAX = 16 * 1024 * 1024
+UPLOAD_PROBE_MIN_BYTES = 512 * 1024  # primer intento de análisis de cabecera
+UPLOAD_EARLY_START = os.environ.get('UPLOAD_EARLY_START', '1') != '0'
+UPLOAD_STREAMABLE_EXTENSIONS = {'.mp4', '.mov'}
+UPLOAD_STALL_TIMEOUT = 3600  # segundos sin datos antes de abandonar un trabajo iniciado
+UPLOAD_SESSION_TTL = 24 * 3600
+
+# {upload_id: UploadSession}
+upload_sessions = {}
+upload_sessions_cond = threading.Condition()
+
+
+class UploadSession:
+    """Estado de una subida por partes (persistido como JSON)"""
+
+    FIELDS = ('id', 'original_filename', 'path', 'timestamp', 'stem', 'size', 'received', 'parallel',
+              'annotate', 'status', 'probe', 'next_probe_at', 'output_filename',
+              'created_at', 'updated_at')
+
+    def __init__(self, **fields):
+        for name in self.FIELDS:
+            setattr(self, name, fields.get(name))
+        self.lock = threading.Lock()  # serializa los trozos de una misma sesión
+
+    @property
+    def meta_path(self):
+        return os.path.join(app.config['UPLOAD_SESSIONS_FOLDER'], f"{self.id}.json")
+
+    def save(self):
+        self.updated_at = time.time()
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({name: getattr(self, name) for name in self.FIELDS}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.meta_path)
+
+    def remove(self, keep_data=False):
+        with upload_sessions_cond:
+            upload_sessions.pop(self.id, None)
+            upload_sessions_cond.notify_all()
+        for path in ([] if keep_data else [self.path]) + [self.meta_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def to_dict(self):
+        return {
+            'upload_id': self.id,
+            'offset': self.received,
+            'size': self.size,
+            'status': self.status,
+            'probe': self.probe,
+            'output_filename': self.output_filename,
+            'chunk_size': UPLOAD_CHUNK_SIZE,
+            'upload_url': f'/uploads/{self.id}'
+        }
+
+
+def restore_upload_sessions():
+    """Recupera las sesiones de subida sin terminar tras un reinicio"""
+    folder = app.config['UPLOAD_SESSIONS_FOLDER']
+    for name in os.listdir(folder):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(folder, name), 'r', encoding='utf-8') as f:
+                session = UploadSession(**json.load(f))
+        except Exception as e:
+            print(f"Sesión de subida ilegible {name}: {e}")
+            continue
+        if session.status != 'receiving':
+            continue
+        # El archivo manda: si se perdió algún trozo sin confirmar, se vuelve a pedir
+        if not os.path.exists(session.path):
+            open(session.path, 'wb').close()
+        session.received = min(session.received, file_size(session.path))
+        with upload_sessions_cond:
+            upload_sessions[session.id] = session
+    if upload_sessions:
+        print(f"Sesiones de subida pendientes: {len(upload_sessions)}")
+
+
+def sweep_upload_sessions(now):
+    """Elimina sesiones abandonadas (y su archivo si no llegó a procesarse)"""
+    removed = 0
+    folder = app.config['UPLOAD_SESSIONS_FOLDER']
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if not name.endswith('.json') or now - os.path.getmtime(path) < UPLOAD_SESSION_TTL:
+            continue
+        upload_id = name[:-5]
+        with upload_sessions_cond:
+            session = upload_sessions.get(upload_id)
+        if session is None:
+            os.remove(path)
+        else:
+            session.remove(keep_data=bool(session.output_filename))
+        removed += 1
+    return removed
+
+
+def is_upload_receiving(input_path):
+    with upload_sessions_cond:
+        return any(s.path == input_path and s.status == 'receiving' for s in upload_sessions.values())
+
+
+def reopen_growing_input(decoder, input_path, frame_index):
+    """Espera más datos de un original que todavía se está subiendo.
+
+    Devuelve un decodificador nuevo posicionado en frame_index y si la subida
+    sigue en curso (si ya terminó, un nuevo fallo de lectura es el fin del video).
+    """
+    deadline = time.time() + UPLOAD_STALL_TIMEOUT
+    received = file_size(input_path)
+    with upload_sessions_cond:
+        while True:
+            receiving = any(s.path == input_path and s.status == 'receiving' for s in upload_sessions.values())
+            if not receiving or file_size(input_path) > received:
+                break
+            if time.time() > deadline:
+                raise ValueError('La subida del video se interrumpió')
+            upload_sessions_cond.wait(timeout=5.0)
+    decoder.release()
+    decoder = open_video_decoder(input_path, decoder.max_dimension)
+    if frame_index > 0:
+        decoder.seek(frame_index)
+    return decoder, receiving
+
+
+def probe_video(path):
+    """fps, frames y dimensiones según la cabecera (None si aún no se puede leer)"""
+    try:
+        decoder = open_video_decoder(path)
+    except Exception:
+        return None
+    try:
+        if not decoder.is_opened():
+            return None
+        if decoder.fps <= 0 or decoder.frame_count <= 0:
+            return None
+        return {
+            'fps': decoder.fps,
+            'frame_count': decoder.frame_count,
+            'width': decoder.width,
+            'height': decoder.height
+        }
+    finally:
+        decoder.release()
+
+
+def get_upload_session(upload_id):
+    with upload_sessions_cond:
+        return upload_sessions.get(upload_id)
+
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    """Crear una sesión de subida por partes"""
+    if model is None:
+        return jsonify({'error': 'Modelo YOLO no está cargado'}), 500
+    data = request.get_json(silent=True) or {}
+    original_filename = os.path.basename(str(data.get('filename', '')))
+    size = data.get('size')
+    file_ext = os.path.splitext(original_filename)[1].lower()
+    if not original_filename:
+        return jsonify({'error': 'Archivo vacío'}), 400
+    if file_ext not in VIDEO_EXTENSIONS:
+        return jsonify({'error': f'Formato no soportado. Use: {", ".join(VIDEO_EXTENSIONS)}'}), 400
+    if not isinstance(size, int) or size <= 0:
+        return jsonify({'error': 'Tamaño de archivo inválido'}), 400
+    if size > CHUNKED_UPLOAD_MAX_BYTES:
+        return jsonify({'error': f'El video supera el máximo de {CHUNKED_UPLOAD_MAX_BYTES // 1024**2} MB'}), 413
+
+    decision = video_admission.evaluate()
+    if decision['status'] != 200:
+        video_admission.record(decision, original_filename)
+        return admission_rejection(decision)
+
+    timestamp, stem = new_video_stem()
+    session = UploadSession(
+        id=uuid.uuid4().hex,
+        original_filename=original_filename,
+        path=os.path.join(app.config['UPLOAD_FOLDER'], f"video_{stem}{file_ext}"),
+        timestamp=timestamp,
+        stem=stem,
+        size=size,
+        received=0,
+        parallel=bool(data.get('parallel')),
+        annotate=data.get('annotate', True) not in (False, 0, '0', 'false', 'off'),
+        status='receiving',
+        probe=None,
+        next_probe_at=UPLOAD_PROBE_MIN_BYTES,
+        output_filename=None,
+        created_at=time.time()
+    )
+    open(session.path, 'xb').close()  # nunca truncar el original de otra subida
+    session.save()
+    with upload_sessions_cond:
+        upload_sessions[session.id] = session
+    return jsonify(session.to_dict()), 201
+
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    """Estado de una subida (offset desde el que continuar)"""
+    session = get_upload_session(upload_id)
+    if session is None:
+        return jsonify({'error': 'Sesión de subida no encontrada'}), 404
+    return jsonify(session.to_dict())
+
+
+@app.route('/uploads/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    """Agregar un trozo en el offset indicado"""
+    session = get_upload_session(upload_id)
+    if session is None:
+        return jsonify({'error': 'Sesión de subida no encontrada'}), 404
+    offset = request.args.get('offset', type=int)
+    chunk = request.get_data(cache=False)
+
+    with session.lock:
+        if session.status != 'receiving':
+            return jsonify(dict(session.to_dict(), error='La subida ya terminó')), 409
+        if offset != session.received:
+            # El cliente debe continuar desde lo que realmente se guardó
+            return jsonify(dict(session.to_dict(), error='Offset incorrecto')), 409
+        # Un trozo vacío al final solo reintenta la admisión de un video ya recibido
+        if (not chunk and offset != session.size) or len(chunk) > UPLOAD_CHUNK_MAX \
+                or offset + len(chunk) > session.size:
+            return jsonify({'error': 'Tamaño de trozo inválido'}), 400
+        checksum = request.headers.get('X-Chunk-SHA256')
+        if checksum and hashlib.sha256(chunk).hexdigest() != checksum.lower():
+            return jsonify({'error': 'El checksum del trozo no coincide'}), 400
+
+        if chunk:
+            with open(session.path, 'r+b') as f:
+                f.seek(offset)
+                f.write(chunk)
+                f.truncate()
+                f.flush()
+                os.fsync(f.fileno())
+            session.received = offset + len(chunk)
+            session.save()
+            with upload_sessions_cond:
+                upload_sessions_cond.notify_all()  # despierta a un trabajo que espera datos
+        complete = session.received == session.size
+
+        # Analizar la cabecera en cuanto sea legible (intentos en 512 KB, 1 MB, 2 MB...)
+        if session.probe is None and (complete or session.received >= session.next_probe_at):
+            session.next_probe_at = session.received * 2
+            session.probe = probe_video(session.path)
+            if session.probe is None and complete:
+                session.remove()
+                return jsonify({'error': 'El archivo de video no es válido o está corrupto'}), 400
+            if session.probe is not None:
+                session.probe['admitted'] = False
+            session.save()
+
+        # Admisión con los frames reales. Si se rechaza, lo recibido se conserva:
+        # el cliente espera Retry-After y sigue desde el offset devuelto
+        if session.probe is not None and not session.probe.get('admitted', True):
+            decision = video_admission.evaluate(session.probe['frame_count'])
+            video_admission.record(decision, session.original_filename)
+            if decision['status'] != 200:
+                return admission_rejection(decision, **session.to_dict())
+            session.probe['admitted'] = True
+            session.probe['eta_seconds'] = decision['eta_seconds']
+            session.save()
+
+        if complete:
+            session.status = 'complete'
+            session.save()
+
+        # Arrancar el procesamiento: al terminar o, si el formato lo permite, ya mismo
+        job = None
+        early = (UPLOAD_EARLY_START and not session.parallel
+                 and os.path.splitext(session.path)[1].lower() in UPLOAD_STREAMABLE_EXTENSIONS)
+        if session.output_filename is None and session.probe is not None and (complete or early):
+            job = start_uploaded_video(session.original_filename, session.path, session.timestamp,
+                                       session.probe['frame_count'], session.parallel, session.annotate,
+                                       stem=session.stem)
+            job['eta_seconds'] = session.probe.get('eta_seconds')
+            session.output_filename = job['output_filename']
+            session.save()
+            print(f"Procesamiento de {session.original_filename} iniciado con "
+                  f"{session.received}/{session.size} bytes recibidos")
+
+        response = dict(session.to_dict(), complete=complete)
+        if job:
+            response['job'] = job
+        if complete:
+            # El archivo queda en uploads; la sesión ya no hace falta
+            session.remove(keep_data=True)
+    return jsonify(response)
 
 
 # ==================== PROCESAMIENTO DE IMÁGENES ====================
 
+IMAGE_STORE_MAX_DIMENSION = 1920
+# Marcadores SOF de JPEG (excepto DHT 0xC4, JPG 0xC8 y DAC 0xCC)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+EXIF_TRANSPOSED = {5, 6, 7, 8}  # orientaciones que intercambian ancho y alto
+# Decodificación reducida en el dominio DCT de libjpeg (1/8, 1/4, 1/2)
+JPEG_REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                      (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def read_exif_orientation(tiff):
+    """Etiqueta Orientation (0x0112) del IFD0 de un bloque EXIF/TIFF"""
+    if len(tiff) < 8:
+        return None
+    order = {b'II': 'little', b'MM': 'big'}.get(bytes(tiff[:2]))
+    if order is None:
+        return None
+    offset = int.from_bytes(tiff[4:8], order)
+    if offset + 2 > len(tiff):
+        return None
+    for i in range(int.from_bytes(tiff[offset:offset + 2], order)):
+        entry = offset + 2 + i * 12
+        if entry + 12 > len(tiff):
+            break
+        if int.from_bytes(tiff[entry:entry + 2], order) == 0x0112:
+            return int.from_bytes(tiff[entry + 8:entry + 10], order)
+    return None
+
+
+def read_jpeg_header(data):
+    """(ancho, alto, orientación EXIF) leyendo solo los marcadores; None si no es JPEG"""
+    if data[:2] != b'\xff\xd8':
+        return None
+    orientation = 1
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:  # relleno entre marcadores
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:  # marcadores sin longitud
+            pos += 2
+            continue
+        if marker == 0xDA:  # inicio de datos comprimidos sin haber visto SOF
+            return None
+        length = int.from_bytes(data[pos + 2:pos + 4], 'big')
+        segment = data[pos + 4:pos + 2 + length]
+        if marker == 0xE1 and segment[:6] == b'Exif\x00\x00':
+            orientation = read_exif_orientation(segment[6:]) or 1
+        elif marker in JPEG_SOF_MARKERS:
+            if len(segment) < 5:
+                return None
+            height = int.from_bytes(segment[1:3], 'big')
+            width = int.from_bytes(segment[3:5], 'big')
+            return width, height, orientation
+        pos += 2 + length
+    return None
+
+
+def decode_image_upload(data, max_dimension):
+    """Decodifica una imagen subida sin pasar por la resolución completa si no hace falta.
+
+    En JPEG las dimensiones se leen de la cabecera y se elige el mayor factor
+    IMREAD_REDUCED_* que aún deja al menos max_dimension en el lado mayor; la
+    rotación EXIF la aplica OpenCV sobre la imagen ya reducida. Devuelve
+    (imagen BGR, keep_original): keep_original indica que los bytes subidos
+    se pueden guardar tal cual (JPEG sin rotar y sin redimensionar).
+    """
+    header = read_jpeg_header(data)
+    flags = cv2.IMREAD_COLOR
+    keep_original = False
+    if header is not None:
+        width, height, orientation = header
+        longest = max(width, height)
+        keep_original = longest <= max_dimension and orientation == 1
+        for factor, reduced_flag in JPEG_REDUCED_FLAGS:
+            if longest // factor >= max_dimension:
+                flags = reduced_flag
+                break
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), flags)
+    return image, keep_original and image is not None
+
+
 @app.route('/upload_image', methods=['POST'])
 def upload_image():
     """Subir y procesar una imagen con YOLO"""
@@ -485,58 +2739,43 @@ def upload_image():
         return jsonify({'error': f'Formato no soportado. Use: {", ".join(allowed_extensions)}'}), 400
     
     try:
-        # Leer imagen
-        import numpy as np
-        file_bytes = np.frombuffer(file.read(), np.uint8)
-        image = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
+        # Leer imagen (JPEG grandes se decodifican ya reducidos)
+        file_bytes = file.read()
+        image, keep_original = decode_image_upload(file_bytes, IMAGE_STORE_MAX_DIMENSION)
         
         if image is None:
             return jsonify({'error': 'No se pudo leer la imagen'}), 400
         
-        height, width = image.shape[:2]
+        src_height, src_width = image.shape[:2]
         
-        # Redimensionar si es muy grande
-        max_dimension = 1920
-        if width > max_dimension or height > max_dimension:
-            scale = max_dimension / max(width, height)
-            width = int(width * scale)
-            height = int(height * scale)
-            image = cv2.resize(image, (width, height))
+        # Tamaño de almacenamiento (máximo 1920 px)
+        width, height = get_output_size(src_width, src_height, max_dimension=IMAGE_STORE_MAX_DIMENSION)
         
-        # Detección YOLO
-        imgsz = 960 if DEVICE != 'cpu' else 640
-        results = model(
-            image,
-            imgsz=imgsz,
-            conf=0.3,
-            device=DEVICE,
-            verbose=False
-        )
+        # Detección YOLO: el modelo recibe la imagen original reducida una sola vez
+        # La variante (pesos y tamaño de entrada) depende de la carga actual
+        variant = model_pool.begin('image')
+        started = time.perf_counter()
+        try:
+            imgsz = variant.imgsz(960 if DEVICE != 'cpu' else 640)
+            preprocessor = LetterboxPreprocessor(src_width, src_height, imgsz, (width, height))
+            results = variant.model(
+                preprocessor.letterbox(image),
+                imgsz=imgsz,
+                conf=0.3,
+                device=DEVICE,
+                verbose=False
+            )
+        finally:
+            model_pool.end('image', (time.perf_counter() - started) * 1000)
         
         # NO usar imagen anotada de YOLO, guardar la original
         # El bounding box se dibujará en el overlay del frontend
         
-        # Extraer detecciones
-        detections = []
-        for result in results:
-            boxes = result.boxes
-            if boxes is not None:
-                for i in range(len(boxes)):
-                    box = boxes.xyxy[i].cpu().numpy()
-                    conf = float(boxes.conf[i].cpu().numpy())
-                    cls_id = int(boxes.cls[i].cpu().numpy())
-                    class_name = model.names[cls_id]
-                    
-                    detections.append({
-                        'class': class_name,
-                        'confidence': round(conf, 2),
-                        'bbox': {
-                            'x1': float(box[0]),
-                            'y1': float(box[1]),
-                            'x2': float(box[2]),
-                            'y2': float(box[3])
-                        }
-                    })
+        # Extraer detecciones (en coordenadas de la imagen guardada)
+        detections = preprocessor.to_output(extract_detections(results[0]))
+        
+        if (width, height) != (src_width, src_height):
+            image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
         
         # Guardar imagen ORIGINAL (sin anotaciones de YOLO)
         timestamp = time.strftime('%Y%m%d_%H%M%S')
@@ -546,13 +2785,19 @@ def upload_image():
         # Asegurarse de que la carpeta existe
         os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
         
-        # Guardar imagen original
-        success = cv2.imwrite(output_path, image)
+        # Guardar imagen original: sin re-codificar si no hubo que reducirla ni rotarla
+        if keep_original:
+            with open(output_path, 'wb') as f:
+                f.write(file_bytes)
+            success = True
+        else:
+            success = cv2.imwrite(output_path, image)
         if not success:
             print(f"Error al guardar imagen: {output_path}")
             return jsonify({'error': 'No se pudo guardar la imagen procesada'}), 500
         
         print(f"Imagen guardada en: {output_path}")
+        generate_entry_thumbnails(output_filename, source_image=image)
         
         # Guardar en cache
         session_id = f'image_{timestamp}'
@@ -575,20 +2820,22 @@ def upload_image():
             'detection_count': len(detections),
             'width': width,
             'height': height,
-            'session_id': session_id
+            'session_id': session_id,
+            'model_variant': variant.name
         }
         upsert_history(image_entry)
         
         print(f"Imagen procesada: {output_filename}, detecciones: {len(detections)}")
         
-        return jsonify({
+        return detections_jsonify({
             'success': True,
             'processed_url': f'/detected/{output_filename}',
             'original_filename': file.filename,
             'detections': detections,
             'width': width,
             'height': height,
-            'session_id': session_id
+            'session_id': session_id,
+            'model_variant': variant.name
         })
         
     except Exception as e:
@@ -597,135 +2844,693 @@ def upload_image():
         traceback.print_exc()
         return jsonify({'error': f'Error al procesar: {str(e)}'}), 500
 
-def process_video(input_path, output_path, output_filename):
-    """Procesa video con YOLO de forma optimizada"""
-    cap = None
-    out = None
-    last_detections = []
-    last_width = 0
-    last_height = 0
-    last_nonempty_detections = []
-    last_nonempty_width = 0
-    last_nonempty_height = 0
-    sample_step = 3  # guardar detecciones cada 3 frames para overlay dinámico
-    
+# ==================== CHECKPOINTS DE TRABAJOS DE VIDEO ====================
+# Cada trabajo guarda en jobs/<id>/ su checkpoint, los segmentos de salida ya
+# cerrados y las detecciones por frame, para reanudarse tras un reinicio.
+
+SEGMENT_SECONDS = 4  # duración de cada segmento de salida (= intervalo de checkpoint)
+FFMPEG_PATH = shutil.which('ffmpeg')
+
+
+def get_job_dir(output_filename):
+    """Carpeta de trabajo de un video en procesamiento"""
+    job_id = os.path.splitext(output_filename)[0]
+    return os.path.join(app.config['JOBS_FOLDER'], job_id)
+
+
+def load_checkpoint(output_filename):
+    """Carga el checkpoint de un trabajo (None si no existe)"""
+    path = os.path.join(get_job_dir(output_filename), 'checkpoint.json')
+    if not os.path.exists(path):
+        return None
     try:
-        cap = cv2.VideoCapture(input_path)
-        
-        if not cap.isOpened():
-            raise ValueError("No se pudo abrir el video de entrada")
-        
-        # Propiedades del video
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        update_history_meta(output_filename, fps=fps, width=width, height=height)
-        
-        # Validar propiedades
-        if fps <= 0:
-            fps = 30.0  # FPS por defecto
-        if width <= 0 or height <= 0:
-            raise ValueError("Dimensiones de video inválidas")
-        
-        # Redimensionar si el video es muy grande (optimización)
-        max_dimension = 1280
-        if width > max_dimension or height > max_dimension:
-            scale = max_dimension / max(width, height)
-            width = int(width * scale)
-            height = int(height * scale)
-            print(f"Redimensionando video a {width}x{height} para optimización")
-        
-        # Codec más compatible (H.264)
-        fourcc = cv2.VideoWriter_fourcc(*'avc1')  # H.264
-        # Si avc1 no funciona, intentar con mp4v
-        out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
-        
-        # Verificar que el writer funciona
-        if not out.isOpened():
-            # Intentar con codec alternativo
-            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-            out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
-            if not out.isOpened():
-                raise ValueError("No se pudo crear el video de salida")
-        
-        print(f"Procesando video: {total_frames} frames a {fps} FPS, tamaño: {width}x{height}")
-        
-        frame_count = 0
-        skip_frames = 0  # Procesar todos los frames para análisis completo
-        
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
-            
-            # Redimensionar frame si es necesario
-            if frame.shape[1] != width or frame.shape[0] != height:
-                frame = cv2.resize(frame, (width, height))
-            
-            # Detección YOLO optimizada según dispositivo
-            try:
-                # Tamaño optimizado para GPU
-                imgsz = 1280 if DEVICE == 'cuda:0' else (960 if DEVICE == 'mps' else 640)
-                results = model(
-                    frame,
-                    imgsz=imgsz,
-                    conf=0.5 if DEVICE != 'cpu' else 0.45,
-                    iou=0.7 if DEVICE != 'cpu' else 0.5,
-                    verbose=False,
-                    device=DEVICE,
-                    half=(DEVICE == 'cuda:0'),  # FP16 solo en CUDA
-                    max_det=300 if DEVICE != 'cpu' else 100,
-                    stream=False
-                )
-                annotated_frame = results[0].plot()
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Checkpoint ilegible para {output_filename}: {e}")
+        return None
+
+
+def save_checkpoint(output_filename, checkpoint):
+    """Guarda el checkpoint de forma atómica (escribir temporal y renombrar)"""
+    job_dir = get_job_dir(output_filename)
+    os.makedirs(job_dir, exist_ok=True)
+    path = os.path.join(job_dir, 'checkpoint.json')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def append_frame_detections(output_filename, frames):
+    """Agrega detecciones por frame al archivo JSONL del trabajo"""
+    if not frames:
+        return
+    path = os.path.join(get_job_dir(output_filename), 'detections.jsonl')
+    with open(path, 'a', encoding='utf-8') as f:
+        for frame_data in frames:
+            f.write(json.dumps(frame_data, ensure_ascii=False) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def load_frame_detections(output_filename, max_frame=None):
+    """Lee las detecciones por frame guardadas (hasta max_frame exclusivo)"""
+    path = os.path.join(get_job_dir(output_filename), 'detections.jsonl')
+    frames = []
+    if not os.path.exists(path):
+        return frames
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                frame_data = json.loads(line)
+            except ValueError:
+                break  # Línea truncada por una caída durante la escritura
+            if max_frame is not None and frame_data['frame'] >= max_frame:
+                break
+            frames.append(frame_data)
+    return frames
+
+
+def truncate_frame_detections(output_filename, max_frame):
+    """Recorta el JSONL a los frames anteriores al checkpoint y los devuelve.
+
+    Las detecciones se vuelcan antes de guardar el checkpoint: una caída entre
+    ambos deja líneas desde next_frame en adelante que la reanudación volvería
+    a escribir, duplicadas y fuera de orden.
+    """
+    frames = load_frame_detections(output_filename, max_frame=max_frame)
+    path = os.path.join(get_job_dir(output_filename), 'detections.jsonl')
+    if os.path.exists(path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for frame_data in frames:
+                f.write(json.dumps(frame_data, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    return frames
+
+
+def remove_job_dir(output_filename):
+    """Elimina la carpeta de trabajo (checkpoint y segmentos)"""
+    shutil.rmtree(get_job_dir(output_filename), ignore_errors=True)
+
+
+def open_video_writer(path, fps, width, height):
+    """Crea un VideoWriter H.264 con mp4v como alternativa"""
+    fourcc = cv2.VideoWriter_fourcc(*'avc1')  # H.264
+    out = cv2.VideoWriter(path, fourcc, fps, (width, height))
+    if not out.isOpened():
+        # Intentar con codec alternativo
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        out = cv2.VideoWriter(path, fourcc, fps, (width, height))
+        if not out.isOpened():
+            raise ValueError("No se pudo crear el video de salida")
+    return out
+
+
+class FFmpegSegmentWriter:
+    """Codifica frames BGR en un segmento H.264 MPEG-TS usando ffmpeg.
+
+    Expone la misma interfaz que cv2.VideoWriter (write/release/isOpened).
+    """
+
+    def __init__(self, path, fps, width, height, start_time=0.0):
+        self.path = path
+        self.proc = subprocess.Popen(
+            [FFMPEG_PATH, '-y', '-loglevel', 'error',
+             '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-',
+             '-an', '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p',
+             # libx264 exige dimensiones pares
+             '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+             '-output_ts_offset', f'{start_time:.3f}', '-f', 'mpegts', path],
+            stdin=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+
+    def isOpened(self):
+        return self.proc.poll() is None
+
+    def write(self, frame):
+        self.proc.stdin.write(frame.tobytes())
+
+    def release(self):
+        if self.proc.returncode is not None:
+            return
+        _, stderr = self.proc.communicate()
+        if self.proc.returncode != 0:
+            raise ValueError(f"ffmpeg no pudo cerrar el segmento: {stderr.decode(errors='ignore')[:200]}")
+
+
+def open_segment_writer(path_base, fps, width, height, start_time=0.0):
+    """Abre el escritor de un segmento: H.264/TS con ffmpeg, MP4 con OpenCV si no hay ffmpeg"""
+    if FFMPEG_PATH:
+        path = path_base + '.ts'
+        return FFmpegSegmentWriter(path, fps, width, height, start_time), path
+    path = path_base + '.mp4'
+    return open_video_writer(path, fps, width, height), path
+
+
+def get_playlist_url(output_filename):
+    return f"/hls/{os.path.splitext(output_filename)[0]}/index.m3u8"
+
+
+def get_live_urls(output_filename):
+    """URLs para ver un trabajo en curso: playlist HLS (si ya hay segmentos) y
+    vista previa MJPEG (solo trabajos secuenciales con anotación)"""
+    playlist_path = os.path.join(get_job_dir(output_filename), 'index.m3u8')
+    with video_previews_lock:
+        has_preview = output_filename in video_previews
+    return {
+        'playlist_url': get_playlist_url(output_filename) if os.path.exists(playlist_path) else None,
+        'preview_url': f'/video_preview/{output_filename}' if has_preview else None
+    }
+
+
+# Vista previa MJPEG de un trabajo en curso, para navegadores sin HLS (Chrome y
+# Firefox cuando no está hls.js). Solo se codifica si hay espectadores.
+VIDEO_PREVIEW_FPS = 5
+video_previews = {}  # {output_filename: FrameBroadcaster}
+video_previews_lock = threading.Lock()
+
+
+def open_video_preview(output_filename):
+    broadcaster = FrameBroadcaster(f'preview-{output_filename}', None)
+    broadcaster.set_running(True)
+    with video_previews_lock:
+        video_previews[output_filename] = broadcaster
+    return broadcaster
+
+
+def close_video_preview(output_filename):
+    with video_previews_lock:
+        broadcaster = video_previews.pop(output_filename, None)
+    if broadcaster is not None:
+        broadcaster.set_running(False)
+
+
+@app.route('/video_preview/<filename>')
+def video_preview(filename):
+    """Stream MJPEG de los frames anotados de un trabajo en curso"""
+    with video_previews_lock:
+        broadcaster = video_previews.get(filename)
+    if broadcaster is None:
+        return jsonify({'error': 'El video no se está procesando'}), 404
+    return Response(generate_mjpeg(broadcaster, lambda: broadcaster.running),
+                    mimetype='multipart/x-mixed-replace; boundary=frame')
+
+
+def write_hls_playlist(output_filename, segments, fps, ended=False):
+    """Reescribe la playlist HLS (tipo EVENT) con los segmentos ya cerrados"""
+    if not FFMPEG_PATH:
+        return
+    durations = [s['frames'] / fps for s in segments]
+    lines = [
+        '#EXTM3U',
+        '#EXT-X-VERSION:3',
+        f'#EXT-X-TARGETDURATION:{int(math.ceil(max(durations + [SEGMENT_SECONDS])))}',
+        '#EXT-X-MEDIA-SEQUENCE:0',
+        '#EXT-X-PLAYLIST-TYPE:EVENT'
+    ]
+    for seg, duration in zip(segments, durations):
+        lines.append(f'#EXTINF:{duration:.3f},')
+        lines.append(os.path.basename(seg['path']))
+    if ended:
+        lines.append('#EXT-X-ENDLIST')
+    path = os.path.join(get_job_dir(output_filename), 'index.m3u8')
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(path + '.tmp', path)
+
+
+def merge_segments(segment_paths, output_path, fps, width, height):
+    """Une los segmentos cerrados en el MP4 final (faststart si hay ffmpeg)"""
+    if FFMPEG_PATH:
+        list_path = os.path.join(os.path.dirname(segment_paths[0]), 'segments.txt')
+        with open(list_path, 'w', encoding='utf-8') as f:
+            for seg in segment_paths:
+                f.write(f"file '{os.path.abspath(seg)}'\n")
+        result = subprocess.run(
+            [FFMPEG_PATH, '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0',
+             '-i', list_path, '-c', 'copy', '-movflags', '+faststart', output_path],
+            capture_output=True
+        )
+        if result.returncode == 0:
+            return
+        print(f"ffmpeg concat falló, uniendo con OpenCV: {result.stderr[:200]}")
+
+    if len(segment_paths) == 1 and segment_paths[0].endswith('.mp4'):
+        shutil.move(segment_paths[0], output_path)
+        return
+
+    # Alternativa sin ffmpeg: reescribir los frames de cada segmento
+    out = open_video_writer(output_path, fps, width, height)
+    try:
+        for seg in segment_paths:
+            seg_cap = cv2.VideoCapture(seg)
+            while True:
+                ret, frame = seg_cap.read()
+                if not ret:
+                    break
+                out.write(frame)
+            seg_cap.release()
+    finally:
+        out.release()
+
+
+# Códecs que todos los navegadores reproducen dentro de un MP4
+MP4_VIDEO_CODECS = {'h264'}
+MP4_AUDIO_CODECS = {'aac', 'mp3'}
+
+
+def probe_stream_codecs(path):
+    """Códecs de video (primer flujo) y audio según ffprobe; None si no se pueden leer"""
+    ffprobe = shutil.which('ffprobe')
+    if not ffprobe:
+        return None
+    try:
+        result = subprocess.run(
+            [ffprobe, '-v', 'error', '-show_entries', 'stream=codec_type,codec_name', '-of', 'json', path],
+            capture_output=True, text=True, timeout=60
+        )
+        streams = json.loads(result.stdout or '{}').get('streams', [])
+    except Exception as e:
+        print(f"No se pudieron leer los códecs de {path}: {e}")
+        return None
+    video = [s.get('codec_name') for s in streams if s.get('codec_type') == 'video']
+    return {
+        'video': video[0] if video else None,
+        'audio': [s.get('codec_name') for s in streams if s.get('codec_type') == 'audio']
+    }
+
+
+def remux_original(input_path, output_path, fps, width, height):
+    """Publica el video original sin anotaciones, re-empaquetado para streaming.
+
+    Con ffmpeg se copia el flujo a un MP4 faststart sin re-codificar si ya es
+    H.264 (y AAC/MP3); si no, se transcodifica solo lo necesario. Sin ffmpeg
+    se mueve el MP4 tal cual o, como último recurso, se recodifica con OpenCV.
+    """
+    if FFMPEG_PATH:
+        codecs = probe_stream_codecs(input_path)
+        # Sin ffprobe se intenta copiar y, si falla, se transcodifica
+        attempts = [['-c', 'copy']] if codecs is None else []
+        if codecs is not None:
+            copy_video = codecs['video'] in MP4_VIDEO_CODECS
+            copy_audio = all(c in MP4_AUDIO_CODECS for c in codecs['audio'])
+            attempts.append(['-c:v', 'copy' if copy_video else 'libx264',
+                             '-c:a', 'copy' if copy_audio else 'aac'])
+        attempts.append(['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-pix_fmt', 'yuv420p',
+                         '-c:a', 'aac'])
+        for codec_args in attempts:
+            result = subprocess.run(
+                [FFMPEG_PATH, '-y', '-loglevel', 'error', '-i', input_path, '-map', '0:v:0', '-map', '0:a?',
+                 *codec_args, '-movflags', '+faststart', output_path],
+                capture_output=True
+            )
+            if result.returncode == 0:
+                os.remove(input_path)
+                return
+            print(f"ffmpeg no pudo re-empaquetar el original ({' '.join(codec_args)}): {result.stderr[:200]}")
+
+    if input_path.lower().endswith('.mp4'):
+        shutil.move(input_path, output_path)
+        return
+
+    decoder = open_video_decoder(input_path, max(width, height))
+    out = open_video_writer(output_path, fps, width, height)
+    try:
+        while True:
+            frame = decoder.read()
+            if frame is None:
+                break
+            if frame.shape[1] != width or frame.shape[0] != height:
+                frame = cv2.resize(frame, (width, height))
+            out.write(frame)
+    finally:
+        decoder.release()
+        out.release()
+    os.remove(input_path)  # igual que en los otros caminos: la salida reemplaza al original
+
+
+def start_video_job(video_path, output_path, output_filename, resume=False, workers=0, annotate=True):
+    """Lanza el procesamiento del video en un hilo de fondo"""
+    if workers > 1:
+        target = process_video_parallel
+        args = (video_path, output_path, output_filename, workers, resume, annotate)
+    else:
+        target = process_video
+        args = (video_path, output_path, output_filename, resume, annotate)
+    # Vista previa solo en trabajos nuevos, largos y con el original ya completo
+    with status_lock:
+        total_frames = (video_processing_status.get(output_filename) or {}).get('total_frames', 0)
+    quick_look = (QUICK_LOOK_ENABLED and model is not None and not resume
+                  and total_frames >= QUICK_LOOK_MIN_FRAMES and not is_upload_receiving(video_path))
+    thread = threading.Thread(target=run_video_job, args=(target, args, video_path, output_filename, quick_look))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def resume_interrupted_jobs():
+    """Reanuda trabajos que quedaron a medias por una caída o reinicio"""
+    resumed = set()
+    if os.path.isdir(app.config['JOBS_FOLDER']):
+        for job_id in sorted(os.listdir(app.config['JOBS_FOLDER'])):
+            output_filename = f"{job_id}.mp4"
+            checkpoint = load_checkpoint(output_filename)
+            if not checkpoint or checkpoint.get('status') != 'processing':
+                continue
+            input_path = checkpoint.get('input_path')
+            if not input_path or not os.path.exists(input_path):
+                print(f"No se puede reanudar {output_filename}: falta el video original")
+                remove_job_dir(output_filename)
+                continue
+
+            total_frames = checkpoint.get('total_frames', 0)
+            if checkpoint.get('mode') == 'parallel':
+                next_frame = sum(p['end'] - p['start'] for p in checkpoint.get('parts', []) if p.get('done'))
+            else:
+                next_frame = checkpoint.get('next_frame', 0)
+            with status_lock:
+                video_processing_status[output_filename] = {
+                    'status': 'processing',
+                    'progress': int((next_frame / total_frames) * 100) if total_frames else 0,
+                    'total_frames': total_frames,
+                    'processed_frames': next_frame,
+                    'resumed_from': next_frame
+                }
+            print(f"Reanudando {output_filename} desde el frame {next_frame}/{total_frames}")
+            start_video_job(input_path, checkpoint['output_path'], output_filename,
+                            resume=True, workers=checkpoint.get('workers', 0),
+                            annotate=checkpoint.get('annotate', True))
+            resumed.add(output_filename)
+
+    # Entradas sin checkpoint que quedaron "processing" ya no se pueden recuperar
+    with history_lock:
+        history = load_history()
+        changed = False
+        for h in history:
+            if h.get('type', 'video') == 'video' and h.get('status') == 'processing' \
+                    and h.get('output_filename') not in resumed:
+                h['status'] = 'error'
+                h['error'] = 'Procesamiento interrumpido sin checkpoint'
+                changed = True
+        if changed:
+            save_history(history)
+
+    return resumed
+
+
+def get_output_size(width, height, max_dimension=1280):
+    """Tamaño de salida limitado a max_dimension conservando la proporción"""
+    if width > max_dimension or height > max_dimension:
+        scale = max_dimension / max(width, height)
+        return int(width * scale), int(height * scale)
+    return width, height
+
+
+def extract_detections(result):
+    """Convierte las cajas de un resultado YOLO en detecciones serializables"""
+    detections = []
+    if result.boxes is not None:
+        boxes = result.boxes
+        for i in range(len(boxes)):
+            box = boxes.xyxy[i].cpu().numpy()  # [x1, y1, x2, y2]
+            cls = int(boxes.cls[i].cpu().numpy())
+            conf = float(boxes.conf[i].cpu().numpy())
+            class_name = result.names[cls]  # nombres del modelo que produjo el resultado
+            
+            detections.append({
+                'class': class_name,
+                'confidence': round(conf, 2),
+                'bbox': {
+                    'x1': float(box[0]),
+                    'y1': float(box[1]),
+                    'x2': float(box[2]),
+                    'y2': float(box[3])
+                }
+            })
+    return detections
+
+
+def get_video_imgsz():
+    """Tamaño de entrada del modelo para videos según dispositivo"""
+    return 1280 if DEVICE == 'cuda:0' else (960 if DEVICE == 'mps' else 640)
+
+
+def detect_video_frame(frame, preprocessor, annotate=True):
+    """Detección YOLO optimizada según dispositivo para un frame de video.
+
+    Devuelve el frame anotado a la resolución de salida (None si annotate=False)
+    y las detecciones en coordenadas de salida.
+    """
+    results = model(
+        preprocessor.letterbox(frame),
+        imgsz=preprocessor.imgsz,
+        conf=0.5 if DEVICE != 'cpu' else 0.45,
+        iou=0.7 if DEVICE != 'cpu' else 0.5,
+        verbose=False,
+        device=DEVICE,
+        half=(DEVICE == 'cuda:0'),  # FP16 solo en CUDA
+        max_det=300 if DEVICE != 'cpu' else 100,
+        stream=False
+    )
+    detections = preprocessor.to_output(extract_detections(results[0]))
+    annotated_frame = None
+    if annotate:
+        annotated_frame = draw_detections(preprocessor.output_frame(frame), detections)
+    return annotated_frame, detections
+
+
+def finish_video_job(output_filename, output_path, frames_list, last_detections, width, height, analytics=None):
+    """Marca el trabajo como completado y persiste sus detecciones y analítica en el historial"""
+    with status_lock:
+        status_info = video_processing_status.get(output_filename)
+        if status_info:
+            status_info['status'] = 'completed'
+            status_info['progress'] = 100
+    update_history_progress(output_filename, 100, 'completed')
+    
+    print(f"Video completado: {output_filename}, detecciones por frame guardadas: {len(frames_list)}")
+    
+    # Guardar detecciones en historial para reutilizar en videos ya listos
+    # Al menos guardar lo último aunque esté vacío, para tener dimensiones
+    update_history_detections(output_filename, last_detections, width, height)
+    
+    # Guardar detecciones por frame en historial (muestreo para no crecer mucho el archivo)
+    # Guardar solo cada 10 frames para no hacer el JSON muy grande
+    sampled_frames = [f for i, f in enumerate(frames_list) if i % 10 == 0]
+    summary = analytics.summary() if analytics is not None else None
+    
+    # La pista completa (todas las muestras) va a un archivo aparte para el reproductor
+    track_version = None
+    if frames_list:
+        try:
+            track_version = save_detection_track(output_filename, frames_list)
+        except Exception as e:
+            print(f"Error al guardar pista de detecciones: {e}")
+    
+    if sampled_frames or summary:
+        with history_lock:
+            history = load_history()
+            for h in history:
+                if h.get('output_filename') == output_filename:
+                    if sampled_frames:
+                        h['frames_detections'] = sampled_frames
+                    if summary:
+                        h['analytics'] = summary
+                    if track_version:
+                        h['track_version'] = track_version
+                    break
+            save_history(history)
+        print(f"Guardadas {len(sampled_frames)} muestras de frames en historial")
+    with video_analytics_lock:
+        video_analytics.pop(output_filename, None)
+    
+    remove_job_dir(output_filename)
+    generate_entry_thumbnails(output_filename)
+    if RETENTION_DELETE_ORIGINALS:
+        remove_original_upload(output_filename)
+    print(f"✅ Video procesado exitosamente: {output_path}")
+
+
+def fail_video_job(output_filename, output_path, error):
+    """Marca el trabajo con error y descarta checkpoint, segmentos y salida parcial"""
+    print(f"❌ Error al procesar video: {error}")
+    with status_lock:
+        status_info = video_processing_status.get(output_filename)
+        if status_info:
+            status_info['status'] = 'error'
+            status_info['error'] = str(error)
+    update_history_progress(output_filename, status='error')
+    with video_analytics_lock:
+        video_analytics.pop(output_filename, None)
+    
+    # Un error de procesamiento no es recuperable: descartar checkpoint y segmentos
+    remove_job_dir(output_filename)
+    
+    # Eliminar archivo de salida si existe y está corrupto
+    if os.path.exists(output_path):
+        try:
+            os.remove(output_path)
+        except:
+            pass
+
+
+def process_video(input_path, output_path, output_filename, resume=False, annotate=True):
+    """Procesa video con YOLO de forma optimizada, con checkpoints periódicos.
+
+    Con annotate=False no se dibujan ni re-codifican frames: solo se analizan
+    los frames muestreados y se publica el original re-empaquetado.
+    """
+    decoder = None
+    out = None
+    sample_step = 3  # guardar detecciones cada 3 frames para overlay dinámico
+    
+    try:
+        # Redimensionar si el video es muy grande (con PyAV, ya al decodificar)
+        decoder = open_video_decoder(input_path, max_dimension=1280)
+        
+        if not decoder.is_opened():
+            raise ValueError("No se pudo abrir el video de entrada")
+        
+        # Propiedades del video
+        fps = decoder.fps
+        width = decoder.width
+        height = decoder.height
+        total_frames = decoder.frame_count
+        if not resume:
+            update_history_meta(output_filename, fps=fps, width=width, height=height)
+        
+        # Validar propiedades
+        if fps <= 0:
+            fps = 30.0  # FPS por defecto
+        if width <= 0 or height <= 0:
+            raise ValueError("Dimensiones de video inválidas")
+        # El original puede estar llegando todavía (subida por partes)
+        growing_input = is_upload_receiving(input_path)
+        
+        width, height = decoder.output_size
+        preprocessor = LetterboxPreprocessor(*decoder.frame_size, get_video_imgsz(), (width, height))
+        
+        # Estado del trabajo: nuevo o reanudado desde el último checkpoint
+        checkpoint = load_checkpoint(output_filename) if resume else None
+        if checkpoint is None:
+            remove_job_dir(output_filename)
+            checkpoint = {
+                'status': 'processing',
+                'annotate': annotate,
+                'input_path': input_path,
+                'output_path': output_path,
+                'total_frames': total_frames,
+                'next_frame': 0,
+                'segments': [],
+                'last_detections': [],
+                'last_nonempty_detections': [],
+                'updated_at': time.time()
+            }
+            save_checkpoint(output_filename, checkpoint)
+        
+        job_dir = get_job_dir(output_filename)
+        segment_length = max(1, int(round(SEGMENT_SECONDS * fps)))
+        segments = [s for s in checkpoint['segments'] if os.path.exists(s['path'])]
+        frame_count = checkpoint['next_frame'] if len(segments) == len(checkpoint['segments']) else 0
+        if frame_count == 0:
+            segments = []
+        last_detections = checkpoint.get('last_detections', [])
+        last_nonempty_detections = checkpoint.get('last_nonempty_detections', [])
+        if frame_count and checkpoint.get('analytics'):
+            analytics = DetectionAnalytics.from_dict(checkpoint['analytics'])
+        else:
+            analytics = DetectionAnalytics(fps)
+        with video_analytics_lock:
+            video_analytics[output_filename] = analytics
+        
+        # Restaurar detecciones ya guardadas y posicionar la lectura en el checkpoint
+        restored_frames = truncate_frame_detections(output_filename, frame_count) if frame_count else []
+        with detections_frames_lock:
+            detections_frames_cache[output_filename] = [FrameDetections.from_dict(f) for f in restored_frames]
+        if frame_count > 0:
+            decoder.seek(frame_count)
+            print(f"Reanudando desde frame {frame_count} ({len(segments)} segmentos recuperados)")
+        else:
+            # Descartar detecciones de un intento anterior sin checkpoint válido
+            detections_path = os.path.join(job_dir, 'detections.jsonl')
+            if os.path.exists(detections_path):
+                os.remove(detections_path)
+        
+        if annotate:
+            out, segment_path = open_segment_writer(
+                os.path.join(job_dir, f"segment_{len(segments):05d}"), fps, width, height, frame_count / fps)
+            preview = open_video_preview(output_filename)
+            preview_at = 0.0
+        segment_frames = 0
+        pending_frames = []  # detecciones por frame aún no volcadas a disco
+        
+        print(f"Procesando video: {total_frames} frames a {fps} FPS, tamaño: {width}x{height}"
+              f"{'' if annotate else ' (solo detecciones)'}, decodificador: {decoder.backend}")
+        
+        while True:
+            # Sin anotación, se salta hasta el próximo frame muestreado sin
+            # convertirlos (sin cruzar un límite de checkpoint)
+            if not annotate and frame_count % sample_step != 0:
+                count = min(sample_step - frame_count % sample_step,
+                            segment_length - frame_count % segment_length)
+                if not decoder.skip(count):
+                    frame_count = decoder.position
+                    if not growing_input:
+                        break
+                    decoder, growing_input = reopen_growing_input(decoder, input_path, frame_count)
+                    continue
+                frame_count += count
+                if frame_count % segment_length == 0:
+                    append_frame_detections(output_filename, pending_frames)
+                    pending_frames = []
+                    checkpoint.update({
+                        'next_frame': frame_count,
+                        'last_detections': last_detections,
+                        'last_nonempty_detections': last_nonempty_detections,
+                        'analytics': analytics.to_dict(),
+                        'updated_at': time.time()
+                    })
+                    save_checkpoint(output_filename, checkpoint)
+                continue
+            
+            frame = decoder.read()
+            if frame is None:
+                if not growing_input:
+                    break
+                decoder, growing_input = reopen_growing_input(decoder, input_path, frame_count)
+                continue
+            
+            try:
+                # Un único redimensionado hacia el modelo (y otro hacia la salida si se anota)
+                annotated_frame, detections = detect_video_frame(frame, preprocessor, annotate)
                 
                 # Log de detecciones (cada 30 frames)
-                num_boxes = len(results[0].boxes) if results[0].boxes is not None else 0
                 if frame_count % 30 == 0:
-                    print(f"Frame {frame_count}: {num_boxes} detecciones encontradas")
+                    print(f"Frame {frame_count}: {len(detections)} detecciones encontradas")
                 
-                # Almacenar detecciones con coordenadas para interacción
-                detections = []
-                if results[0].boxes is not None:
-                    boxes = results[0].boxes
-                    for i in range(len(boxes)):
-                        box = boxes.xyxy[i].cpu().numpy()  # [x1, y1, x2, y2]
-                        cls = int(boxes.cls[i].cpu().numpy())
-                        conf = float(boxes.conf[i].cpu().numpy())
-                        class_name = model.names[cls]
-                        
-                        detections.append({
-                            'class': class_name,
-                            'confidence': round(conf, 2),
-                            'bbox': {
-                                'x1': float(box[0]),
-                                'y1': float(box[1]),
-                                'x2': float(box[2]),
-                                'y2': float(box[3])
-                            }
-                        })
                 last_detections = detections
-                last_width = width
-                last_height = height
                 if detections:
                     last_nonempty_detections = detections
-                    last_nonempty_width = width
-                    last_nonempty_height = height
+                # Sin anotación cada frame analizado representa sample_step frames
+                analytics.update(frame_count, detections, 1 if annotate else sample_step)
                 
                 # Guardar detecciones por frame para overlay dinámico (cada 3 frames)
-                if frame_count % 3 == 0:
+                if frame_count % sample_step == 0:
+                    frame_data = {
+                        'frame': frame_count,
+                        'detections': detections,
+                        'width': width,
+                        'height': height
+                    }
+                    pending_frames.append(frame_data)
                     with detections_frames_lock:
-                        frames_list = detections_frames_cache.setdefault(output_filename, [])
-                        frames_list.append({
-                            'frame': frame_count,
-                            'detections': detections,
-                            'width': width,
-                            'height': height
-                        })
-                        # Limitar memoria
-                        if len(frames_list) > 3000:
-                            frames_list.pop(0)
+                        detections_frames_cache.append(output_filename, FrameDetections.from_dict(frame_data))
 
                 # Almacenar detecciones en cache para este video
                 with detections_lock:
@@ -739,111 +3544,398 @@ def process_video(input_path, output_path, output_filename):
                 print(f"Error en detección frame {frame_count}: {e}")
                 annotated_frame = frame  # Usar frame original si falla la detección
             
-            # Asegurar que el frame anotado tenga el tamaño correcto
-            if annotated_frame.shape[1] != width or annotated_frame.shape[0] != height:
-                annotated_frame = cv2.resize(annotated_frame, (width, height))
-            
-            # Escribir frame al video
-            out.write(annotated_frame)
-            
-            # Almacenar frame procesado para streaming en tiempo real
-            encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 85]
-            ret, buffer = cv2.imencode('.jpg', annotated_frame, encode_param)
-            if ret:
-                with frames_cache_lock:
-                    if output_filename in video_frames_cache:
-                        video_frames_cache[output_filename].append(buffer.tobytes())
-                        # Limitar cache a últimos 100 frames para no consumir mucha memoria
-                        if len(video_frames_cache[output_filename]) > 100:
-                            video_frames_cache[output_filename].pop(0)
-            
+            if annotate:
+                # Asegurar que el frame anotado tenga el tamaño correcto
+                if annotated_frame.shape[1] != width or annotated_frame.shape[0] != height:
+                    annotated_frame = cv2.resize(annotated_frame, (width, height))
+                
+                # Escribir frame al segmento actual
+                out.write(annotated_frame)
+                segment_frames += 1
+                
+                if preview.viewers and time.time() - preview_at >= 1.0 / VIDEO_PREVIEW_FPS:
+                    ret, buffer = cv2.imencode('.jpg', annotated_frame, [int(cv2.IMWRITE_JPEG_QUALITY), 70])
+                    if ret:
+                        preview.publish(buffer.tobytes())
+                    preview_at = time.time()
             frame_count += 1
             
+            # Checkpoint: cerrar segmento, publicarlo en la playlist, volcar detecciones
+            if (segment_frames >= segment_length) if annotate else (frame_count % segment_length == 0):
+                if annotate:
+                    out.release()
+                    segments.append({'path': segment_path, 'frames': segment_frames})
+                    write_hls_playlist(output_filename, segments, fps)
+                append_frame_detections(output_filename, pending_frames)
+                pending_frames = []
+                checkpoint.update({
+                    'next_frame': frame_count,
+                    'segments': segments,
+                    'last_detections': last_detections,
+                    'last_nonempty_detections': last_nonempty_detections,
+                    'analytics': analytics.to_dict(),
+                    'updated_at': time.time()
+                })
+                save_checkpoint(output_filename, checkpoint)
+                if annotate:
+                    out, segment_path = open_segment_writer(
+                        os.path.join(job_dir, f"segment_{len(segments):05d}"), fps, width, height, frame_count / fps)
+                    segment_frames = 0
+            
             # Actualizar progreso
             with status_lock:
-                if output_filename in video_processing_status:
-                    video_processing_status[output_filename]['processed_frames'] = frame_count
-                    video_processing_status[output_filename]['progress'] = int((frame_count / total_frames) * 100)
-                    update_history_progress(output_filename, video_processing_status[output_filename]['progress'])
+                status_info = video_processing_status.get(output_filename)
+                if status_info:
+                    status_info['processed_frames'] = frame_count
+                    status_info['progress'] = int((frame_count / total_frames) * 100)
+                    update_history_progress(output_filename, status_info['progress'])
             
             # Log cada 30 frames o cada 10%
             if frame_count % max(30, total_frames // 10) == 0:
                 progress = (frame_count / total_frames) * 100
                 print(f"Procesado: {frame_count}/{total_frames} frames ({progress:.1f}%)")
         
-        # Marcar como completado
-        with status_lock:
-            if output_filename in video_processing_status:
-                video_processing_status[output_filename]['status'] = 'completed'
-                video_processing_status[output_filename]['progress'] = 100
-        update_history_progress(output_filename, 100, 'completed')
-        
-        # Log de detecciones guardadas
-        with detections_frames_lock:
-            frames_list = detections_frames_cache.get(output_filename, [])
-            frames_count = len(frames_list)
-        print(f"Video completado: {output_filename}, detecciones por frame guardadas: {frames_count}")
-        
-        # Guardar detecciones en historial para reutilizar en videos ya listos
-        if last_nonempty_detections:
-            update_history_detections(output_filename, last_nonempty_detections, last_nonempty_width, last_nonempty_height)
-        elif last_detections or last_width or last_height:
-            # Al menos guardar lo último aunque esté vacío, para tener dimensiones
-            update_history_detections(output_filename, last_detections, last_width, last_height)
-        
-        # Guardar detecciones por frame en historial (muestreo para no crecer mucho el archivo)
-        # Guardar solo cada 10 frames para no hacer el JSON muy grande
-        with detections_frames_lock:
-            sampled_frames = [f for i, f in enumerate(frames_list) if i % 10 == 0]
-        if sampled_frames:
-            with history_lock:
-                history = load_history()
-                for h in history:
-                    if h.get('output_filename') == output_filename:
-                        h['frames_detections'] = sampled_frames
-                        break
-                save_history(history)
-            print(f"Guardadas {len(sampled_frames)} muestras de frames en historial")
-        
-        # Limpiar cache después de un tiempo (dejar algunos frames para el stream final)
-        import time
-        time.sleep(2)  # Esperar para que el stream termine
-        with frames_cache_lock:
-            if output_filename in video_frames_cache:
-                # Mantener solo los últimos 10 frames
-                if len(video_frames_cache[output_filename]) > 10:
-                    video_frames_cache[output_filename] = video_frames_cache[output_filename][-10:]
+        append_frame_detections(output_filename, pending_frames)
+        if annotate:
+            # Cerrar el último segmento y unir todo en el video final
+            out.release()
+            out = None
+            if segment_frames > 0 or not segments:
+                segments.append({'path': segment_path, 'frames': segment_frames})
+            write_hls_playlist(output_filename, segments, fps, ended=True)
+            merge_segments([s['path'] for s in segments], output_path, fps, width, height)
+        else:
+            decoder.release()
+            decoder = None
+            remux_original(input_path, output_path, fps, width, height)
         
-        print(f"✅ Video procesado exitosamente: {output_path}")
+        # Detecciones completas (incluye las anteriores a un reinicio)
+        frames_list = load_frame_detections(output_filename)
+        finish_video_job(output_filename, output_path, frames_list,
+                         last_nonempty_detections or last_detections, width, height, analytics)
         
     except Exception as e:
-        print(f"❌ Error al procesar video: {e}")
-        with status_lock:
-            if output_filename in video_processing_status:
-                video_processing_status[output_filename]['status'] = 'error'
-                video_processing_status[output_filename]['error'] = str(e)
-        
-        # Eliminar archivo de salida si existe y está corrupto
-        if os.path.exists(output_path):
+        if out is not None:
             try:
-                os.remove(output_path)
-            except:
+                out.release()
+            except Exception:
                 pass
+            out = None
+        fail_video_job(output_filename, output_path, e)
     
     finally:
         # Liberar recursos
-        if cap is not None:
-            cap.release()
+        close_video_preview(output_filename)
+        if decoder is not None:
+            decoder.release()
+        if out is not None:
+            out.release()
+
+
+# ==================== PROCESAMIENTO PARALELO POR SEGMENTOS ====================
+# Videos largos se dividen en rangos de frames alineados a keyframes; cada rango
+# se procesa en un proceso aparte con su propia copia del modelo.
+
+# Cada proceso carga su propia copia del modelo: en GPU todos comparten cuda:0
+# y su memoria, así que se limitan a unos pocos (configurable)
+PARALLEL_WORKERS_PER_GPU = int(os.environ.get('PARALLEL_WORKERS_PER_GPU', 2))
+PARALLEL_MAX_CPU_WORKERS = 4
+
+
+def get_max_parallel_workers():
+    """Procesos de trabajo permitidos según el dispositivo (o MAX_PARALLEL_WORKERS)"""
+    configured = os.environ.get('MAX_PARALLEL_WORKERS')
+    if configured:
+        return max(1, int(configured))
+    if DEVICE.startswith('cuda'):
+        return max(1, PARALLEL_WORKERS_PER_GPU)
+    if DEVICE == 'mps':
+        return 1
+    return max(1, min(PARALLEL_MAX_CPU_WORKERS, (os.cpu_count() or 1) // 2))
+
+
+MAX_PARALLEL_WORKERS = get_max_parallel_workers()
+PARALLEL_MIN_FRAMES_PER_PART = 600  # no dividir en partes de menos de ~20 s
+
+# Progreso compartido por los procesos de trabajo (un contador por parte)
+_part_progress = None
+
+
+def find_keyframes(input_path, fps):
+    """Índices de frame de los keyframes del video (vacío si no hay ffprobe)"""
+    ffprobe = shutil.which('ffprobe')
+    if not ffprobe:
+        return []
+    try:
+        result = subprocess.run(
+            [ffprobe, '-v', 'error', '-select_streams', 'v:0', '-skip_frame', 'nokey',
+             '-show_entries', 'frame=best_effort_timestamp_time', '-of', 'csv=p=0', input_path],
+            capture_output=True, text=True, timeout=120
+        )
+    except Exception as e:
+        print(f"No se pudieron leer keyframes: {e}")
+        return []
+    keyframes = set()
+    for line in result.stdout.splitlines():
+        try:
+            keyframes.add(int(round(float(line.strip().rstrip(',')) * fps)))
+        except ValueError:
+            continue
+    return sorted(keyframes)
+
+
+def plan_video_parts(total_frames, workers, keyframes):
+    """Divide [0, total_frames) en rangos contiguos que empiezan en keyframes"""
+    parts_count = max(1, min(workers, total_frames // PARALLEL_MIN_FRAMES_PER_PART))
+    boundaries = [0]
+    for i in range(1, parts_count):
+        target = total_frames * i // parts_count
+        if keyframes:
+            target = min(keyframes, key=lambda k: abs(k - target))
+        if boundaries[-1] < target < total_frames:
+            boundaries.append(target)
+    boundaries.append(total_frames)
+    return [{'index': i, 'start': boundaries[i], 'end': boundaries[i + 1], 'done': False}
+            for i in range(len(boundaries) - 1)]
+
+
+def _init_part_worker(progress, torch_threads):
+    """Inicializador de cada proceso de trabajo"""
+    global _part_progress, decoder_thread_count
+    _part_progress = progress
+    if VIDEO_JOB_NICE > 0 and hasattr(os, 'nice'):
+        os.nice(VIDEO_JOB_NICE)  # la pasada completa cede CPU a tiempo real e imágenes
+    # Repartir los núcleos entre procesos para no sobresuscribir la CPU
+    torch.set_num_threads(torch_threads)
+    cv2.setNumThreads(1)
+    decoder_thread_count = min(decoder_thread_count or torch_threads, torch_threads)
+
+
+def process_video_part(input_path, part_path, detections_path, part_index, start_frame, end_frame, fps, width, height,
+                       annotate=True):
+    """Procesa un rango de frames en un proceso de trabajo (numeración absoluta)"""
+    if model is None:
+        raise RuntimeError('Modelo YOLO no está cargado en el proceso de trabajo')
+    sample_step = 3
+    decoder = open_video_decoder(input_path, max(width, height))
+    preprocessor = LetterboxPreprocessor(*decoder.frame_size, get_video_imgsz(), (width, height))
+    out = None
+    if annotate:
+        out, part_path = open_segment_writer(part_path, fps, width, height, start_frame / fps)
+    frames = []
+    last_detections = []
+    last_nonempty_detections = []
+    analytics = DetectionAnalytics(fps)
+    try:
+        if start_frame > 0:
+            decoder.seek(start_frame)
+        frame_index = start_frame
+        while frame_index < end_frame:
+            # Sin anotación, se salta hasta el próximo frame muestreado sin convertirlos
+            if not annotate and frame_index % sample_step != 0:
+                count = min(sample_step - frame_index % sample_step, end_frame - frame_index)
+                if not decoder.skip(count):
+                    frame_index = decoder.position
+                    break
+                frame_index += count
+                continue
+            frame = decoder.read()
+            if frame is None:
+                break
+            try:
+                annotated_frame, detections = detect_video_frame(frame, preprocessor, annotate)
+                last_detections = detections
+                if detections:
+                    last_nonempty_detections = detections
+                analytics.update(frame_index, detections, 1 if annotate else sample_step)
+                if frame_index % sample_step == 0:
+                    frames.append({
+                        'frame': frame_index,
+                        'detections': detections,
+                        'width': width,
+                        'height': height
+                    })
+            except Exception as e:
+                print(f"Error en detección frame {frame_index}: {e}")
+                annotated_frame = frame
+            if annotate:
+                if annotated_frame.shape[1] != width or annotated_frame.shape[0] != height:
+                    annotated_frame = cv2.resize(annotated_frame, (width, height))
+                out.write(annotated_frame)
+            frame_index += 1
+            if _part_progress is not None:
+                _part_progress[part_index] = frame_index - start_frame
+    finally:
+        decoder.release()
         if out is not None:
             out.release()
 
-@app.route('/check_video/<filename>')
+    with open(detections_path, 'w', encoding='utf-8') as f:
+        for frame_data in frames:
+            f.write(json.dumps(frame_data, ensure_ascii=False) + '\n')
+    return {
+        'index': part_index,
+        'path': part_path if annotate else None,
+        'frames': frame_index - start_frame,
+        'last_detections': last_detections,
+        'last_nonempty_detections': last_nonempty_detections,
+        'analytics': analytics.to_dict()
+    }
+
+
+def process_video_parallel(input_path, output_path, output_filename, workers, resume=False, annotate=True):
+    """Procesa un video largo repartiendo segmentos entre varios procesos"""
+    executor = None
+    try:
+        decoder = open_video_decoder(input_path)
+        if not decoder.is_opened():
+            decoder.release()
+            raise ValueError("No se pudo abrir el video de entrada")
+        fps = decoder.fps
+        width = decoder.width
+        height = decoder.height
+        total_frames = decoder.frame_count
+        decoder.release()
+        if not resume:
+            update_history_meta(output_filename, fps=fps, width=width, height=height)
+        if fps <= 0:
+            fps = 30.0
+        if width <= 0 or height <= 0:
+            raise ValueError("Dimensiones de video inválidas")
+        width, height = get_output_size(width, height)
+        
+        checkpoint = load_checkpoint(output_filename) if resume else None
+        if checkpoint is None or checkpoint.get('mode') != 'parallel':
+            remove_job_dir(output_filename)
+            parts = plan_video_parts(total_frames, workers, find_keyframes(input_path, fps))
+            checkpoint = {
+                'status': 'processing',
+                'mode': 'parallel',
+                'workers': workers,
+                'annotate': annotate,
+                'input_path': input_path,
+                'output_path': output_path,
+                'total_frames': total_frames,
+                'parts': parts,
+                'updated_at': time.time()
+            }
+            save_checkpoint(output_filename, checkpoint)
+        
+        job_dir = get_job_dir(output_filename)
+        parts = checkpoint['parts']
+        for part in parts:
+            part.setdefault('path', os.path.join(job_dir, f"part_{part['index']:03d}"))
+            part['detections_path'] = os.path.join(job_dir, f"part_{part['index']:03d}.jsonl")
+            if part['done'] and annotate and not os.path.exists(part['path']):
+                part['done'] = False
+        pending = [p for p in parts if not p['done']]
+        print(f"Procesando video en paralelo: {len(parts)} partes ({len(pending)} pendientes), "
+              f"{workers} procesos, {total_frames} frames")
+        
+        ctx = multiprocessing.get_context('spawn')
+        progress = ctx.Array('i', len(parts))
+        torch_threads = max(1, (os.cpu_count() or 1) // max(1, min(workers, len(pending))))
+        part_results = {}
+        if pending:
+            executor = ProcessPoolExecutor(
+                max_workers=min(workers, len(pending)),
+                mp_context=ctx,
+                initializer=_init_part_worker,
+                initargs=(progress, torch_threads)
+            )
+            futures = {
+                executor.submit(process_video_part, input_path, p['path'], p['detections_path'], p['index'],
+                                p['start'], p['end'], fps, width, height, annotate): p
+                for p in pending
+            }
+            remaining = set(futures)
+            while remaining:
+                done, remaining = wait(remaining, timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in done:
+                    part = futures[future]
+                    part_results[part['index']] = future.result()
+                    part['path'] = part_results[part['index']]['path'] or part['path']
+                    part['analytics'] = part_results[part['index']]['analytics']
+                    part['done'] = True
+                    checkpoint['updated_at'] = time.time()
+                    save_checkpoint(output_filename, checkpoint)
+                
+                # Progreso combinado de todas las partes
+                processed = sum(p['end'] - p['start'] if p['done'] else progress[p['index']] for p in parts)
+                with status_lock:
+                    status_info = video_processing_status.get(output_filename)
+                    if status_info:
+                        status_info['processed_frames'] = processed
+                        status_info['progress'] = min(99, int((processed / total_frames) * 100))
+            executor.shutdown()
+            executor = None
+            update_history_progress(output_filename, 99)
+        
+        if annotate:
+            merge_segments([p['path'] for p in parts], output_path, fps, width, height)
+        else:
+            remux_original(input_path, output_path, fps, width, height)
+        
+        # Unir detecciones en orden de frame
+        frames_list = []
+        for part in parts:
+            if os.path.exists(part['detections_path']):
+                with open(part['detections_path'], 'r', encoding='utf-8') as f:
+                    frames_list.extend(json.loads(line) for line in f if line.strip())
+        with detections_frames_lock:
+            detections_frames_cache[output_filename] = [FrameDetections.from_dict(f) for f in frames_list]
+        
+        last_detections = []
+        for part in reversed(parts):
+            result = part_results.get(part['index'])
+            if result and (result['last_nonempty_detections'] or result['last_detections']):
+                last_detections = result['last_nonempty_detections'] or result['last_detections']
+                break
+        if not last_detections:
+            # Partes completadas antes de un reinicio: tomar la última muestra no vacía
+            nonempty = [f for f in frames_list if f['detections']]
+            last_detections = nonempty[-1]['detections'] if nonempty else []
+        
+        # Agregados de todas las partes (incluidas las completadas antes de un reinicio)
+        analytics = DetectionAnalytics(fps)
+        for part in parts:
+            if part.get('analytics'):
+                analytics.merge(DetectionAnalytics.from_dict(part['analytics']))
+        
+        finish_video_job(output_filename, output_path, frames_list, last_detections, width, height, analytics)
+    
+    except Exception as e:
+        if executor is not None:
+            stop_part_workers(executor)
+        fail_video_job(output_filename, output_path, e)
+
+
+def stop_part_workers(executor):
+    """Detiene los procesos de trabajo antes de dar el trabajo por fallido.
+
+    Cancelar no basta: las partes en curso seguirían escribiendo en la carpeta
+    del trabajo mientras fail_video_job la limpia.
+    """
+    # ProcessPoolExecutor no expone sus procesos (terminate_workers es de 3.14)
+    processes = list((getattr(executor, '_processes', None) or {}).values())
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    for process in processes:
+        process.join(timeout=10)
+    executor.shutdown(wait=True, cancel_futures=True)
+
 def check_video(filename):
     """Verificar si el video procesado está listo"""
     output_path = os.path.join(app.config['OUTPUT_FOLDER'], filename)
     
     with status_lock:
-        status_info = video_processing_status.get(filename, {})
+        status_info = video_processing_status.get(filename) or {}
+    if not status_info:
+        # El estado pudo expirar de la cache; el historial conserva el resultado
+        entry = get_history_entry(filename) or {}
+        if entry.get('status') in ('completed', 'error'):
+            status_info = {'status': entry['status'], 'progress': entry.get('progress', 0)}
     
     if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
         # Verificar que el archivo esté completamente escrito
@@ -856,7 +3948,8 @@ def check_video(filename):
                 'status': 'completed',
                 'fps': meta.get('fps'),
                 'width': meta.get('width'),
-                'height': meta.get('height')
+                'height': meta.get('height'),
+                'quick_look': meta.get('quick_look')
             })
         elif status == 'error':
             return jsonify({
@@ -868,13 +3961,16 @@ def check_video(filename):
     # Retornar progreso si está procesando
     if status_info:
         update_history_progress(filename, status_info.get('progress', 0), status_info.get('status', 'processing'))
-        return jsonify({
+        return jsonify(dict(get_live_urls(filename), **{
             'ready': False,
             'status': status_info.get('status', 'processing'),
             'progress': status_info.get('progress', 0),
             'processed_frames': status_info.get('processed_frames', 0),
-            'total_frames': status_info.get('total_frames', 0)
-        })
+            'total_frames': status_info.get('total_frames', 0),
+            'eta_seconds': video_admission.job_eta(status_info),
+            'phase': status_info.get('phase', 'full'),
+            'quick_look': status_info.get('quick_look')
+        }))
     
     return jsonify({'ready': False, 'status': 'processing'})
 
@@ -884,49 +3980,473 @@ def serve_video(filename):
     from flask import send_from_directory
     return send_from_directory(app.config['OUTPUT_FOLDER'], filename)
 
-@app.route('/video_stream/<filename>')
-def video_stream(filename):
-    """Stream de frames procesados en tiempo real"""
-    def generate():
-        last_frame_index = -1
-        import time
-        
-        while True:
-            with frames_cache_lock:
-                frames = video_frames_cache.get(filename, [])
-            
-            with status_lock:
-                status_info = video_processing_status.get(filename, {})
-                status = status_info.get('status', 'processing')
-            
-            # Si hay frames nuevos, enviarlos
-            if len(frames) > last_frame_index + 1:
-                # Enviar todos los frames nuevos
-                for i in range(last_frame_index + 1, len(frames)):
-                    frame_bytes = frames[i]
-                    yield (b'--frame\r\n'
-                           b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-                last_frame_index = len(frames) - 1
-            
-            # Si terminó el procesamiento
-            if status == 'completed':
-                # Enviar último frame si existe
-                if frames and last_frame_index < len(frames) - 1:
-                    yield (b'--frame\r\n'
-                           b'Content-Type: image/jpeg\r\n\r\n' + frames[-1] + b'\r\n')
-                break
-            elif status == 'error':
-                # Si hay error, enviar último frame disponible y cerrar
-                if frames:
-                    yield (b'--frame\r\n'
-                           b'Content-Type: image/jpeg\r\n\r\n' + frames[-1] + b'\r\n')
-                break
-            
-            # Esperar un poco antes de verificar de nuevo
-            time.sleep(0.05)  # 50ms para ~20 FPS de actualización
-    
-    return Response(generate(),
-                    mimetype='multipart/x-mixed-replace; boundary=frame')
+@app.route('/hls/<job_id>/<name>')
+def serve_hls(job_id, name):
+    """Servir la playlist HLS y los segmentos ya cerrados de un video en proceso"""
+    from flask import send_from_directory
+    job_dir = get_job_dir(f"{job_id}.mp4")
+    if name.endswith('.m3u8'):
+        response = send_from_directory(job_dir, name, mimetype='application/vnd.apple.mpegurl')
+        # La playlist crece mientras se procesa: no cachear
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    if name.endswith('.ts'):
+        response = send_from_directory(job_dir, name, mimetype='video/mp2t')
+        # Un segmento cerrado no cambia nunca
+        response.headers['Cache-Control'] = 'public, max-age=3600, immutable'
+        return response
+    return jsonify({'error': 'Recurso HLS no válido'}), 404
+
+# ==================== MINIATURAS ====================
+# Miniaturas y posters se guardan en una cache direccionada por contenido: el
+# nombre deriva del archivo de origen (tamaño y mtime), así que la URL cambia
+# si cambia el origen y se puede servir como inmutable.
+
+THUMBNAIL_SIZES = {'thumb': 320, 'poster': 1280}
+THUMBNAIL_QUALITY = 80
+
+
+def get_thumbnail_key(output_filename, kind):
+    """Clave de la miniatura o None si la salida todavía no existe"""
+    source_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
+    try:
+        stat = os.stat(source_path)
+    except OSError:
+        return None
+    raw = f"{output_filename}|{stat.st_size}|{stat.st_mtime_ns}|{kind}|{THUMBNAIL_SIZES[kind]}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:20]
+
+
+def get_thumbnail_path(key):
+    return os.path.join(app.config['THUMBNAIL_FOLDER'], f"{key}.jpg")
+
+
+def read_video_poster_frame(video_path):
+    """Frame representativo de un video (~1 s o 10% de la duración)"""
+    decoder = open_video_decoder(video_path)
+    try:
+        fps = decoder.fps or 30
+        total = decoder.frame_count
+        target = min(int(fps), total // 10) if total > 0 else 0
+        if target > 0:
+            decoder.seek(target)
+        frame = decoder.read()
+        if frame is None and target > 0:
+            decoder.seek(0)
+            frame = decoder.read()
+        return frame
+    finally:
+        decoder.release()
+
+
+def write_thumbnail(image, path, max_dimension):
+    """Reduce la imagen y la guarda como JPEG de forma atómica"""
+    height, width = image.shape[:2]
+    size = get_output_size(width, height, max_dimension)
+    if size != (width, height):
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    ok, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, THUMBNAIL_QUALITY])
+    if not ok:
+        return False
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(buffer.tobytes())
+    os.replace(tmp_path, path)
+    return True
+
+
+def ensure_thumbnail(output_filename, kind, source_image=None):
+    """Devuelve la ruta de la miniatura, generándola si no está en cache"""
+    key = get_thumbnail_key(output_filename, kind)
+    if key is None:
+        return None
+    path = get_thumbnail_path(key)
+    if os.path.exists(path):
+        return path
+
+    image = source_image
+    if image is None:
+        source_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
+        if output_filename.lower().endswith('.mp4'):
+            image = read_video_poster_frame(source_path)
+        else:
+            image = cv2.imread(source_path, cv2.IMREAD_COLOR)
+    if image is None:
+        return None
+    return path if write_thumbnail(image, path, THUMBNAIL_SIZES[kind]) else None
+
+
+def generate_entry_thumbnails(output_filename, source_image=None):
+    """Genera por adelantado las miniaturas de una entrada recién terminada"""
+    kinds = ['thumb'] if source_image is not None else ['thumb', 'poster']
+    if source_image is None and output_filename.lower().endswith('.mp4'):
+        # Decodificar el poster una sola vez y derivar la miniatura de él
+        source_image = read_video_poster_frame(os.path.join(app.config['OUTPUT_FOLDER'], output_filename))
+        if source_image is None:
+            return
+    for kind in kinds:
+        try:
+            ensure_thumbnail(output_filename, kind, source_image)
+        except Exception as e:
+            print(f"Error al generar miniatura {kind} de {output_filename}: {e}")
+
+
+def get_thumbnail_urls(entry):
+    """URLs versionadas de miniatura (y poster en videos) de una entrada"""
+    output_filename = entry.get('output_filename')
+    if not output_filename or entry.get('status', 'completed') != 'completed':
+        return {}
+    kinds = ['thumb'] if entry.get('type') == 'image' else ['thumb', 'poster']
+    urls = {}
+    for kind in kinds:
+        key = get_thumbnail_key(output_filename, kind)
+        if key:
+            field = 'thumbnail_url' if kind == 'thumb' else 'poster_url'
+            urls[field] = f'/thumbnail/{output_filename}?kind={kind}&v={key}'
+    return urls
+
+
+def get_thumbnail_paths(entry):
+    """Miniaturas existentes en disco de una entrada (para retención)"""
+    output_filename = entry.get('output_filename')
+    if not output_filename:
+        return []
+    paths = []
+    for kind in THUMBNAIL_SIZES:
+        key = get_thumbnail_key(output_filename, kind)
+        if key and os.path.exists(get_thumbnail_path(key)):
+            paths.append(get_thumbnail_path(key))
+    strip_path = get_quick_look_strip_path(output_filename)
+    if os.path.exists(strip_path):
+        paths.append(strip_path)
+    return paths
+
+
+@app.route('/thumbnail/<filename>')
+def serve_thumbnail(filename):
+    """Servir miniatura o poster de una entrada del historial (generación perezosa)"""
+    from flask import send_from_directory
+    kind = request.args.get('kind', 'thumb')
+    if kind == 'strip':
+        # Tira de la vista previa rápida: se sobrescribe solo si se repite la pasada
+        path = get_quick_look_strip_path(filename)
+        if not os.path.exists(path):
+            return jsonify({'error': 'Miniatura no disponible'}), 404
+        response = send_from_directory(app.config['THUMBNAIL_FOLDER'], os.path.basename(path), mimetype='image/jpeg')
+        response.headers['Cache-Control'] = 'public, max-age=300'
+        return response
+    if kind not in THUMBNAIL_SIZES:
+        return jsonify({'error': 'Tipo de miniatura no válido'}), 400
+    if not get_history_entry(filename):
+        return jsonify({'error': 'Entrada no encontrada en el historial'}), 404
+
+    try:
+        path = ensure_thumbnail(filename, kind)
+    except Exception as e:
+        print(f"Error al generar miniatura de {filename}: {e}")
+        path = None
+    if not path:
+        return jsonify({'error': 'Miniatura no disponible'}), 404
+
+    response = send_from_directory(app.config['THUMBNAIL_FOLDER'], os.path.basename(path), mimetype='image/jpeg')
+    if request.args.get('v') == os.path.basename(path)[:-4]:
+        # URL versionada por contenido: el navegador no necesita revalidar
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'public, max-age=300'
+    return response
+
+
+# ==================== VISTA PREVIA RÁPIDA ====================
+# Primera pasada sobre unos pocos frames repartidos por todo el video (con
+# búsquedas, sin decodificar lo intermedio) y detectados en lote: en segundos
+# da un resumen aproximado de qué animales aparecen y una tira de miniaturas.
+# La pasada completa continúa después con menor prioridad de CPU.
+
+QUICK_LOOK_ENABLED = os.environ.get('QUICK_LOOK_ENABLED', '1') != '0'
+QUICK_LOOK_SAMPLES = 24  # frames analizados en la primera pasada
+QUICK_LOOK_BATCH = 8
+QUICK_LOOK_MIN_FRAMES = 300  # videos más cortos van directo a la pasada completa
+QUICK_LOOK_STRIP_FRAMES = 8
+QUICK_LOOK_STRIP_HEIGHT = 90
+VIDEO_JOB_NICE = int(os.environ.get('VIDEO_JOB_NICE', 5))  # prioridad de la pasada completa
+
+
+def get_quick_look_strip_path(output_filename):
+    stem = os.path.splitext(output_filename)[0]
+    return os.path.join(app.config['THUMBNAIL_FOLDER'], f"{stem}_strip.jpg")
+
+
+def lower_thread_priority():
+    """Baja la prioridad del hilo actual (Linux: nice por hilo) para la pasada completa"""
+    if VIDEO_JOB_NICE <= 0:
+        return
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), VIDEO_JOB_NICE)
+    except (AttributeError, OSError):
+        pass  # plataforma sin prioridades por hilo
+
+
+def sample_video_frames(video_path, samples):
+    """Frames repartidos uniformemente por el video: [(índice, frame)], fps"""
+    decoder = open_video_decoder(video_path, max_dimension=1280)
+    try:
+        total = decoder.frame_count
+        fps = decoder.fps or 30.0
+        if total <= 0:
+            return [], fps
+        frames = []
+        for i in range(min(samples, total)):
+            index = int((i + 0.5) * total / samples)
+            decoder.seek(index)
+            frame = decoder.read()
+            if frame is not None:
+                frames.append((index, frame.copy()))  # OpenCV reutiliza el buffer de lectura
+        return frames, fps
+    finally:
+        decoder.release()
+
+
+def write_quick_look_strip(output_filename, samples):
+    """Tira horizontal con las detecciones dibujadas; devuelve su versión"""
+    if not samples:
+        return None
+    step = max(1, len(samples) // QUICK_LOOK_STRIP_FRAMES)
+    tiles = []
+    for _, frame, detections in samples[::step][:QUICK_LOOK_STRIP_FRAMES]:
+        annotated = draw_detections(frame, detections)
+        height, width = annotated.shape[:2]
+        tile_width = max(1, int(width * QUICK_LOOK_STRIP_HEIGHT / height))
+        tiles.append(cv2.resize(annotated, (tile_width, QUICK_LOOK_STRIP_HEIGHT), interpolation=cv2.INTER_AREA))
+    strip = cv2.hconcat(tiles)
+    path = get_quick_look_strip_path(output_filename)
+    if not write_thumbnail(strip, path, max(strip.shape[:2])):
+        return None
+    return hashlib.sha1(f"{path}|{os.stat(path).st_mtime_ns}".encode('utf-8')).hexdigest()[:20]
+
+
+def run_quick_look(video_path, output_filename):
+    """Primera pasada: resumen de presencia por clase y tira de miniaturas"""
+    started = time.time()
+    with status_lock:
+        status_info = video_processing_status.get(output_filename)
+        if status_info:
+            status_info['phase'] = 'quick_look'
+
+    frames, fps = sample_video_frames(video_path, QUICK_LOOK_SAMPLES)
+    samples = []
+    for start in range(0, len(frames), QUICK_LOOK_BATCH):
+        batch = frames[start:start + QUICK_LOOK_BATCH]
+        results = model(
+            [frame for _, frame in batch],
+            imgsz=get_video_imgsz(),
+            conf=0.5 if DEVICE != 'cpu' else 0.45,
+            device=DEVICE,
+            half=(DEVICE == 'cuda:0'),
+            verbose=False
+        )
+        for (index, frame), result in zip(batch, results):
+            samples.append((index, frame, extract_detections(result)))
+
+    classes = {}
+    for index, _, detections in samples:
+        for name in {d['class'] for d in detections}:
+            best = max(d['confidence'] for d in detections if d['class'] == name)
+            info = classes.setdefault(name, {'class': name, 'samples': 0, 'max_confidence': 0.0,
+                                             'first_seen_seconds': round(index / fps, 1)})
+            info['samples'] += 1
+            info['max_confidence'] = max(info['max_confidence'], best)
+    for info in classes.values():
+        info['presence'] = round(info['samples'] / len(samples), 2)
+
+    strip_version = write_quick_look_strip(output_filename, samples)
+    summary = {
+        'samples': len(samples),
+        'classes': sorted(classes.values(), key=lambda c: c['samples'], reverse=True),
+        'strip_url': f'/thumbnail/{output_filename}?kind=strip&v={strip_version}' if strip_version else None,
+        'elapsed_seconds': round(time.time() - started, 2)
+    }
+    with status_lock:
+        status_info = video_processing_status.get(output_filename)
+        if status_info:
+            status_info['quick_look'] = summary
+    update_history_meta(output_filename, quick_look=summary)
+    print(f"Vista previa de {output_filename}: {len(samples)} frames en {summary['elapsed_seconds']}s, "
+          f"clases: {', '.join(classes) or 'ninguna'}")
+    return summary
+
+
+def run_video_job(target, args, video_path, output_filename, quick_look):
+    """Hilo de un trabajo: vista previa rápida y después la pasada completa"""
+    if quick_look:
+        try:
+            run_quick_look(video_path, output_filename)
+        except Exception as e:
+            print(f"Error en la vista previa de {output_filename}: {e}")
+    with status_lock:
+        status_info = video_processing_status.get(output_filename)
+        if status_info:
+            status_info['phase'] = 'full'
+    lower_thread_priority()
+    target(*args)
+
+
+# ==================== PISTA DE DETECCIONES ====================
+# Toda la secuencia de detecciones de un video en un solo recurso comprimido:
+# coordenadas enteras (píxeles), confianza en porcentaje y cada caja expresada
+# como diferencia respecto a la caja equivalente del frame anterior. El
+# reproductor la descarga una vez y busca/interpola las cajas localmente.
+
+TRACK_FORMAT_VERSION = 1
+
+
+def get_track_path(output_filename):
+    stem = os.path.splitext(output_filename)[0]
+    return os.path.join(app.config['TRACKS_FOLDER'], f"{stem}.json.gz")
+
+
+def encode_detection_track(frames_list):
+    """Detecciones por frame -> pista compacta (dict serializable)
+
+    'data' es una lista plana de enteros; por frame: salto de frame, número de
+    cajas y, por caja, clase, confianza, x1, y1, x2, y2. Las cajas se ordenan
+    por (clase, x1) y, si el frame anterior tiene en la misma posición una caja
+    de la misma clase, las coordenadas se guardan como diferencia respecto a
+    ella. De una racha de frames vacíos solo se guarda el primero.
+    """
+    classes = []
+    class_ids = {}
+    data = []
+    width = height = 0
+    step = None
+    emitted = 0
+    prev_frame = 0
+    prev_boxes = []
+    for frame_data in sorted(frames_list, key=lambda f: f['frame']):
+        detections = frame_data['detections']
+        if isinstance(detections, np.ndarray):
+            detections = unpack_detections(detections)
+        boxes = []
+        for det in detections:
+            name = det['class']
+            if name not in class_ids:
+                class_ids[name] = len(classes)
+                classes.append(name)
+            bbox = det['bbox']
+            boxes.append((class_ids[name], int(round(det['confidence'] * 100)),
+                          int(round(bbox['x1'])), int(round(bbox['y1'])),
+                          int(round(bbox['x2'])), int(round(bbox['y2']))))
+        boxes.sort(key=lambda b: (b[0], b[2]))
+        width = frame_data.get('width') or width
+        height = frame_data.get('height') or height
+        if emitted and not boxes and not prev_boxes:
+            continue
+        gap = frame_data['frame'] - prev_frame
+        if emitted and gap > 0 and boxes and prev_boxes:
+            step = gap if step is None else min(step, gap)
+
+        data.append(gap)
+        data.append(len(boxes))
+        for i, box in enumerate(boxes):
+            ref = prev_boxes[i] if i < len(prev_boxes) and prev_boxes[i][0] == box[0] else None
+            data.extend(box[:2])
+            data.extend(box[k] - ref[k] if ref else box[k] for k in range(2, 6))
+        prev_frame = frame_data['frame']
+        prev_boxes = boxes
+        emitted += 1
+
+    return {
+        'version': TRACK_FORMAT_VERSION,
+        'width': width,
+        'height': height,
+        'classes': classes,
+        'frames': emitted,
+        # Entre dos frames a más de max_gap de distancia no se interpola
+        'max_gap': 2 * (step or 3),
+        'data': data
+    }
+
+
+def save_detection_track(output_filename, frames_list):
+    """Escribe la pista comprimida de forma atómica; devuelve su versión"""
+    track = encode_detection_track(frames_list)
+    body = gzip.compress(json.dumps(track, separators=(',', ':')).encode('utf-8'), compresslevel=9)
+    path = get_track_path(output_filename)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(body)
+    os.replace(tmp_path, path)
+    print(f"Pista de detecciones guardada: {path} ({track['frames']} frames, {len(body)} bytes)")
+    return hashlib.sha1(body).hexdigest()[:20]
+
+
+def build_missing_track(entry):
+    """Genera la pista de videos procesados antes de existir este formato"""
+    output_filename = entry['output_filename']
+    with detections_frames_lock:
+        cached = detections_frames_cache.get(output_filename)
+        frames_list = [f.to_dict() for f in cached] if cached else None
+    if not frames_list:
+        # Sin la cache completa, el historial conserva una muestra
+        frames_list = entry.get('frames_detections') or []
+    if not frames_list:
+        return None
+    version = save_detection_track(output_filename, frames_list)
+    update_history_meta(output_filename, track_version=version)
+    return version
+
+
+def get_track_url(entry):
+    """URL de la pista de detecciones (versionada si se conoce su contenido)"""
+    output_filename = entry.get('output_filename')
+    if (not output_filename or entry.get('type') == 'image'
+            or entry.get('status', 'completed') != 'completed'):
+        return {}
+    url = f'/detections_track/{output_filename}'
+    if entry.get('track_version'):
+        url += f"?v={entry['track_version']}"
+    return {'track_url': url}
+
+
+@app.route('/detections_track/<filename>')
+def get_detections_track(filename):
+    """Pista completa de detecciones de un video procesado (gzip, cacheable)"""
+    entry = get_history_entry(filename)
+    if not entry or entry.get('type') == 'image':
+        return jsonify({'error': 'Video no encontrado en el historial'}), 404
+    if entry.get('status') != 'completed':
+        return jsonify({'error': 'El video aún se está procesando'}), 409
+
+    path = get_track_path(filename)
+    version = entry.get('track_version')
+    if not version or not os.path.exists(path):
+        try:
+            version = build_missing_track(entry)
+        except Exception as e:
+            print(f"Error al generar pista de {filename}: {e}")
+            version = None
+        if not version:
+            return jsonify({'error': 'No hay detecciones por frame para este video'}), 404
+
+    if request.if_none_match.contains(version):
+        response = Response(status=304)
+    else:
+        with open(path, 'rb') as f:
+            body = f.read()
+        if request.accept_encodings['gzip']:
+            response = Response(body, mimetype='application/json')
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = Response(gzip.decompress(body), mimetype='application/json')
+    response.set_etag(version)
+    response.headers['Vary'] = 'Accept-Encoding'
+    if request.args.get('v') == version:
+        # URL versionada por contenido: el navegador no necesita revalidar
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 
 # ==================== INFORMACIÓN DE CLASES ====================
 
@@ -936,22 +4456,190 @@ def get_classes():
     classes = model.names
     return jsonify(classes)
 
-@app.route('/history')
-def get_history():
-    """Obtener historial de videos procesados (filtrado por tipo video o sin tipo)"""
-    history = load_history()
-    # Filtrar solo videos (type='video' o sin type para retrocompatibilidad)
-    video_history = [h for h in history if h.get('type', 'video') == 'video']
-    return jsonify(video_history)
+# Campos pesados que la vista de lista no necesita
+HISTORY_HEAVY_FIELDS = ('frames_detections', 'detections', 'analytics')
+HISTORY_PAGE_MAX = 200
+
+
+def encode_history_cursor(entry):
+    raw = json.dumps([entry.get('created_at', ''), entry.get('output_filename', '')])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_history_cursor(cursor):
+    try:
+        created_at, filename = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return str(created_at), str(filename)
+    except Exception:
+        return None
+
+
+def history_list_response(entry_type):
+    """Lista de historial paginada por cursor, proyectada y con ETag.
+
+    Parámetros: limit, cursor (X-Next-Cursor de la página anterior),
+    fields (lista separada por comas) y view=summary (sin detecciones).
+    Sin limit se devuelven todas las entradas, como antes.
+    """
+    entries, version = get_history_snapshot()
+    limit = request.args.get('limit', type=int)
+    cursor = request.args.get('cursor', '')
+    fields = [f for f in request.args.get('fields', '').split(',') if f]
+    view = request.args.get('view', '')
+
+    # La versión del historial (hash de su contenido, estable entre reinicios)
+    # y la variante pedida identifican la respuesta
+    variant = f"{entry_type}|{version}|{limit}|{cursor}|{','.join(fields)}|{view}|{wants_compact_detections()}"
+    etag = hashlib.md5(variant.encode('utf-8')).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.headers['Vary'] = 'Accept'
+        return response
+
+    if entry_type == 'image':
+        selected = [h for h in entries if h.get('type') == 'image']
+    else:
+        # type='video' o sin type para retrocompatibilidad
+        selected = [h for h in entries if h.get('type', 'video') == 'video']
+    selected.sort(key=lambda h: (h.get('created_at', ''), h.get('output_filename', '')), reverse=True)
+
+    if cursor:
+        key = decode_history_cursor(cursor)
+        if key is None:
+            return jsonify({'error': 'Cursor inválido'}), 400
+        selected = [h for h in selected if (h.get('created_at', ''), h.get('output_filename', '')) < key]
+
+    next_cursor = None
+    if limit is not None:
+        limit = max(1, min(limit, HISTORY_PAGE_MAX))
+        if len(selected) > limit:
+            selected = selected[:limit]
+            next_cursor = encode_history_cursor(selected[-1])
+
+    if fields:
+        page = [{k: h[k] for k in fields if k in h} for h in selected]
+    elif view == 'summary':
+        page = [{k: v for k, v in h.items() if k not in HISTORY_HEAVY_FIELDS} for h in selected]
+    else:
+        page = [dict(h) for h in selected]
+    if not fields or {'thumbnail_url', 'poster_url', 'track_url'} & set(fields):
+        for item, h in zip(page, selected):
+            urls = get_thumbnail_urls(h)
+            urls.update(get_track_url(h))
+            item.update({k: v for k, v in urls.items() if not fields or k in fields})
+
+    response = detections_jsonify(page)
+    response.set_etag(etag)
+    # Revalidar siempre: el historial cambia, pero casi siempre responde 304
+    response.headers['Cache-Control'] = 'no-cache'
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+
+@app.route('/history')
+def get_history():
+    """Obtener historial de videos procesados (filtrado por tipo video o sin tipo)"""
+    return history_list_response('video')
+
+
+@app.route('/image_history')
+def get_image_history():
+    """Obtener historial de imágenes procesadas"""
+    return history_list_response('image')
+
+
+@app.route('/history/<filename>')
+def get_history_item(filename):
+    """Obtener una entrada completa del historial (con sus detecciones)"""
+    entry = get_history_entry(filename)
+    if not entry:
+        return jsonify({'error': 'Entrada no encontrada en el historial'}), 404
+    entry.update(get_thumbnail_urls(entry))
+    entry.update(get_track_url(entry))
+    return detections_jsonify(entry)
+
+
+# Agregado de todo el historial; se recalcula solo cuando cambia la versión
+_analytics_aggregate = {'version': None, 'data': None}
+_analytics_aggregate_lock = threading.Lock()
+
+
+def get_analytics_aggregate():
+    """Resumen por clase de todas las entradas del historial (videos e imágenes)"""
+    history, version = get_history_snapshot()
+    with _analytics_aggregate_lock:
+        if _analytics_aggregate['version'] == version:
+            return _analytics_aggregate['data']
+    
+    classes = {}
+    totals = {'videos': 0, 'images': 0, 'analyzed_seconds': 0.0}
+    
+    def class_entry(name):
+        return classes.setdefault(name, {
+            'videos': 0, 'images': 0, 'detections': 0,
+            'peak_count': 0, 'presence_seconds': 0.0
+        })
+    
+    for h in history:
+        if h.get('type') == 'image':
+            counts = {}
+            for det in h.get('detections') or []:
+                counts[det['class']] = counts.get(det['class'], 0) + 1
+            # Las imágenes no tienen status (se guardan ya procesadas); una
+            # imagen sin detecciones también cuenta como analizada
+            if h.get('status') == 'processing':
+                continue
+            totals['images'] += 1
+            for name, count in counts.items():
+                stats = class_entry(name)
+                stats['images'] += 1
+                stats['detections'] += count
+                stats['peak_count'] = max(stats['peak_count'], count)
+            continue
+        summary = h.get('analytics')
+        if not summary:
+            continue
+        totals['videos'] += 1
+        totals['analyzed_seconds'] += summary.get('analyzed_seconds', 0)
+        for name, video_stats in summary.get('classes', {}).items():
+            stats = class_entry(name)
+            stats['videos'] += 1
+            stats['detections'] += video_stats['detections']
+            stats['peak_count'] = max(stats['peak_count'], video_stats['peak_count'])
+            stats['presence_seconds'] += video_stats['presence_seconds']
+    
+    totals['analyzed_seconds'] = round(totals['analyzed_seconds'], 2)
+    for stats in classes.values():
+        stats['presence_seconds'] = round(stats['presence_seconds'], 2)
+    data = {'totals': totals, 'classes': classes}
+    with _analytics_aggregate_lock:
+        _analytics_aggregate['version'] = version
+        _analytics_aggregate['data'] = data
+    return data
+
 
+@app.route('/analytics')
+def get_analytics_overview():
+    """Analítica agregada de todo el historial"""
+    return jsonify(get_analytics_aggregate())
 
-@app.route('/image_history')
-def get_image_history():
-    """Obtener historial de imágenes procesadas"""
-    history = load_history()
-    # Filtrar solo imágenes
-    image_history = [h for h in history if h.get('type') == 'image']
-    return jsonify(image_history)
+
+@app.route('/analytics/<filename>')
+def get_video_analytics(filename):
+    """Resumen de detecciones de un video (en curso o terminado)"""
+    with video_analytics_lock:
+        analytics = video_analytics.get(filename)
+    if analytics is not None:
+        return jsonify({'status': 'processing', 'analytics': analytics.summary()})
+    
+    entry = get_history_entry(filename)
+    if not entry:
+        return jsonify({'error': 'Entrada no encontrada en el historial'}), 404
+    if not entry.get('analytics'):
+        return jsonify({'error': 'No hay analítica disponible para esta entrada'}), 404
+    return jsonify({'status': entry.get('status', 'completed'), 'analytics': entry['analytics']})
 
 
 @app.route('/delete_image/<filename>', methods=['DELETE'])
@@ -969,22 +4657,12 @@ def delete_image(filename):
             if not entry:
                 return jsonify({'error': 'Imagen no encontrada en el historial'}), 404
             
-            # Eliminar archivo de imagen procesada
-            output_path = os.path.join(app.config['OUTPUT_FOLDER'], filename)
-            if os.path.exists(output_path):
-                os.remove(output_path)
-                print(f"Imagen eliminada: {output_path}")
-            
             # Eliminar del historial
             history = [h for h in history if not (h.get('output_filename') == filename and h.get('type') == 'image')]
             save_history(history)
-            
-            # Limpiar cache de detecciones
-            session_id = entry.get('session_id')
-            if session_id:
-                with detections_lock:
-                    if session_id in detections_cache:
-                        del detections_cache[session_id]
+        
+        # Imagen procesada y cache de detecciones
+        remove_entry_files(entry)
         
         return jsonify({'success': True, 'message': f'Imagen {filename} eliminada correctamente'})
     
@@ -1009,176 +4687,1060 @@ def delete_video(filename):
             if not entry:
                 return jsonify({'error': 'Video no encontrado en el historial'}), 404
             
-            # Eliminar archivos
-            # 1. Video procesado
-            output_path = os.path.join(app.config['OUTPUT_FOLDER'], filename)
-            if os.path.exists(output_path):
-                os.remove(output_path)
-                print(f"Archivo eliminado: {output_path}")
-            
-            # 2. Video original (si existe)
-            original_filename = entry.get('original_filename')
-            if original_filename:
-                # Buscar en uploads con el timestamp del nombre de salida
-                timestamp = filename.replace('detected_', '').replace('.mp4', '')
-                for ext in ['.mp4', '.avi', '.mov', '.mkv', '.webm']:
-                    original_path = os.path.join(app.config['UPLOAD_FOLDER'], f"video_{timestamp}{ext}")
-                    if os.path.exists(original_path):
-                        os.remove(original_path)
-                        print(f"Archivo original eliminado: {original_path}")
-                        break
-            
-            # 3. Eliminar del historial
+            # Eliminar del historial
             history = [h for h in history if h.get('output_filename') != filename]
             save_history(history)
-            
-            # 4. Limpiar caches
-            with status_lock:
-                if filename in video_processing_status:
-                    del video_processing_status[filename]
-            
-            with frames_cache_lock:
-                if filename in video_frames_cache:
-                    del video_frames_cache[filename]
-            
-            with detections_lock:
-                if filename in detections_cache:
-                    del detections_cache[filename]
-            
-            with detections_frames_lock:
-                if filename in detections_frames_cache:
-                    del detections_frames_cache[filename]
+        
+        # Video procesado, original subido, checkpoint y caches
+        remove_entry_files(entry)
         
         return jsonify({'success': True, 'message': f'Video {filename} eliminado correctamente'})
     
     except Exception as e:
-        print(f"Error al eliminar video: {e}")
-        return jsonify({'error': f'Error al eliminar: {str(e)}'}), 500
+        print(f"Error al eliminar video: {e}")
+        return jsonify({'error': f'Error al eliminar: {str(e)}'}), 500
+
+# ==================== RETENCIÓN DE ALMACENAMIENTO ====================
+# Políticas configurables por entorno. Un barrido de baja prioridad aplica la
+# antigüedad máxima y el presupuesto de disco, conserva siempre las N entradas
+# más recientes y elimina archivos que ya no referencia el historial. Por
+# defecto no hay límites: nada del historial se borra sin configurarlo.
+
+RETENTION_MAX_AGE_DAYS = float(os.environ.get('RETENTION_MAX_AGE_DAYS', 0))  # 0 = sin límite
+RETENTION_MAX_BYTES = int(float(os.environ.get('RETENTION_MAX_GB', 0)) * 1024**3)  # 0 = sin límite
+RETENTION_KEEP_RECENT = int(os.environ.get('RETENTION_KEEP_RECENT', 0))
+RETENTION_DELETE_ORIGINALS = os.environ.get('RETENTION_DELETE_ORIGINALS', 'false').lower() in ('1', 'true', 'on')
+# Entradas completadas cuya salida falta en disco: solo se informan salvo que se active
+RETENTION_PRUNE_MISSING = os.environ.get('RETENTION_PRUNE_MISSING', 'false').lower() in ('1', 'true', 'on')
+# Archivos sin referencia en el historial: solo se informan salvo que se active
+RETENTION_DELETE_ORPHANS = os.environ.get('RETENTION_DELETE_ORPHANS', 'false').lower() in ('1', 'true', 'on')
+RETENTION_SWEEP_INTERVAL = int(os.environ.get('RETENTION_SWEEP_INTERVAL', 3600))  # 0 = desactivado
+RETENTION_ORPHAN_GRACE = 3600  # no tocar archivos sin referencia más recientes que esto
+RETENTION_THROTTLE = 0.05  # pausa entre borrados para no competir con el procesamiento
+
+retention_lock = threading.Lock()  # un solo barrido a la vez
+retention_report = {}  # resultado del último barrido
+
+
+def parse_history_timestamp(created_at):
+    """Timestamp de una entrada (videos e imágenes usan formatos distintos)"""
+    for fmt in ('%Y%m%d_%H%M%S', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.strptime(created_at, fmt).timestamp()
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def folder_size(folder):
+    total = 0
+    for root, _, files in os.walk(folder):
+        for name in files:
+            total += file_size(os.path.join(root, name))
+    return total
+
+
+def get_entry_paths(entry):
+    """Archivos en disco asociados a una entrada del historial"""
+    paths = get_thumbnail_paths(entry)
+    output_filename = entry.get('output_filename')
+    if output_filename:
+        paths.append(os.path.join(app.config['OUTPUT_FOLDER'], output_filename))
+        if entry.get('type', 'video') == 'video':
+            paths.append(get_track_path(output_filename))
+    if entry.get('input_path'):
+        paths.append(entry['input_path'])
+    elif entry.get('type', 'video') == 'video' and output_filename and 'input_path' not in entry:
+        # Entradas antiguas no guardaban la ruta del original: deducirla del timestamp
+        timestamp = output_filename.replace('detected_', '').replace('.mp4', '')
+        for ext in ['.mp4', '.avi', '.mov', '.mkv', '.webm']:
+            original_path = os.path.join(app.config['UPLOAD_FOLDER'], f"video_{timestamp}{ext}")
+            if os.path.exists(original_path):
+                paths.append(original_path)
+                break
+    return paths
+
+
+def remove_entry_files(entry):
+    """Elimina archivos, checkpoint y caches de una entrada; devuelve bytes liberados"""
+    freed = 0
+    for path in get_entry_paths(entry):
+        if os.path.exists(path):
+            size = file_size(path)
+            os.remove(path)
+            freed += size
+            print(f"Archivo eliminado: {path}")
+
+    output_filename = entry.get('output_filename')
+    if entry.get('type', 'video') == 'video':
+        remove_job_dir(output_filename)
+        with status_lock:
+            video_processing_status.pop(output_filename)
+        with detections_lock:
+            detections_cache.pop(output_filename)
+        with detections_frames_lock:
+            detections_frames_cache.pop(output_filename)
+    elif entry.get('session_id'):
+        with detections_lock:
+            detections_cache.pop(entry['session_id'])
+    return freed
+
+
+def delete_history_entries(output_filenames):
+    """Quita del historial las entradas indicadas"""
+    with history_lock:
+        history = load_history()
+        kept = [h for h in history if h.get('output_filename') not in output_filenames]
+        if len(kept) != len(history):
+            save_history(kept)
+
+
+def remove_original_upload(output_filename):
+    """Borra el video subido de un trabajo completado (política delete-originals)"""
+    entry = get_history_entry(output_filename)
+    input_path = entry.get('input_path') if entry else None
+    if input_path and os.path.exists(input_path):
+        os.remove(input_path)
+        print(f"Original eliminado tras procesar: {input_path}")
+    if entry and input_path:
+        update_history_meta(output_filename, input_path=None)
+
+
+def get_storage_usage():
+    usage = {
+        'uploads_bytes': folder_size(app.config['UPLOAD_FOLDER']),
+        'outputs_bytes': folder_size(app.config['OUTPUT_FOLDER']),
+        'jobs_bytes': folder_size(app.config['JOBS_FOLDER']),
+        'thumbnails_bytes': folder_size(app.config['THUMBNAIL_FOLDER']),
+        'tracks_bytes': folder_size(app.config['TRACKS_FOLDER'])
+    }
+    usage['total_bytes'] = sum(usage.values())
+    return usage
+
+
+def sweep_orphan_files(now, delete=False):
+    """Archivos y carpetas de trabajo que no referencia el historial: (cantidad, bytes).
+
+    Solo se eliminan con delete=True; si no, únicamente se cuentan.
+    """
+    history, _ = get_history_snapshot()
+    referenced = set()
+    entry_names = set()
+    for h in history:
+        entry_names.add(h.get('output_filename'))
+        referenced.update(os.path.abspath(p) for p in get_entry_paths(h))
+
+    removed, freed = 0, 0
+    jobs_folder = app.config['JOBS_FOLDER']
+    for job_id in os.listdir(jobs_folder):
+        output_filename = f"{job_id}.mp4"
+        checkpoint = load_checkpoint(output_filename)
+        if checkpoint and checkpoint.get('input_path'):
+            # El original de un trabajo pendiente sigue en uso
+            referenced.add(os.path.abspath(checkpoint['input_path']))
+        job_dir = os.path.join(jobs_folder, job_id)
+        if output_filename not in entry_names and now - os.path.getmtime(job_dir) > RETENTION_ORPHAN_GRACE:
+            freed += folder_size(job_dir)
+            if delete:
+                remove_job_dir(output_filename)
+            removed += 1
+
+    # Originales de subidas por partes todavía en curso
+    with upload_sessions_cond:
+        referenced.update(os.path.abspath(s.path) for s in upload_sessions.values())
+
+    for folder in (app.config['UPLOAD_FOLDER'], app.config['OUTPUT_FOLDER'],
+                   app.config['THUMBNAIL_FOLDER'], app.config['TRACKS_FOLDER']):
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if not os.path.isfile(path) or os.path.abspath(path) in referenced:
+                continue
+            if now - os.path.getmtime(path) < RETENTION_ORPHAN_GRACE:
+                continue  # puede ser una subida o una salida todavía en curso
+            size = file_size(path)
+            if not delete:
+                freed += size
+                removed += 1
+                continue
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"No se pudo eliminar huérfano {path}: {e}")
+                continue
+            freed += size
+            removed += 1
+            print(f"Archivo huérfano eliminado: {path}")
+            time.sleep(RETENTION_THROTTLE)
+    return removed, freed
+
+
+def run_retention_sweep():
+    """Aplica las políticas de retención y reconcilia el disco con el historial"""
+    with retention_lock:
+        now = time.time()
+        report = {
+            'started_at': datetime.now().isoformat(),
+            'expired': 0,
+            'over_budget': 0,
+            'missing_files': 0,
+            'orphans': 0,
+            'reclaimed_bytes': 0
+        }
+        report['stale_uploads'] = sweep_upload_sessions(now)
+
+        # Sin un historial legible no se puede saber qué está referenciado:
+        # no borrar nada en base a él
+        load_error = history_load_error()
+        if load_error:
+            report['skipped'] = f'Barrido omitido: {load_error}'
+            report['usage'] = get_storage_usage()
+            report['duration_s'] = round(time.time() - now, 2)
+            retention_report.clear()
+            retention_report.update(report)
+            print(f"Retención: {report['skipped']}")
+            return report
+
+        history, _ = get_history_snapshot()
+        entries = sorted(history, key=lambda h: parse_history_timestamp(h.get('created_at')) or now, reverse=True)
+
+        # Nunca tocar trabajos en curso ni las N entradas más recientes
+        protected = {h.get('output_filename') for h in entries[:RETENTION_KEEP_RECENT]}
+        protected.update(h.get('output_filename') for h in entries if h.get('status') == 'processing')
+
+        victims = {}
+        max_age = RETENTION_MAX_AGE_DAYS * 86400
+        for h in entries:
+            name = h.get('output_filename')
+            created = parse_history_timestamp(h.get('created_at'))
+            if name in protected or not max_age or created is None:
+                continue
+            if now - created > max_age:
+                victims[name] = h
+                report['expired'] += 1
+
+        # Presupuesto de disco: eliminar las más antiguas hasta cumplirlo
+        if RETENTION_MAX_BYTES:
+            projected = get_storage_usage()['total_bytes']
+            projected -= sum(file_size(p) for h in victims.values() for p in get_entry_paths(h))
+            for h in reversed(entries):
+                if projected <= RETENTION_MAX_BYTES:
+                    break
+                name = h.get('output_filename')
+                if name in protected or name in victims:
+                    continue
+                victims[name] = h
+                projected -= sum(file_size(p) for p in get_entry_paths(h))
+                report['over_budget'] += 1
+
+        # Entradas completadas cuya salida ya no existe en disco
+        for h in entries:
+            name = h.get('output_filename')
+            if name in victims or h.get('status', 'completed') != 'completed':
+                continue
+            if not os.path.exists(os.path.join(app.config['OUTPUT_FOLDER'], name)):
+                report['missing_files'] += 1
+                if RETENTION_PRUNE_MISSING:
+                    victims[name] = h
+
+        if victims:
+            delete_history_entries(set(victims))
+            for h in victims.values():
+                try:
+                    report['reclaimed_bytes'] += remove_entry_files(h)
+                except Exception as e:
+                    print(f"Error al eliminar archivos de {h.get('output_filename')}: {e}")
+                time.sleep(RETENTION_THROTTLE)
+
+        report['orphans'], orphan_bytes = sweep_orphan_files(now, delete=RETENTION_DELETE_ORPHANS)
+        if RETENTION_DELETE_ORPHANS:
+            report['reclaimed_bytes'] += orphan_bytes
+        else:
+            report['orphan_bytes'] = orphan_bytes
+        report['usage'] = get_storage_usage()
+        report['duration_s'] = round(time.time() - now, 2)
+
+        retention_report.clear()
+        retention_report.update(report)
+        if victims or (report['orphans'] and RETENTION_DELETE_ORPHANS):
+            print(f"Retención: {len(victims)} entradas y {report['orphans']} huérfanos eliminados, "
+                  f"{report['reclaimed_bytes'] / 1024**2:.1f} MB recuperados")
+        return report
+
+
+def retention_sweeper_loop():
+    """Hilo de fondo que ejecuta el barrido de retención periódicamente"""
+    while True:
+        time.sleep(RETENTION_SWEEP_INTERVAL)
+        try:
+            run_retention_sweep()
+        except Exception as e:
+            print(f"Error en barrido de retención: {e}")
+
+
+def start_retention_sweeper():
+    if RETENTION_SWEEP_INTERVAL > 0:
+        threading.Thread(target=retention_sweeper_loop, daemon=True, name='retention-sweeper').start()
+
+
+@app.route('/storage_status')
+def storage_status():
+    """Uso de disco, políticas de retención y resultado del último barrido"""
+    return jsonify({
+        'usage': get_storage_usage(),
+        'policy': {
+            'max_age_days': RETENTION_MAX_AGE_DAYS,
+            'max_bytes': RETENTION_MAX_BYTES,
+            'keep_recent': RETENTION_KEEP_RECENT,
+            'delete_originals': RETENTION_DELETE_ORIGINALS,
+            'prune_missing': RETENTION_PRUNE_MISSING,
+            'delete_orphans': RETENTION_DELETE_ORPHANS,
+            'sweep_interval': RETENTION_SWEEP_INTERVAL
+        },
+        'last_sweep': retention_report or None
+    })
+
+
+@app.route('/storage_gc', methods=['POST'])
+def storage_gc():
+    """Ejecuta un barrido de retención inmediato"""
+    try:
+        return jsonify(run_retention_sweep())
+    except Exception as e:
+        print(f"Error en barrido de retención: {e}")
+        return jsonify({'error': f'Error al liberar espacio: {str(e)}'}), 500
+
+@app.route('/get_detections/<session_id>')
+def get_detections(session_id):
+    """Obtener detecciones actuales para una sesión"""
+    # Permite pedir por frame (para videos procesados)
+    frame_query = request.args.get('frame', type=int)
+    
+    # Para videos procesados con frame específico, buscar primero en frames_cache
+    if session_id != 'realtime' and frame_query is not None:
+        with detections_frames_lock:
+            frames_list = detections_frames_cache.get(session_id)
+            if frames_list:
+                # Buscar el frame más cercano
+                nearest = min(frames_list, key=lambda x: abs(x.frame - frame_query))
+                return detections_jsonify(nearest.to_dict())
+        
+        # Fallback: buscar en historial (para videos cargados después de reiniciar)
+        entry = get_history_entry(session_id)
+        if entry and entry.get('frames_detections'):
+            frames_list = entry['frames_detections']
+            if frames_list:
+                nearest = min(frames_list, key=lambda x: abs(x['frame'] - frame_query))
+                return detections_jsonify({
+                    'detections': nearest['detections'],
+                    'width': nearest['width'],
+                    'height': nearest['height'],
+                    'frame': nearest['frame']
+                })
+    
+    # Buscar en cache general
+    with detections_lock:
+        cache_data = detections_cache.get(session_id)
+        if cache_data:
+            # Para sesiones de video procesado, mantener disponibilidad más tiempo
+            max_age = 3600 if session_id != 'realtime' else 5
+            if time.time() - cache_data['timestamp'] < max_age:
+                payload = {
+                    'detections': cache_data['detections'],
+                    'width': cache_data['width'],
+                    'height': cache_data['height']
+                }
+                if cache_data.get('model_variant'):
+                    payload['model_variant'] = cache_data['model_variant']
+                return detections_jsonify(payload)
+    
+    # Fallback a historial si el servidor se reinició
+    if session_id != 'realtime':
+        entry = get_history_entry(session_id)
+        if entry and entry.get('detections'):
+            return detections_jsonify({
+                'detections': entry.get('detections', []),
+                'width': entry.get('width', 0),
+                'height': entry.get('height', 0)
+            })
+    
+    return detections_jsonify({'detections': [], 'width': 0, 'height': 0})
+
+@app.route('/get_animal_description', methods=['POST'])
+def get_animal_description():
+    """Obtener descripción PLN de un animal"""
+    data = request.json
+    animal_name = data.get('animal', '').lower()
+    
+    if not animal_name:
+        return jsonify({'error': 'Nombre de animal no proporcionado'}), 400
+    
+    # Buscar descripción en base de conocimiento
+    if animal_name in ANIMAL_DESCRIPTIONS:
+        description = ANIMAL_DESCRIPTIONS[animal_name]
+        return jsonify({
+            'animal': animal_name,
+            'description': description,
+            'found': True
+        })
+    
+    # Si no se encuentra, generar descripción básica usando PLN
+    # Aquí podrías integrar un modelo de lenguaje o API
+    return jsonify({
+        'animal': animal_name,
+        'description': {
+            'nombre_cientifico': 'Información no disponible',
+            'descripcion': f'El {animal_name} es un animal andino detectado en la región. Para obtener más información específica, consulta fuentes especializadas en fauna andina.',
+            'habitat': 'Regiones andinas',
+            'caracteristicas': ['Animal andino', 'Adaptado a altitud'],
+            'usos': 'Variados según la especie'
+        },
+        'found': False
+    })
+
+
+# ==================== CONFIGURACIÓN API PERPLEXITY ====================
+# IMPORTANTE: Coloca aquí tu clave API de Perplexity
+# Puedes obtenerla en: https://www.perplexity.ai/settings/api
+PERPLEXITY_API_KEY = "wa"  # <-- Reemplaza con tu clave API
+
+PERPLEXITY_API_URL = os.environ.get('PERPLEXITY_API_URL', 'https://api.perplexity.ai/chat/completions')
+PERPLEXITY_MODEL = 'sonar'
+CHATBOT_MAX_CONCURRENCY = int(os.environ.get('CHATBOT_MAX_CONCURRENCY', 4))
+CHATBOT_TIMEOUT = (5, 30)  # (conexión, lectura) en segundos
+CHATBOT_MAX_ANSWER_LENGTH = 2000
+
+# ==================== CLIENTE DEL CHATBOT ====================
+# Una sesión HTTP compartida reutiliza las conexiones TLS con la API y un
+# semáforo limita las consultas simultáneas. En modo streaming los tokens se
+# reenvían al navegador por SSE a medida que llegan.
+
+_chatbot_session = None
+_chatbot_session_lock = threading.Lock()
+_chatbot_slots = threading.BoundedSemaphore(CHATBOT_MAX_CONCURRENCY)
+
+
+class ChatbotUpstreamError(Exception):
+    """Error de la API del chatbot con el código HTTP a devolver al cliente"""
+
+    def __init__(self, message, status_code=502, detail=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def get_chatbot_session():
+    """Sesión con pool de conexiones keep-alive hacia la API"""
+    global _chatbot_session
+    with _chatbot_session_lock:
+        if _chatbot_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=CHATBOT_MAX_CONCURRENCY)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _chatbot_session = session
+        return _chatbot_session
+
+
+def acquire_chatbot_slot():
+    if not _chatbot_slots.acquire(timeout=10):
+        raise ChatbotUpstreamError('Demasiadas consultas simultáneas al chatbot, intenta de nuevo', 503)
+
+
+def post_to_perplexity(messages, api_key, stream=False):
+    """Envía la consulta por la sesión compartida (llamar con un slot tomado)"""
+    payload = {
+        "model": PERPLEXITY_MODEL,
+        "messages": messages
+    }
+    if stream:
+        payload['stream'] = True
+    
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+    
+    try:
+        resp = get_chatbot_session().post(
+            PERPLEXITY_API_URL,
+            json=payload,
+            headers=headers,
+            timeout=CHATBOT_TIMEOUT,
+            stream=stream
+        )
+    except requests.exceptions.Timeout:
+        raise ChatbotUpstreamError('Timeout - La API de Perplexity tardó demasiado en responder', 504)
+    except requests.exceptions.ConnectionError:
+        raise ChatbotUpstreamError('Error de conexión - No se pudo conectar con la API de Perplexity', 503)
+    
+    if resp.status_code != 200:
+        error_detail = resp.text[:500] if resp.text else 'Sin detalles'
+        resp.close()
+        raise ChatbotUpstreamError(f'Error de API Perplexity ({resp.status_code})', 502, error_detail)
+    return resp
+
+
+def clean_chatbot_text(content):
+    """Limpia el formato markdown de una respuesta del chatbot"""
+    # Eliminar negritas ** y __
+    content = re.sub(r'\*\*(.+?)\*\*', r'\1', content)
+    content = re.sub(r'__(.+?)__', r'\1', content)
+    # Eliminar cursivas * y _
+    content = re.sub(r'\*(.+?)\*', r'\1', content)
+    content = re.sub(r'_(.+?)_', r'\1', content)
+    # Eliminar encabezados #
+    content = re.sub(r'^#+\s*', '', content, flags=re.MULTILINE)
+    # Eliminar listas con viñetas
+    content = re.sub(r'^\s*[-*•]\s+', '• ', content, flags=re.MULTILINE)
+    # Eliminar bloques de código
+    content = re.sub(r'```[\s\S]*?```', '', content)
+    content = re.sub(r'`(.+?)`', r'\1', content)
+    return content
+
+
+class StreamingMarkdownCleaner:
+    """Aplica clean_chatbot_text de forma incremental sobre un flujo de tokens.
+
+    Solo se emite texto hasta el último espacio y cuando los marcadores
+    (**, *, _, `) están cerrados; si un marcador queda abierto demasiado
+    tiempo se emite igualmente para no frenar el streaming.
+    """
+
+    MAX_PENDING = 300
+
+    def __init__(self, max_length=CHATBOT_MAX_ANSWER_LENGTH):
+        self.pending = ''
+        self.at_line_start = True
+        self.emitted = 0
+        self.max_length = max_length
+
+    @staticmethod
+    def _markers_closed(text):
+        text = re.sub(r'^\s*[-*•]\s+', '', text, flags=re.MULTILINE)  # viñetas
+        if text.count('```') % 2:
+            return False
+        text = text.replace('```', '')
+        return all(text.count(marker) % 2 == 0 for marker in ('`', '*', '_'))
+
+    def feed(self, chunk):
+        self.pending += chunk
+        cut = max(self.pending.rfind(' '), self.pending.rfind('\n')) + 1
+        if cut <= 0:
+            return ''
+        head = self.pending[:cut]
+        if not self._markers_closed(head) and len(self.pending) < self.MAX_PENDING:
+            return ''
+        self.pending = self.pending[cut:]
+        return self._emit(head)
+
+    def flush(self):
+        head, self.pending = self.pending, ''
+        return self._emit(head)
+
+    def _emit(self, text):
+        if not text or self.emitted >= self.max_length:
+            return ''
+        if self.emitted == 0:
+            text = text.lstrip()
+        # Un marcador ficticio evita que ^ coincida en mitad de una línea
+        prefix = '' if self.at_line_start else '\x00'
+        cleaned = clean_chatbot_text(prefix + text)[len(prefix):]
+        self.at_line_start = text.endswith('\n')
+        cleaned = cleaned[:self.max_length - self.emitted]
+        self.emitted += len(cleaned)
+        return cleaned
+
+
+def stream_perplexity(messages, api_key):
+    """Genera los fragmentos de texto (sin limpiar) que envía la API en streaming"""
+    acquire_chatbot_slot()
+    try:
+        resp = post_to_perplexity(messages, api_key, stream=True)
+        with resp:
+            resp.encoding = resp.encoding or 'utf-8'
+            for line in resp.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'):
+                    continue
+                data = line[5:].strip()
+                if data == '[DONE]':
+                    break
+                try:
+                    chunk = json.loads(data)
+                except ValueError:
+                    continue
+                choice = (chunk.get('choices') or [{}])[0]
+                delta = (choice.get('delta') or {}).get('content')
+                if delta:
+                    yield delta
+    except requests.exceptions.RequestException as e:
+        raise ChatbotUpstreamError(f'Error de conexión con la API de Perplexity: {e}', 503)
+    finally:
+        _chatbot_slots.release()
+
+
+def sse_event(data, event=None):
+    """Serializa un evento Server-Sent Events"""
+    payload = json.dumps(data, ensure_ascii=False)
+    return f"event: {event}\ndata: {payload}\n\n" if event else f"data: {payload}\n\n"
+
+
+def sse_response(events):
+    return Response(events, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 1)
+
+
+def chatbot_answer_response(answer, stream, **info):
+    """Respuesta ya conocida (local o en cache), en JSON o como SSE"""
+    body = dict(answer=answer, **info)
+    if stream:
+        return sse_response(iter([sse_event({'delta': answer}), sse_event(body, 'done')]))
+    return jsonify(body)
+
+
+# ==================== CACHE DEL CHATBOT ====================
+# Las preguntas sobre cada animal se repiten mucho: las respuestas se guardan
+# por animal + pregunta normalizada en memoria (LRU con TTL) y en disco, y las
+# preguntas idénticas simultáneas comparten una sola llamada a la API.
+
+CHATBOT_CACHE_FILE = 'chatbot_cache.json'
+CHATBOT_CACHE_TTL = int(os.environ.get('CHATBOT_CACHE_TTL_HOURS', 7 * 24)) * 3600
+CHATBOT_CACHE_MAX_ENTRIES = int(os.environ.get('CHATBOT_CACHE_MAX_ENTRIES', 5000))
+
+chatbot_cache = BoundedCache('chatbot', 4 * 1024 * 1024, ttl=CHATBOT_CACHE_TTL, manager=cache_manager)
+_chatbot_disk = {'loaded': False, 'entries': {}}
+_chatbot_disk_lock = threading.Lock()
+_chatbot_inflight = {}  # {clave: {'event': Event, 'answer': ..., 'error': ...}}
+_chatbot_inflight_lock = threading.Lock()
+
+
+def normalize_question(text):
+    """Minúsculas, sin tildes, sin puntuación y con espacios simples"""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(c for c in text if not unicodedata.combining(c)).casefold()
+    text = re.sub(r'[^\w\s]', ' ', text)
+    return ' '.join(text.split())
+
+
+def get_chatbot_cache_key(animal, question):
+    raw = f"{PERPLEXITY_MODEL}|{normalize_question(animal)}|{normalize_question(question)}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def _load_chatbot_disk():
+    """Carga perezosa de la cache persistente (llamar con _chatbot_disk_lock)"""
+    if _chatbot_disk['loaded']:
+        return _chatbot_disk['entries']
+    entries = {}
+    if os.path.exists(CHATBOT_CACHE_FILE):
+        try:
+            with open(CHATBOT_CACHE_FILE, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except Exception as e:
+            print(f"Error al cargar cache del chatbot: {e}")
+    _chatbot_disk['entries'] = entries
+    _chatbot_disk['loaded'] = True
+    return entries
+
+
+def get_cached_answer(key):
+    """Busca la respuesta en memoria y luego en disco"""
+    answer = chatbot_cache.get(key)
+    if answer is not None:
+        return answer
+    with _chatbot_disk_lock:
+        item = _load_chatbot_disk().get(key)
+    if item and time.time() - item.get('created_at', 0) < CHATBOT_CACHE_TTL:
+        chatbot_cache[key] = item['answer']
+        return item['answer']
+    return None
+
+
+def store_cached_answer(key, animal, question, answer):
+    chatbot_cache[key] = answer
+    with _chatbot_disk_lock:
+        entries = _load_chatbot_disk()
+        now = time.time()
+        entries[key] = {'animal': animal, 'question': question, 'answer': answer, 'created_at': now}
+        # Purgar expiradas y limitar tamaño conservando las más recientes
+        expired = [k for k, v in entries.items() if now - v.get('created_at', 0) >= CHATBOT_CACHE_TTL]
+        for k in expired:
+            del entries[k]
+        if len(entries) > CHATBOT_CACHE_MAX_ENTRIES:
+            newest = sorted(entries.items(), key=lambda kv: kv[1].get('created_at', 0), reverse=True)
+            entries = dict(newest[:CHATBOT_CACHE_MAX_ENTRIES])
+            _chatbot_disk['entries'] = entries
+        try:
+            tmp_path = CHATBOT_CACHE_FILE + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entries, f, ensure_ascii=False)
+            os.replace(tmp_path, CHATBOT_CACHE_FILE)
+        except Exception as e:
+            print(f"Error al guardar cache del chatbot: {e}")
+
+
+def begin_chatbot_flight(key):
+    """Registra una consulta en curso; devuelve (flight, es_líder)"""
+    with _chatbot_inflight_lock:
+        flight = _chatbot_inflight.get(key)
+        if flight is not None:
+            return flight, False
+        flight = {'event': threading.Event(), 'answer': None, 'error': None}
+        _chatbot_inflight[key] = flight
+        return flight, True
+
+
+def finish_chatbot_flight(key, flight, answer=None, error=None):
+    if flight['event'].is_set():
+        return
+    flight['answer'] = answer
+    flight['error'] = error
+    with _chatbot_inflight_lock:
+        _chatbot_inflight.pop(key, None)
+    flight['event'].set()
+
+
+def wait_chatbot_flight(flight):
+    if not flight['event'].wait(timeout=60):
+        raise ChatbotUpstreamError('Timeout - La API de Perplexity tardó demasiado en responder', 504)
+    if flight['error'] is not None:
+        raise flight['error']
+    return flight['answer']
+
+
+def get_answer_coalesced(key, compute):
+    """Ejecuta compute() una sola vez por clave aunque lleguen varias
+    peticiones iguales a la vez; las demás esperan el mismo resultado"""
+    flight, leader = begin_chatbot_flight(key)
+    if not leader:
+        return wait_chatbot_flight(flight)
+
+    try:
+        answer = compute()
+    except Exception as e:
+        finish_chatbot_flight(key, flight, error=e)
+        raise
+    finish_chatbot_flight(key, flight, answer=answer)
+    return answer
 
-@app.route('/get_detections/<session_id>')
-def get_detections(session_id):
-    """Obtener detecciones actuales para una sesión"""
-    # Permite pedir por frame (para videos procesados)
-    frame_query = request.args.get('frame', type=int)
-    
-    # Para videos procesados con frame específico, buscar primero en frames_cache
-    if session_id != 'realtime' and frame_query is not None:
-        with detections_frames_lock:
-            frames_list = detections_frames_cache.get(session_id, [])
-            if frames_list:
-                # Buscar el frame más cercano
-                nearest = min(frames_list, key=lambda x: abs(x['frame'] - frame_query))
-                return jsonify({
-                    'detections': nearest['detections'],
-                    'width': nearest['width'],
-                    'height': nearest['height'],
-                    'frame': nearest['frame']
-                })
+
+def ask_perplexity(messages, api_key, animal):
+    """Llama a la API y devuelve la respuesta ya limpia de markdown"""
+    acquire_chatbot_slot()
+    try:
+        resp = post_to_perplexity(messages, api_key)
         
-        # Fallback: buscar en historial (para videos cargados después de reiniciar)
-        entry = get_history_entry(session_id)
-        if entry and entry.get('frames_detections'):
-            frames_list = entry['frames_detections']
-            if frames_list:
-                nearest = min(frames_list, key=lambda x: abs(x['frame'] - frame_query))
-                return jsonify({
-                    'detections': nearest['detections'],
-                    'width': nearest['width'],
-                    'height': nearest['height'],
-                    'frame': nearest['frame']
-                })
+        # Debug: imprimir respuesta en consola
+        print(f"[Chatbot] Status: {resp.status_code}")
+        print(f"[Chatbot] Animal: {animal}")
+        print(f"[Chatbot] Response: {resp.text[:500]}")
+        
+        response_data = resp.json()
+    finally:
+        _chatbot_slots.release()
     
-    # Buscar en cache general
-    with detections_lock:
-        if session_id in detections_cache:
-            cache_data = detections_cache[session_id]
-            # Para sesiones de video procesado, mantener disponibilidad más tiempo
-            max_age = 3600 if session_id != 'realtime' else 5
-            if time.time() - cache_data['timestamp'] < max_age:
-                return jsonify({
-                    'detections': cache_data['detections'],
-                    'width': cache_data['width'],
-                    'height': cache_data['height']
-                })
+    content = response_data.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
+    if not content:
+        return ''
     
-    # Fallback a historial si el servidor se reinició
-    if session_id != 'realtime':
-        entry = get_history_entry(session_id)
-        if entry and entry.get('detections'):
-            return jsonify({
-                'detections': entry.get('detections', []),
-                'width': entry.get('width', 0),
-                'height': entry.get('height', 0)
+    # Limitar longitud de respuesta
+    return clean_chatbot_text(content)[:CHATBOT_MAX_ANSWER_LENGTH]
+
+
+def stream_chatbot_answer(cache_key, messages, api_key, animal, question, started, fallback=None):
+    """Generador SSE: reenvía los tokens limpios y al final la respuesta completa.
+
+    Si la API no está disponible y no se emitió nada se envía `fallback`
+    (la mejor coincidencia local) en su lugar.
+    """
+    def fallback_events(error):
+        if fallback is None or error.status_code not in (503, 504):
+            return [sse_event({'error': str(error), 'detail': error.detail}, 'error')]
+        return [sse_event({'delta': fallback['answer']}),
+                sse_event({'answer': fallback['answer'], 'cached': False, 'source': 'local_fallback',
+                           'score': fallback['score'], 'latency_ms': elapsed_ms(started)}, 'done')]
+
+    flight, leader = begin_chatbot_flight(cache_key)
+    if not leader:
+        # Otra petición idéntica ya está consultando: esperar su respuesta
+        try:
+            answer = wait_chatbot_flight(flight) or 'No se recibió respuesta de Perplexity.'
+        except ChatbotUpstreamError as e:
+            yield from fallback_events(e)
+            return
+        yield sse_event({'delta': answer})
+        yield sse_event({'answer': answer, 'cached': True, 'source': 'cache', 'latency_ms': elapsed_ms(started)}, 'done')
+        return
+
+    cleaner = StreamingMarkdownCleaner()
+    parts = []
+    try:
+        for chunk in stream_perplexity(messages, api_key):
+            text = cleaner.feed(chunk)
+            if text:
+                parts.append(text)
+                yield sse_event({'delta': text})
+        text = cleaner.flush()
+        if text:
+            parts.append(text)
+            yield sse_event({'delta': text})
+
+        answer = ''.join(parts).strip()
+        finish_chatbot_flight(cache_key, flight, answer=answer)
+        if answer:
+            store_cached_answer(cache_key, animal, question, answer)
+        else:
+            # Las respuestas vacías no se cachean
+            answer = 'No se recibió respuesta de Perplexity.'
+            yield sse_event({'delta': answer})
+        print(f"[Chatbot] Streaming completado ({len(answer)} caracteres) - Animal: {animal}")
+        yield sse_event({'answer': answer, 'cached': False, 'source': 'remote', 'latency_ms': elapsed_ms(started)}, 'done')
+    except ChatbotUpstreamError as e:
+        finish_chatbot_flight(cache_key, flight, error=e)
+        if parts:
+            yield sse_event({'error': str(e), 'detail': e.detail}, 'error')
+        else:
+            yield from fallback_events(e)
+    except Exception as e:
+        print(f"[Chatbot] Error: {str(e)}")
+        finish_chatbot_flight(cache_key, flight, error=ChatbotUpstreamError(f'Error en chatbot: {str(e)}', 500))
+        yield sse_event({'error': f'Error en chatbot: {str(e)}'}, 'error')
+    finally:
+        # Cliente desconectado a mitad del streaming: liberar a los que esperan
+        finish_chatbot_flight(cache_key, flight, error=ChatbotUpstreamError('Consulta cancelada', 503))
+
+
+# ==================== RESPUESTAS LOCALES (BM25) ====================
+# Índice BM25 precalculado sobre ANIMAL_DESCRIPTIONS y un corpus de preguntas
+# frecuentes por especie. Las coincidencias con puntaje suficiente se responden
+# sin red; si la API no está disponible se usa la mejor coincidencia local.
+
+CHATBOT_LOCAL_MIN_SCORE = float(os.environ.get('CHATBOT_LOCAL_MIN_SCORE', 1.5))
+CHATBOT_LOCAL_MIN_COVERAGE = 0.6  # fracción (ponderada por IDF) de la pregunta cubierta
+ANIMAL_FAQ_FILE = 'animal_faq.json'  # preguntas frecuentes adicionales (opcional)
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+SPANISH_STOPWORDS = {
+    'a', 'al', 'como', 'con', 'cual', 'cuales', 'de', 'del', 'el', 'en', 'es', 'esta', 'este', 'la', 'las',
+    'lo', 'los', 'me', 'mi', 'para', 'por', 'que', 'se', 'su', 'sus', 'un', 'una', 'unos', 'unas', 'y', 'o',
+    'son', 'hay', 'tiene', 'tienen', 'sobre', 'puedes', 'puede', 'dime', 'quiero', 'saber'
+}
+
+ANIMAL_ARTICLES = {'cuy': 'el'}  # el resto de especies usa "la"
+
+# Preguntas frecuentes por especie: {'preguntas': [...], 'respuesta': ...}
+ANIMAL_FAQ = {
+    'alpaca': [
+        {'preguntas': ['¿De qué se alimenta la alpaca?', '¿Qué come la alpaca?'],
+         'respuesta': 'La alpaca es herbívora y se alimenta principalmente de pastos naturales de las praderas altoandinas.'},
+        {'preguntas': ['¿Cuál es la diferencia entre la alpaca y la llama?'],
+         'respuesta': 'La alpaca es más pequeña que la llama, tiene orejas puntiagudas y una lana más fina; la llama es más grande, de orejas largas y curvas, y se usa como animal de carga.'}
+    ],
+    'llama': [
+        {'preguntas': ['¿Cuánto peso puede cargar una llama?', '¿La llama es animal de carga?'],
+         'respuesta': 'La llama se usa como animal de carga y puede transportar alrededor de un cuarto de su peso corporal en largas distancias.'},
+        {'preguntas': ['¿De qué se alimenta la llama?', '¿Qué come la llama?'],
+         'respuesta': 'La llama es herbívora y se alimenta de pastos, hierbas y arbustos del altiplano.'}
+    ],
+    'cuy': [
+        {'preguntas': ['¿De qué se alimenta el cuy?', '¿Qué come el cuy?'],
+         'respuesta': 'El cuy es herbívoro: come pasto, alfalfa, hojas y restos de vegetales, y necesita vitamina C en su dieta.'}
+    ],
+    'oveja': [
+        {'preguntas': ['¿De qué se alimenta la oveja?', '¿Qué come la oveja?'],
+         'respuesta': 'La oveja es un rumiante herbívoro que se alimenta de pastos y forrajes.'}
+    ],
+    'vaca': [
+        {'preguntas': ['¿De qué se alimenta la vaca?', '¿Qué come la vaca?'],
+         'respuesta': 'La vaca es un rumiante herbívoro que se alimenta de pastos, forrajes y ensilado.'},
+        {'preguntas': ['¿Cuánta leche produce una vaca?'],
+         'respuesta': 'En la ganadería andina una vaca criolla suele producir entre 3 y 8 litros de leche al día, según la raza y la alimentación.'}
+    ]
+}
+
+
+def tokenize_for_search(text):
+    """Tokens normalizados sin stopwords y con stemming ligero por prefijo"""
+    return [t[:6] for t in normalize_question(text).split() if t not in SPANISH_STOPWORDS and len(t) > 1]
+
+
+def build_animal_documents():
+    """Documentos indexables (texto de búsqueda + respuesta) por especie"""
+    faq = {k: list(v) for k, v in ANIMAL_FAQ.items()}
+    if os.path.exists(ANIMAL_FAQ_FILE):
+        try:
+            with open(ANIMAL_FAQ_FILE, 'r', encoding='utf-8') as f:
+                for animal, items in json.load(f).items():
+                    faq.setdefault(animal.lower(), []).extend(items)
+        except Exception as e:
+            print(f"Error al cargar {ANIMAL_FAQ_FILE}: {e}")
+
+    documents = []
+    for animal, info in ANIMAL_DESCRIPTIONS.items():
+        name = f"del {animal}" if ANIMAL_ARTICLES.get(animal) == 'el' else f"de la {animal}"
+        fields = [
+            ('nombre_cientifico', 'nombre científico especie científicamente taxonomía',
+             f"El nombre científico {name} es {info['nombre_cientifico']}."),
+            ('habitat', 'hábitat dónde vive habita encuentra región altitud zona',
+             f"Hábitat {name}: {info['habitat']}."),
+            ('usos', 'usos para qué sirve utiliza aprovecha produce beneficio',
+             f"Usos {name}: {info['usos']}."),
+            ('caracteristicas', 'características cómo es físicamente apariencia rasgos aspecto',
+             f"Características {name}: {', '.join(info['caracteristicas'])}."),
+            ('descripcion', 'qué es descripción describe información general',
+             info['descripcion'])
+        ]
+        for field, keywords, answer in fields:
+            documents.append({'animal': animal, 'source': field, 'text': f"{keywords} {answer}", 'answer': answer})
+        # Cada oración de la descripción responde preguntas puntuales
+        for sentence in re.split(r'(?<=\.)\s+', info['descripcion']):
+            if sentence:
+                documents.append({'animal': animal, 'source': 'descripcion', 'text': sentence, 'answer': sentence})
+        for item in faq.get(animal, []):
+            answer = item['respuesta']
+            documents.append({
+                'animal': animal,
+                'source': 'faq',
+                'text': ' '.join(item.get('preguntas', [])) + ' ' + answer,
+                'answer': answer
             })
-    
-    return jsonify({'detections': [], 'width': 0, 'height': 0})
+    return documents
 
-@app.route('/get_animal_description', methods=['POST'])
-def get_animal_description():
-    """Obtener descripción PLN de un animal"""
-    data = request.json
-    animal_name = data.get('animal', '').lower()
-    
-    if not animal_name:
-        return jsonify({'error': 'Nombre de animal no proporcionado'}), 400
-    
-    # Buscar descripción en base de conocimiento
-    if animal_name in ANIMAL_DESCRIPTIONS:
-        description = ANIMAL_DESCRIPTIONS[animal_name]
-        return jsonify({
-            'animal': animal_name,
-            'description': description,
-            'found': True
-        })
-    
-    # Si no se encuentra, generar descripción básica usando PLN
-    # Aquí podrías integrar un modelo de lenguaje o API
-    return jsonify({
-        'animal': animal_name,
-        'description': {
-            'nombre_cientifico': 'Información no disponible',
-            'descripcion': f'El {animal_name} es un animal andino detectado en la región. Para obtener más información específica, consulta fuentes especializadas en fauna andina.',
-            'habitat': 'Regiones andinas',
-            'caracteristicas': ['Animal andino', 'Adaptado a altitud'],
-            'usos': 'Variados según la especie'
-        },
-        'found': False
-    })
 
+class BM25Index:
+    """Índice BM25 en memoria con los términos precalculados"""
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.doc_terms = []
+        self.doc_lengths = []
+        doc_freq = {}
+        for doc in documents:
+            terms = {}
+            tokens = tokenize_for_search(doc['text'])
+            for token in tokens:
+                terms[token] = terms.get(token, 0) + 1
+            for token in terms:
+                doc_freq[token] = doc_freq.get(token, 0) + 1
+            self.doc_terms.append(terms)
+            self.doc_lengths.append(len(tokens))
+        n = len(documents)
+        self.avg_length = (sum(self.doc_lengths) / n) if n else 0
+        self.idf = {t: math.log(1 + (n - df + 0.5) / (df + 0.5)) for t, df in doc_freq.items()}
+        self.max_idf = max(self.idf.values(), default=1.0)
+
+    def search(self, query, animal=None):
+        """Devuelve (puntaje, cobertura, documento) ordenados por puntaje.
+
+        La cobertura es la fracción del peso IDF de la pregunta que aparece
+        en el documento; los términos desconocidos cuentan con el IDF máximo.
+        """
+        tokens = tokenize_for_search(query)
+        query_weight = sum(self.idf.get(t, self.max_idf) for t in tokens)
+        results = []
+        for i, doc in enumerate(self.documents):
+            if animal and doc['animal'] != animal:
+                continue
+            terms = self.doc_terms[i]
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[i] / self.avg_length)
+            score, matched = 0.0, 0.0
+            for token in tokens:
+                tf = terms.get(token)
+                if tf:
+                    score += self.idf[token] * tf * (BM25_K1 + 1) / (tf + norm)
+                    matched += self.idf[token]
+            if score > 0:
+                results.append((score, matched / query_weight, doc))
+        results.sort(key=lambda r: r[0], reverse=True)
+        return results
+
+
+animal_knowledge_index = BM25Index(build_animal_documents())
+
+
+def answer_locally(animal, question):
+    """Mejor coincidencia local: {'answer', 'score', 'coverage', 'field', 'confident'} o None"""
+    animal_key = normalize_question(animal)
+    question = re.sub(rf'\b{re.escape(animal_key)}\b', ' ', normalize_question(question))
+    results = animal_knowledge_index.search(question, animal=animal_key)
+    if not results:
+        return None
+    score, coverage, doc = results[0]
+    return {
+        'answer': doc['answer'],
+        'score': round(score, 2),
+        'coverage': round(coverage, 2),
+        'field': doc['source'],
+        'confident': score >= CHATBOT_LOCAL_MIN_SCORE and coverage >= CHATBOT_LOCAL_MIN_COVERAGE
+    }
 
-# ==================== CONFIGURACIÓN API PERPLEXITY ====================
-# IMPORTANTE: Coloca aquí tu clave API de Perplexity
-# Puedes obtenerla en: https://www.perplexity.ai/settings/api
-PERPLEXITY_API_KEY = "wa"  # <-- Reemplaza con tu clave API
 
 @app.route('/chatbot', methods=['POST'])
 def chatbot():
-    """Chat usando API de Perplexity enfocado en el animal detectado"""
-    import re
-    
+    """Chat usando API de Perplexity enfocado en el animal detectado.
+
+    Con {"stream": true} o Accept: text/event-stream la respuesta se envía
+    como SSE: eventos con {"delta"} y un evento final "done" con {"answer"}.
+    Toda respuesta indica su origen (source: local, cache, remote o
+    local_fallback) y la latencia en el servidor (latency_ms).
+    """
+    started = time.perf_counter()
     data = request.json or {}
     question = (data.get('question') or data.get('message') or '').strip()
     animal = (data.get('animal') or '').strip()  # Animal seleccionado    
+    stream = bool(data.get('stream')) or request.accept_mimetypes.best == 'text/event-stream'
     if not question:
         return jsonify({'error': 'Pregunta vacía'}), 400
 
+    if not animal:
+        # Sin animal seleccionado, no responder
+        return jsonify({
+            'answer': 'No hay un animal seleccionado. Por favor, haz clic sobre un animal detectado para poder consultar información sobre él.'
+        })
+
+    # Preguntas que responde la base de conocimiento local: sin red
+    local_match = answer_locally(animal, question)
+    if local_match and local_match['confident']:
+        return chatbot_answer_response(local_match['answer'], stream, cached=False, source='local',
+                                       score=local_match['score'], latency_ms=elapsed_ms(started))
+
+    # Respuestas repetidas se sirven desde cache sin consultar la API
+    cache_key = get_chatbot_cache_key(animal, question)
+    answer = get_cached_answer(cache_key)
+    if answer is not None:
+        return chatbot_answer_response(answer, stream, cached=True, source='cache', latency_ms=elapsed_ms(started))
+
     # Usar la clave API definida arriba o variable de entorno como fallback
     api_key = PERPLEXITY_API_KEY if PERPLEXITY_API_KEY and not PERPLEXITY_API_KEY.startswith("pplx-XXX") else os.getenv('SONAR_API_KEY', '')
     
     if not api_key or api_key.startswith("pplx-XXX"):
+        if local_match:
+            # Sin API disponible: la mejor coincidencia local es mejor que nada
+            return chatbot_answer_response(local_match['answer'], stream, cached=False, source='local_fallback',
+                                           score=local_match['score'], latency_ms=elapsed_ms(started))
         return jsonify({
             'error': 'API key no configurada',
             'detail': 'Por favor configura tu clave API de Perplexity en la variable PERPLEXITY_API_KEY en app.py'
         }), 500
 
     try:
-        # Crear prompt contextualizado al animal si está seleccionado
-        if animal:
-            # Obtener descripción local del animal si existe
-            animal_lower = animal.lower()
-            animal_info = ANIMAL_DESCRIPTIONS.get(animal_lower, {})
-            
-            system_context = f"""Eres un experto en fauna andina. El usuario está consultando sobre el animal "{animal}" que fue detectado en una imagen/video.
+        # Crear prompt contextualizado al animal seleccionado
+        # Obtener descripción local del animal si existe
+        animal_lower = animal.lower()
+        animal_info = ANIMAL_DESCRIPTIONS.get(animal_lower, {})
+        
+        system_context = f"""Eres un experto en fauna andina. El usuario está consultando sobre el animal "{animal}" que fue detectado en una imagen/video.
             
 Información básica del animal:
 - Nombre científico: {animal_info.get('nombre_cientifico', 'No especificado')}
@@ -1186,76 +5748,36 @@ Información básica del animal:
 
 IMPORTANTE: Responde de forma MUY BREVE y concisa (máximo 2-3 oraciones). En español. NO uses formato markdown, asteriscos ni negritas. Texto plano solamente."""
 
-            messages = [
-                {"role": "system", "content": system_context},
-                {"role": "user", "content": question}
-            ]
-        else:
-            # Sin animal seleccionado, no responder
-            return jsonify({
-                'answer': 'No hay un animal seleccionado. Por favor, haz clic sobre un animal detectado para poder consultar información sobre él.'
-            })
-        
-        # Configuración de la API
-        payload = {
-            "model": "sonar",
-            "messages": messages
-        }
-        
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        resp = requests.post(
-            "https://api.perplexity.ai/chat/completions",
-            json=payload,
-            headers=headers,
-            timeout=30
-        )
-        
-        # Debug: imprimir respuesta en consola
-        print(f"[Chatbot] Status: {resp.status_code}")
-        print(f"[Chatbot] Animal: {animal}")
-        print(f"[Chatbot] Response: {resp.text[:500]}")
+        messages = [
+            {"role": "system", "content": system_context},
+            {"role": "user", "content": question}
+        ]
         
-        if resp.status_code != 200:
-            error_detail = resp.text[:500] if resp.text else 'Sin detalles'
-            return jsonify({
-                'error': f'Error de API Perplexity ({resp.status_code})',
-                'detail': error_detail
-            }), 502
+        if stream:
+            return sse_response(stream_chatbot_answer(cache_key, messages, api_key, animal, question,
+                                                      started, fallback=local_match))
         
-        response_data = resp.json()
-        content = response_data.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
+        def compute():
+            content = ask_perplexity(messages, api_key, animal)
+            if content:
+                store_cached_answer(cache_key, animal, question, content)
+            return content
         
+        content = get_answer_coalesced(cache_key, compute)
         if not content:
+            # Las respuestas vacías no se cachean
             content = 'No se recibió respuesta de Perplexity.'
+        return jsonify({'answer': content, 'cached': False, 'source': 'remote', 'latency_ms': elapsed_ms(started)})
         
-        # Limpiar formato markdown de la respuesta
-        # Eliminar negritas ** y __
-        content = re.sub(r'\*\*(.+?)\*\*', r'\1', content)
-        content = re.sub(r'__(.+?)__', r'\1', content)
-        # Eliminar cursivas * y _
-        content = re.sub(r'\*(.+?)\*', r'\1', content)
-        content = re.sub(r'_(.+?)_', r'\1', content)
-        # Eliminar encabezados #
-        content = re.sub(r'^#+\s*', '', content, flags=re.MULTILINE)
-        # Eliminar listas con viñetas
-        content = re.sub(r'^\s*[-*•]\s+', '• ', content, flags=re.MULTILINE)
-        # Eliminar bloques de código
-        content = re.sub(r'```[\s\S]*?```', '', content)
-        content = re.sub(r'`(.+?)`', r'\1', content)
-        
-        # Limitar longitud de respuesta
-        content = content[:2000]
-        
-        return jsonify({'answer': content})
-        
-    except requests.exceptions.Timeout:
-        return jsonify({'error': 'Timeout - La API de Perplexity tardó demasiado en responder'}), 504
-    except requests.exceptions.ConnectionError:
-        return jsonify({'error': 'Error de conexión - No se pudo conectar con la API de Perplexity'}), 503
+    except ChatbotUpstreamError as e:
+        if local_match and e.status_code in (503, 504):
+            # Sin conectividad: responder con la mejor coincidencia local
+            return chatbot_answer_response(local_match['answer'], False, cached=False, source='local_fallback',
+                                           score=local_match['score'], latency_ms=elapsed_ms(started))
+        body = {'error': str(e)}
+        if e.detail:
+            body['detail'] = e.detail
+        return jsonify(body), e.status_code
     except Exception as e:
         print(f"[Chatbot] Error: {str(e)}")
         return jsonify({'error': f'Error en chatbot: {str(e)}'}), 500
@@ -1292,9 +5814,177 @@ def clean_markdown_format(text):
     
     return text
 
+# ==================== MÉTRICAS DEL SISTEMA ====================
+# Un hilo de fondo toma muestras de CPU, memoria, GPU y velocidad de los
+# trabajos a intervalo fijo y las guarda en un buffer circular. Los endpoints
+# de estado responden con la última muestra (y opcionalmente una serie).
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
+
+METRICS_SAMPLE_INTERVAL = float(os.environ.get('METRICS_SAMPLE_INTERVAL', 2.0))
+METRICS_HISTORY_SECONDS = int(os.environ.get('METRICS_HISTORY_SECONDS', 600))
+
+
+class MetricsSampler:
+    """Muestreo periódico del sistema en un buffer circular"""
+
+    def __init__(self, interval, history_seconds):
+        self.interval = interval
+        self.samples = deque(maxlen=max(1, int(history_seconds / interval)))
+        self._lock = threading.Lock()
+        self._thread = None
+        self._process = psutil.Process() if psutil is not None else None
+        self._nvml_handle = None
+        self.nvml_error = None
+        self._last_frames = {}  # trabajo -> (timestamp, frames procesados)
+        self._last_realtime = None
+
+    def _init_nvml(self):
+        """Inicializa NVML una sola vez (None si no está disponible)"""
+        if pynvml is None or not torch.cuda.is_available():
+            return
+        try:
+            pynvml.nvmlInit()
+            self._nvml_handle = pynvml.nvmlDeviceGetHandleByIndex(0)
+        except Exception as e:
+            self.nvml_error = str(e)
+            print(f"NVML no disponible: {e}")
+
+    def _sample_cpu(self):
+        if psutil is None:
+            return None
+        memory = psutil.virtual_memory()
+        # interval=None: porcentaje desde la muestra anterior, sin bloquear
+        return {
+            'percent': psutil.cpu_percent(interval=None),
+            'memory_percent': memory.percent,
+            'memory_used_mb': round(memory.used / 1024**2, 2),
+            'process_rss_mb': round(self._process.memory_info().rss / 1024**2, 2)
+        }
+
+    def _sample_gpu(self):
+        if not torch.cuda.is_available():
+            return None
+        gpu = {
+            'memory_allocated_mb': round(torch.cuda.memory_allocated(0) / 1024**2, 2),
+            'memory_reserved_mb': round(torch.cuda.memory_reserved(0) / 1024**2, 2)
+        }
+        if self._nvml_handle is not None:
+            try:
+                util = pynvml.nvmlDeviceGetUtilizationRates(self._nvml_handle)
+                gpu['utilization'] = {'gpu_percent': util.gpu, 'memory_percent': util.memory}
+                gpu['temperature_c'] = pynvml.nvmlDeviceGetTemperature(
+                    self._nvml_handle, pynvml.NVML_TEMPERATURE_GPU)
+                gpu['power_w'] = round(pynvml.nvmlDeviceGetPowerUsage(self._nvml_handle) / 1000.0, 2)
+            except Exception as e:
+                gpu['nvml_error'] = str(e)
+        return gpu
+
+    def _sample_jobs(self, now):
+        """Frames por segundo de cada trabajo de video en curso"""
+        with status_lock:
+            running = video_processing_status.snapshot(lambda k, v: v.get('status') == 'processing')
+        jobs = {}
+        last_frames = {}
+        for name, status_info in running:
+            processed = status_info.get('processed_frames', 0)
+            previous = self._last_frames.get(name)
+            fps = None
+            if previous and now > previous[0]:
+                fps = round(max(0, processed - previous[1]) / (now - previous[0]), 2)
+            last_frames[name] = (now, processed)
+            jobs[name] = {
+                'processed_frames': processed,
+                'total_frames': status_info.get('total_frames', 0),
+                'fps': fps
+            }
+        self._last_frames = last_frames
+        return jobs
+
+    def _sample_realtime(self, now):
+        """Frames por segundo de la inferencia por lotes de fuentes en tiempo real"""
+        frames = _realtime_inference['frames']
+        previous = self._last_realtime
+        self._last_realtime = (now, frames)
+        if not previous or now <= previous[0]:
+            return None
+        return round((frames - previous[1]) / (now - previous[0]), 2)
+
+    def sample(self):
+        """Toma una muestra y la agrega al buffer"""
+        now = time.time()
+        sample = {'timestamp': now}
+        for key, collect in (('cpu', self._sample_cpu), ('gpu', self._sample_gpu)):
+            try:
+                value = collect()
+            except Exception as e:
+                print(f"Error al muestrear {key}: {e}")
+                value = None
+            if value is not None:
+                sample[key] = value
+        sample['jobs'] = self._sample_jobs(now)
+        measured = [job['fps'] for job in sample['jobs'].values() if job['fps']]
+        if measured:
+            video_admission.observe_throughput(sum(measured))
+        model_pool.relax_idle(now)
+        sample['model_variants'] = {w: model_pool.current(w) for w in model_pool.state}
+        sample['realtime_fps'] = self._sample_realtime(now)
+        with self._lock:
+            self.samples.append(sample)
+        return sample
+
+    def _run(self):
+        self._init_nvml()
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"Error en muestreo de métricas: {e}")
+            time.sleep(self.interval)
+
+    def start(self):
+        if self._thread is None:
+            if psutil is not None:
+                psutil.cpu_percent(interval=None)  # la primera lectura siempre es 0
+            self._thread = threading.Thread(target=self._run, daemon=True, name='metrics-sampler')
+            self._thread.start()
+
+    def latest(self):
+        """Última muestra (se toma una en el momento si el hilo no ha arrancado)"""
+        with self._lock:
+            if self.samples:
+                return self.samples[-1]
+        return self.sample()
+
+    def series(self, window_seconds):
+        """Muestras de los últimos window_seconds segundos"""
+        since = time.time() - window_seconds
+        with self._lock:
+            return [s for s in self.samples if s['timestamp'] >= since]
+
+
+metrics_sampler = MetricsSampler(METRICS_SAMPLE_INTERVAL, METRICS_HISTORY_SECONDS)
+
+
+def get_metrics_window():
+    """Ventana pedida con ?window=<segundos> (None si no se pidió serie)"""
+    window = request.args.get('window', type=float)
+    if window is None or window <= 0:
+        return None
+    return min(window, METRICS_HISTORY_SECONDS)
+
+
 @app.route('/gpu_status')
 def gpu_status():
-    """Obtener estado de GPU en tiempo real"""
+    """Obtener estado de GPU (última muestra del muestreador de fondo)"""
     status = {
         'device': DEVICE,
         'cuda_available': torch.cuda.is_available()
@@ -1304,83 +5994,211 @@ def gpu_status():
         try:
             status['gpu_name'] = torch.cuda.get_device_name(0)
             status['gpu_count'] = torch.cuda.device_count()
-            
-            # Memoria GPU
-            mem_allocated = torch.cuda.memory_allocated(0) / 1024**2  # MB
-            mem_reserved = torch.cuda.memory_reserved(0) / 1024**2  # MB
             mem_total = torch.cuda.get_device_properties(0).total_memory / 1024**2  # MB
             
+            sample = metrics_sampler.latest()
+            gpu = sample.get('gpu', {})
+            mem_allocated = gpu.get('memory_allocated_mb', 0)
             status['memory'] = {
-                'allocated_mb': round(mem_allocated, 2),
-                'reserved_mb': round(mem_reserved, 2),
+                'allocated_mb': mem_allocated,
+                'reserved_mb': gpu.get('memory_reserved_mb', 0),
                 'total_mb': round(mem_total, 2),
                 'percent': round((mem_allocated / mem_total) * 100, 2)
             }
-            
-            # Intentar obtener stats adicionales con nvidia-ml-py
-            try:
-                import pynvml
-                pynvml.nvmlInit()
-                handle = pynvml.nvmlDeviceGetHandleByIndex(0)
-                
-                # Utilización
-                util = pynvml.nvmlDeviceGetUtilizationRates(handle)
-                status['utilization'] = {
-                    'gpu_percent': util.gpu,
-                    'memory_percent': util.memory
-                }
-                
-                # Temperatura
-                temp = pynvml.nvmlDeviceGetTemperature(handle, pynvml.NVML_TEMPERATURE_GPU)
-                status['temperature_c'] = temp
-                
-                # Potencia
-                try:
-                    power = pynvml.nvmlDeviceGetPowerUsage(handle) / 1000.0  # W
-                    status['power_w'] = round(power, 2)
-                except:
-                    pass
-                
-                pynvml.nvmlShutdown()
-            except:
-                pass  # nvidia-ml-py no disponible
-                
+            for key in ('utilization', 'temperature_c', 'power_w'):
+                if key in gpu:
+                    status[key] = gpu[key]
+            if metrics_sampler.nvml_error:
+                status['nvml_error'] = metrics_sampler.nvml_error
+            status['sampled_at'] = sample['timestamp']
         except Exception as e:
             status['error'] = str(e)
     
+    window = get_metrics_window()
+    if window is not None:
+        status['series'] = [
+            {'timestamp': s['timestamp'], **s['gpu']}
+            for s in metrics_sampler.series(window) if 'gpu' in s
+        ]
+    
     return jsonify(status)
 
 @app.route('/performance_metrics')
 def performance_metrics():
-    """Obtener métricas de rendimiento del sistema"""
+    """Obtener métricas de rendimiento del sistema (última muestra y serie opcional)"""
+    sample = metrics_sampler.latest()
     metrics = {
         'device': DEVICE,
-        'timestamp': datetime.now().isoformat()
+        'timestamp': datetime.now().isoformat(),
+        'sampled_at': sample['timestamp'],
+        'sample_interval': METRICS_SAMPLE_INTERVAL
     }
+    for key in ('cpu', 'gpu', 'jobs', 'realtime_fps', 'model_variants'):
+        if key in sample:
+            metrics[key] = sample[key]
     
-    # Stats de CPU
-    try:
-        import psutil
-        metrics['cpu'] = {
-            'percent': psutil.cpu_percent(interval=0.1),
-            'memory_percent': psutil.virtual_memory().percent,
-            'memory_used_mb': round(psutil.virtual_memory().used / 1024**2, 2)
-        }
-    except:
-        pass
+    metrics['caches'] = cache_manager.stats()
+    metrics['model_pool'] = model_pool.stats()
+    metrics['admission'] = video_admission.stats()
     
-    # Stats de GPU
-    if torch.cuda.is_available():
-        try:
-            metrics['gpu'] = {
-                'memory_allocated_mb': round(torch.cuda.memory_allocated(0) / 1024**2, 2),
-                'memory_reserved_mb': round(torch.cuda.memory_reserved(0) / 1024**2, 2)
-            }
-        except:
-            pass
+    window = get_metrics_window()
+    if window is not None:
+        metrics['series'] = metrics_sampler.series(window)
     
     return jsonify(metrics)
 
+@app.route('/cache_stats')
+def cache_stats():
+    """Estadísticas de las caches en memoria (aciertos, fallos, desalojos, bytes)"""
+    return jsonify(cache_manager.stats())
+
+def start_background_services():
+    """Arranca las tareas de fondo del servidor (una vez por proceso)"""
+    start_cache_sweeper()
+    metrics_sampler.start()
+    start_model_pool_warmup()
+    restore_upload_sessions()  # antes de reanudar: un trabajo puede esperar a su subida
+    resume_interrupted_jobs()
+    start_retention_sweeper()
+    restore_realtime_sources()
+
+
+# ==================== SERVIDOR ASÍNCRONO (PRODUCCIÓN) ====================
+# Los endpoints de streaming se atienden directamente en el event loop ASGI:
+# cada espectador es una tarea que espera el siguiente frame compartido. El
+# resto de rutas Flask se ejecutan en un pool de hilos mediante a2wsgi.
+# Uso: python app.py --production   o   uvicorn app:asgi_app (un solo worker,
+# el estado de trabajos y caches vive en el proceso).
+
+try:
+    import uvicorn
+    from a2wsgi import WSGIMiddleware
+except ImportError:
+    uvicorn = None
+    WSGIMiddleware = None
+
+ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', 32))
+
+_wsgi_bridge = None
+
+
+async def wait_for_disconnect(receive, disconnected):
+    """Marca la conexión como cerrada cuando el cliente se desconecta"""
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            disconnected.set()
+            return
+
+
+async def asgi_mjpeg_stream(receive, send, broadcaster, is_active):
+    """Stream MJPEG como tarea asyncio (sin hilo por espectador)"""
+    disconnected = asyncio.Event()
+    watcher = asyncio.ensure_future(wait_for_disconnect(receive, disconnected))
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'multipart/x-mixed-replace; boundary=frame'),
+            (b'cache-control', b'no-cache'),
+        ]
+    })
+    broadcaster.add_viewer()
+    try:
+        last_seq = 0
+        while is_active() and not disconnected.is_set():
+            frame, last_seq = await broadcaster.wait_frame_async(last_seq)
+            if frame is not None:
+                await send({'type': 'http.response.body', 'body': frame, 'more_body': True})
+            elif not broadcaster.running:
+                break
+        if not disconnected.is_set():
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    finally:
+        broadcaster.remove_viewer()
+        watcher.cancel()
+
+
+async def asgi_not_found(send):
+    await send({'type': 'http.response.start', 'status': 404,
+                'headers': [(b'content-type', b'application/json')]})
+    await send({'type': 'http.response.body', 'body': json.dumps({'error': 'Fuente no encontrada'}).encode('utf-8')})
+
+
+async def asgi_video_feed(scope, receive, send):
+    activate_realtime_camera()
+    await asgi_mjpeg_stream(receive, send, realtime_broadcaster, lambda: camera_active)
+
+
+async def asgi_source_feed(scope, receive, send):
+    source = realtime_sources.get(scope['path'][len('/video_feed/'):])
+    if source is None:
+        return await asgi_not_found(send)
+    await asgi_mjpeg_stream(receive, send, source.broadcaster, lambda: source.active)
+
+
+async def asgi_video_preview(scope, receive, send):
+    with video_previews_lock:
+        broadcaster = video_previews.get(scope['path'][len('/video_preview/'):])
+    if broadcaster is None:
+        return await asgi_not_found(send)
+    await asgi_mjpeg_stream(receive, send, broadcaster, lambda: broadcaster.running)
+
+
+ASGI_STREAM_ROUTES = {
+    '/video_feed': asgi_video_feed,
+}
+ASGI_STREAM_PREFIXES = {
+    '/video_feed/': asgi_source_feed,
+    '/video_preview/': asgi_video_preview,
+}
+
+
+async def asgi_lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            start_background_services()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def asgi_app(scope, receive, send):
+    """Aplicación ASGI: streaming nativo + Flask para el resto de rutas"""
+    global _wsgi_bridge
+    if scope['type'] == 'lifespan':
+        return await asgi_lifespan(receive, send)
+    handler = None
+    if scope['type'] == 'http':
+        path = scope.get('path', '')
+        handler = ASGI_STREAM_ROUTES.get(path)
+        if handler is None:
+            handler = next((h for prefix, h in ASGI_STREAM_PREFIXES.items() if path.startswith(prefix)), None)
+    if handler is not None:
+        return await handler(scope, receive, send)
+    if _wsgi_bridge is None:
+        if WSGIMiddleware is None:
+            raise RuntimeError('a2wsgi no está instalado (pip install a2wsgi uvicorn)')
+        _wsgi_bridge = WSGIMiddleware(app, workers=ASGI_WSGI_THREADS)
+    return await _wsgi_bridge(scope, receive, send)
+
+
+def run_production_server(host='0.0.0.0', port=5000):
+    if uvicorn is None or WSGIMiddleware is None:
+        print("Para el modo producción instala uvicorn y a2wsgi: pip install uvicorn a2wsgi")
+        sys.exit(1)
+    uvicorn.run(asgi_app, host=host, port=port, lifespan='on', timeout_keep_alive=30,
+                backlog=4096, log_level='info')
+
+
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000, threaded=True)
+    if '--production' in sys.argv or os.environ.get('APP_ENV') == 'production':
+        run_production_server(port=int(os.environ.get('PORT', 5000)))
+    else:
+        # Con debug=True el reloader ejecuta este bloque en dos procesos; solo el hijo atiende peticiones
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            start_background_services()
+        app.run(debug=True, host='0.0.0.0', port=5000, threaded=True)
 
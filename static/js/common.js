@@ -14,6 +14,189 @@ window.getCurrentAnimal = () => {
     return currentAnimal;
 };
 
+// ==================== FORMATO COMPACTO DE DETECCIONES ====================
+
+// El servidor responde en formato columnar si se pide vía Accept
+const DETECTIONS_ACCEPT = 'application/vnd.yolo-detections+json, application/json;q=0.9';
+
+// Convierte detecciones columnares ({cls, conf, xyxy}) a la lista clásica;
+// classNames es la tabla de clases que la respuesta envía una sola vez
+function expandColumnarDetections(col, classNames) {
+    if (!col || Array.isArray(col)) return col || [];
+    const detections = [];
+    for (let i = 0; i < col.cls.length; i++) {
+        const o = i * 4;
+        detections.push({
+            class: classNames[col.cls[i]],
+            confidence: col.conf[i],
+            bbox: { x1: col.xyxy[o], y1: col.xyxy[o + 1], x2: col.xyxy[o + 2], y2: col.xyxy[o + 3] }
+        });
+    }
+    return detections;
+}
+
+// Normaliza una entrada (respuesta de detecciones o item de historial) in situ
+function expandDetections(entry, classNames) {
+    if (!entry) return entry;
+    if (entry.detections) entry.detections = expandColumnarDetections(entry.detections, classNames);
+    if (Array.isArray(entry.frames_detections)) {
+        entry.frames_detections.forEach(frame => expandDetections(frame, classNames));
+    }
+    return entry;
+}
+
+// fetch de JSON con detecciones en formato compacto
+async function fetchDetectionsJson(url, options = {}) {
+    const headers = Object.assign({ 'Accept': DETECTIONS_ACCEPT }, options.headers || {});
+    const response = await fetch(url, Object.assign({}, options, { headers }));
+    let data = await response.json();
+    if (data && data.class_names) {
+        // Formato compacto: listas en 'entries' y tabla de clases en el nivel superior
+        const classNames = data.class_names;
+        if (Array.isArray(data.entries)) {
+            data = data.entries;
+            data.forEach(entry => expandDetections(entry, classNames));
+        } else {
+            delete data.class_names;
+            expandDetections(data, classNames);
+        }
+    }
+    return { response, data };
+}
+
+// ==================== PISTA DE DETECCIONES PRECARGADA ====================
+
+// Pistas decodificadas por sesión (video procesado); se descargan una sola vez
+const detectionTracks = {};
+
+// Decodifica la pista delta ({classes, data, ...}) a frames con sus cajas
+function decodeDetectionTrack(payload) {
+    const frames = [];
+    const boxes = [];
+    const data = payload.data || [];
+    let frame = 0;
+    let prev = [];
+    let i = 0;
+    while (i < data.length) {
+        frame += data[i];
+        const count = data[i + 1];
+        i += 2;
+        const current = [];
+        for (let b = 0; b < count; b++, i += 6) {
+            const cls = data[i];
+            const ref = prev[b] && prev[b][0] === cls ? prev[b] : null;
+            current.push([
+                cls, data[i + 1],
+                data[i + 2] + (ref ? ref[2] : 0), data[i + 3] + (ref ? ref[3] : 0),
+                data[i + 4] + (ref ? ref[4] : 0), data[i + 5] + (ref ? ref[5] : 0)
+            ]);
+        }
+        frames.push(frame);
+        boxes.push(current);
+        prev = current;
+    }
+    return {
+        classes: payload.classes || [],
+        width: payload.width || 0,
+        height: payload.height || 0,
+        maxGap: payload.max_gap || 6,
+        frames,
+        boxes
+    };
+}
+
+// Descarga la pista de un video; resuelve a null si no está disponible
+function loadDetectionTrack(sessionId, url = null) {
+    if (!(sessionId in detectionTracks)) {
+        detectionTracks[sessionId] = fetch(url || `/detections_track/${sessionId}`)
+            .then(response => response.ok ? response.json() : null)
+            .then(payload => {
+                if (!payload) {
+                    delete detectionTracks[sessionId];
+                    return null;
+                }
+                const track = decodeDetectionTrack(payload);
+                detectionTracks[sessionId] = track;
+                return track;
+            })
+            .catch(() => {
+                delete detectionTracks[sessionId];
+                return null;
+            });
+    }
+    return Promise.resolve(detectionTracks[sessionId]);
+}
+
+// Pista ya decodificada (o null si no se cargó o sigue descargándose)
+function getLoadedTrack(sessionId) {
+    const track = detectionTracks[sessionId];
+    return track && !(track instanceof Promise) ? track : null;
+}
+
+// Detecciones de la pista en un frame, interpolando entre muestras cercanas
+function lookupTrackDetections(track, frameIndex) {
+    const result = { detections: [], width: track.width, height: track.height, frame: frameIndex };
+    const frames = track.frames;
+    // Búsqueda binaria del último frame <= frameIndex
+    let lo = 0;
+    let hi = frames.length - 1;
+    let idx = -1;
+    while (lo <= hi) {
+        const mid = (lo + hi) >> 1;
+        if (frames[mid] <= frameIndex) {
+            idx = mid;
+            lo = mid + 1;
+        } else {
+            hi = mid - 1;
+        }
+    }
+    if (idx < 0) return result;
+
+    const current = track.boxes[idx];
+    const next = track.boxes[idx + 1];
+    const gap = idx + 1 < frames.length ? frames[idx + 1] - frames[idx] : 0;
+    // Interpolar solo si el frame siguiente tiene las mismas cajas y está cerca
+    const canBlend = next && gap > 0 && gap <= track.maxGap && next.length === current.length &&
+        next.every((box, b) => box[0] === current[b][0]);
+    const t = canBlend ? (frameIndex - frames[idx]) / gap : 0;
+
+    result.detections = current.map((box, b) => {
+        const to = canBlend ? next[b] : box;
+        const lerp = k => box[k] + (to[k] - box[k]) * t;
+        return {
+            class: track.classes[box[0]],
+            confidence: box[1] / 100,
+            bbox: { x1: lerp(2), y1: lerp(3), x2: lerp(4), y2: lerp(5) }
+        };
+    });
+    return result;
+}
+
+// ==================== HISTORIAL PAGINADO ====================
+
+const HISTORY_PAGE_SIZE = 20;
+
+// Carga una página del historial (vista resumida); devuelve items y cursor siguiente
+async function fetchHistoryPage(endpoint, cursor = null) {
+    const params = new URLSearchParams({ view: 'summary', limit: HISTORY_PAGE_SIZE });
+    if (cursor) params.set('cursor', cursor);
+    const { response, data } = await fetchDetectionsJson(`${endpoint}?${params}`);
+    return { items: data, nextCursor: response.headers.get('X-Next-Cursor') };
+}
+
+// Miniatura de una entrada del historial (carga diferida, cacheable)
+function createHistoryThumbnail(url) {
+    const img = document.createElement('img');
+    img.className = 'history-thumb';
+    img.src = url;
+    img.alt = '';
+    img.loading = 'lazy';
+    img.decoding = 'async';
+    img.width = 96;
+    img.height = 54;
+    return img;
+}
+
 // ==================== DETECCIÓN DE CLICKS Y PLN ====================
 
 let currentSessionId = 'realtime';
@@ -42,14 +225,34 @@ function getClickedDetection(x, y, detections, imgWidth, imgHeight, displayWidth
     return null;
 }
 
+// Detecciones recibidas junto a cada frame de un stream (tiempo real):
+// corresponden exactamente a la imagen que se está mostrando
+const pushedDetections = {};
+
+function setPushedDetections(sessionId, data) {
+    if (data) {
+        pushedDetections[sessionId] = data;
+    } else {
+        delete pushedDetections[sessionId];
+    }
+}
+
 // Función para obtener detecciones actuales
 async function getCurrentDetections(sessionId, frameIndex = null) {
+    // Stream con detecciones por frame: las del frame visible
+    if (frameIndex === null && pushedDetections[sessionId]) {
+        return pushedDetections[sessionId];
+    }
+    // Videos con pista precargada: sin pedir nada al servidor
+    const track = frameIndex !== null ? getLoadedTrack(sessionId) : null;
+    if (track) {
+        return lookupTrackDetections(track, frameIndex);
+    }
     try {
         const url = frameIndex !== null
             ? `/get_detections/${sessionId}?frame=${frameIndex}`
             : `/get_detections/${sessionId}`;
-        const response = await fetch(url);
-        const data = await response.json();
+        const { data } = await fetchDetectionsJson(url);
         return data;
     } catch (error) {
         console.error('Error al obtener detecciones:', error);
@@ -287,12 +490,21 @@ function initChatbot(btnId, questionId, answerId) {
         try {
             const resp = await fetch('/chatbot', {
                 method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
+                headers: {
+                    'Content-Type': 'application/json',
+                    'Accept': 'text/event-stream, application/json'
+                },
                 body: JSON.stringify({
                     question: q,
-                    animal: window.getCurrentAnimal()
+                    animal: window.getCurrentAnimal(),
+                    stream: true
                 })
             });
+            const contentType = resp.headers.get('Content-Type') || '';
+            if (resp.ok && contentType.includes('text/event-stream') && resp.body) {
+                await readChatbotStream(resp, answerEl);
+                return;
+            }
             const data = await resp.json();
             if (resp.ok && data.answer) {
                 answerEl.textContent = data.answer;
@@ -308,6 +520,55 @@ function initChatbot(btnId, questionId, answerId) {
     });
 }
 
+// Leer la respuesta SSE del chatbot y mostrar los tokens a medida que llegan
+async function readChatbotStream(resp, answerEl) {
+    const reader = resp.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let started = false;
+
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // Los eventos SSE se separan por una línea en blanco
+        let sep;
+        while ((sep = buffer.indexOf('\n\n')) !== -1) {
+            const raw = buffer.slice(0, sep);
+            buffer = buffer.slice(sep + 2);
+
+            let event = 'message';
+            let dataLine = '';
+            raw.split('\n').forEach(line => {
+                if (line.startsWith('event:')) event = line.slice(6).trim();
+                else if (line.startsWith('data:')) dataLine += line.slice(5).trim();
+            });
+            if (!dataLine) continue;
+            const data = JSON.parse(dataLine);
+
+            if (event === 'error') {
+                answerEl.textContent = data.error || 'No se obtuvo respuesta.';
+                if (data.detail) {
+                    answerEl.textContent += '\n\nDetalle: ' + data.detail;
+                }
+                return;
+            }
+            if (event === 'done') {
+                answerEl.textContent = data.answer;
+                return;
+            }
+            if (data.delta) {
+                if (!started) {
+                    answerEl.textContent = '';
+                    started = true;
+                }
+                answerEl.textContent += data.delta;
+            }
+        }
+    }
+}
+
 // ==================== MODAL ====================
 document.addEventListener('DOMContentLoaded', () => {
     const modal = document.getElementById('animalModal');
@@ -5,6 +5,7 @@ let currentImageDetections = [];
 let currentImageWidth = 0;
 let currentImageHeight = 0;
 let currentImageSessionId = null;
+let imageHistoryNextCursor = null;
 
 // ==================== UPLOAD IMAGE ====================
 const imageUploadArea = document.getElementById('imageUploadArea');
@@ -64,13 +65,11 @@ async function uploadImage(file) {
     formData.append('image', file);
 
     try {
-        const response = await fetch('/upload_image', {
+        const { response, data } = await fetchDetectionsJson('/upload_image', {
             method: 'POST',
             body: formData
         });
 
-        const data = await response.json();
-
         if (response.ok) {
             // Guardar datos de detección
             currentImageDetections = data.detections || [];
@@ -330,23 +329,25 @@ window.addEventListener('resize', () => {
 
 // ==================== HISTORIAL DE IMÁGENES ====================
 
-async function loadImageHistory() {
+async function loadImageHistory(append = false) {
     try {
-        const res = await fetch('/image_history');
-        const history = await res.json();
-        renderImageHistory(history);
+        const { items, nextCursor } = await fetchHistoryPage('/image_history', append ? imageHistoryNextCursor : null);
+        imageHistoryNextCursor = nextCursor;
+        renderImageHistory(items, append);
+        const moreBtn = document.getElementById('imageHistoryMoreBtn');
+        if (moreBtn) moreBtn.style.display = nextCursor ? 'inline-block' : 'none';
     } catch (e) {
         console.error('Error al cargar historial de imágenes', e);
     }
 }
 
-function renderImageHistory(history) {
+function renderImageHistory(history, append = false) {
     const historyList = document.getElementById('imageHistoryList');
     if (!historyList) return;
 
-    historyList.innerHTML = '';
+    if (!append) historyList.innerHTML = '';
 
-    if (!history || history.length === 0) {
+    if (!append && (!history || history.length === 0)) {
         historyList.innerHTML = '<p class="history-empty">Sin imágenes procesadas aún.</p>';
         return;
     }
@@ -355,6 +356,11 @@ function renderImageHistory(history) {
         const row = document.createElement('div');
         row.className = 'history-item';
 
+        // Miniatura ligera en lugar de la imagen completa
+        if (item.thumbnail_url) {
+            row.appendChild(createHistoryThumbnail(item.thumbnail_url));
+        }
+
         const info = document.createElement('div');
         info.className = 'history-info';
 
@@ -392,7 +398,16 @@ function renderImageHistory(history) {
     });
 }
 
-function viewHistoryImage(item) {
+async function viewHistoryImage(summary) {
+    // La lista no incluye detecciones: pedir la entrada completa
+    let item = summary;
+    try {
+        const { response, data } = await fetchDetectionsJson(`/history/${summary.output_filename}`);
+        if (response.ok) item = data;
+    } catch (e) {
+        console.error('Error al cargar la entrada del historial', e);
+    }
+
     // Cargar datos de la imagen del historial
     currentImageDetections = item.detections || [];
     currentImageWidth = item.width || 0;
@@ -450,5 +465,10 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // Cargar historial al iniciar
     loadImageHistory();
+
+    const imageHistoryMoreBtn = document.getElementById('imageHistoryMoreBtn');
+    if (imageHistoryMoreBtn) {
+        imageHistoryMoreBtn.addEventListener('click', () => loadImageHistory(true));
+    }
 });
 
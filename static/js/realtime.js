@@ -2,6 +2,97 @@
 // Este archivo contiene las funciones específicas para la página de detección en tiempo real
 
 let cameraActive = false;
+let mjpegReader = null;
+
+// ==================== STREAM MJPEG CON DETECCIONES ====================
+// El stream se lee con fetch en lugar de asignarlo al <img>: cada parte trae
+// X-Frame-Seq, X-Frame-Timestamp y X-Frame-Detections, y las detecciones se
+// publican recién cuando ese mismo frame terminó de mostrarse.
+
+function indexOfHeaderEnd(bytes) {
+    for (let i = 0; i + 3 < bytes.length; i++) {
+        if (bytes[i] === 13 && bytes[i + 1] === 10 && bytes[i + 2] === 13 && bytes[i + 3] === 10) {
+            return i;
+        }
+    }
+    return -1;
+}
+
+// Extrae la siguiente parte completa del buffer (null si faltan bytes)
+function takeMjpegPart(bytes, textDecoder) {
+    const headerEnd = indexOfHeaderEnd(bytes);
+    if (headerEnd < 0) return null;
+    const headers = {};
+    textDecoder.decode(bytes.subarray(0, headerEnd)).split('\r\n').forEach(line => {
+        const sep = line.indexOf(':');
+        if (sep > 0) headers[line.slice(0, sep).trim().toLowerCase()] = line.slice(sep + 1).trim();
+    });
+    const length = parseInt(headers['content-length'], 10);
+    if (isNaN(length)) throw new Error('Parte MJPEG sin Content-Length');
+    const start = headerEnd + 4;
+    if (bytes.length < start + length + 2) return null;
+    return { headers, jpeg: bytes.slice(start, start + length), end: start + length + 2 };
+}
+
+function showMjpegPart(imgEl, reader, part, sessionId) {
+    const frame = part.headers['x-frame-detections'] ? JSON.parse(part.headers['x-frame-detections']) : null;
+    if (frame) {
+        frame.seq = parseInt(part.headers['x-frame-seq'], 10);
+        frame.captured_at = parseFloat(part.headers['x-frame-timestamp']);
+    }
+    const url = URL.createObjectURL(new Blob([part.jpeg], { type: 'image/jpeg' }));
+    if (reader.pendingUrl) URL.revokeObjectURL(reader.pendingUrl);  // nunca llegó a mostrarse
+    reader.pendingUrl = url;
+    imgEl.onload = () => {
+        if (reader.shownUrl) URL.revokeObjectURL(reader.shownUrl);
+        reader.shownUrl = url;
+        reader.pendingUrl = null;
+        setPushedDetections(sessionId, frame);
+    };
+    imgEl.src = url;
+}
+
+async function startMjpegReader(imgEl, url, sessionId) {
+    stopMjpegReader();
+    const reader = { controller: new AbortController(), pendingUrl: null, shownUrl: null };
+    mjpegReader = reader;
+    try {
+        const response = await fetch(url, { signal: reader.controller.signal });
+        if (!response.ok || !response.body) {
+            imgEl.src = url;  // sin streams legibles: <img> nativo, detecciones por consulta
+            return;
+        }
+        const stream = response.body.getReader();
+        const textDecoder = new TextDecoder();
+        let buffer = new Uint8Array(0);
+        while (true) {
+            const { value, done } = await stream.read();
+            if (done) break;
+            const merged = new Uint8Array(buffer.length + value.length);
+            merged.set(buffer);
+            merged.set(value, buffer.length);
+            buffer = merged;
+            let part;
+            while ((part = takeMjpegPart(buffer, textDecoder)) !== null) {
+                buffer = buffer.subarray(part.end);
+                showMjpegPart(imgEl, reader, part, sessionId);
+            }
+        }
+    } catch (error) {
+        if (error.name !== 'AbortError') {
+            console.error('Error en el stream de video:', error);
+        }
+    }
+}
+
+function stopMjpegReader() {
+    if (!mjpegReader) return;
+    mjpegReader.controller.abort();
+    if (mjpegReader.pendingUrl) URL.revokeObjectURL(mjpegReader.pendingUrl);
+    if (mjpegReader.shownUrl) URL.revokeObjectURL(mjpegReader.shownUrl);
+    mjpegReader = null;
+    setPushedDetections('realtime', null);
+}
 
 function startCamera() {
     const webcamStream = document.getElementById('webcamStream');
@@ -12,7 +103,7 @@ function startCamera() {
     fetch('/start_camera', { method: 'POST' })
         .then(response => response.json())
         .then(data => {
-            webcamStream.src = '/video_feed?' + new Date().getTime();
+            startMjpegReader(webcamStream, '/video_feed?' + new Date().getTime(), 'realtime');
             webcamStream.classList.add('active');
             noCamera.style.display = 'none';
             cameraActive = true;
@@ -38,6 +129,8 @@ function stopCamera() {
     fetch('/stop_camera', { method: 'POST' })
         .then(response => response.json())
         .then(data => {
+            stopMjpegReader();
+            webcamStream.onload = null;
             webcamStream.src = '';
             webcamStream.classList.remove('active');
             noCamera.style.display = 'block';
@@ -2,6 +2,9 @@
 // Este archivo contiene las funciones específicas para la página de videos
 
 let processedOverlayInterval = null;
+let processedOverlayFrame = null;
+let liveHls = null;
+let historyNextCursor = null;
 
 // ==================== UPLOAD VIDEO ====================
 const uploadArea = document.getElementById('uploadArea');
@@ -60,18 +63,47 @@ function handleVideoFile(file) {
     };
     reader.readAsDataURL(file);
 
+    // La vista previa rápida anterior no corresponde al nuevo video
+    const quickLook = document.getElementById('quickLook');
+    if (quickLook) {
+        quickLook.style.display = 'none';
+        delete quickLook.dataset.samples;
+    }
+
     // Subir y procesar video
     uploadVideo(file);
 }
 
 function uploadVideo(file) {
-    const formData = new FormData();
-    formData.append('video', file);
+    const parallelCheckbox = document.getElementById('parallelProcessing');
+    const detectionsOnlyCheckbox = document.getElementById('detectionsOnly');
+    const options = {
+        parallel: !!(parallelCheckbox && parallelCheckbox.checked),
+        annotate: !(detectionsOnlyCheckbox && detectionsOnlyCheckbox.checked)
+    };
 
     // Mostrar barra de progreso
     uploadProgress.style.display = 'block';
     progressText.textContent = 'Subiendo video...';
 
+    // Videos grandes: subida por partes, reanudable y con procesamiento anticipado
+    if (file.size >= CHUNKED_UPLOAD_THRESHOLD) {
+        uploadVideoChunked(file, options).catch(error => {
+            backgroundUploadPercent = null;
+            showUploadError(error.status, error.data || { error: error.message }, error.retryAfter);
+        });
+        return;
+    }
+
+    const formData = new FormData();
+    formData.append('video', file);
+    if (options.parallel) {
+        formData.append('parallel', 'true');
+    }
+    if (!options.annotate) {
+        formData.append('annotate', 'false');
+    }
+
     const xhr = new XMLHttpRequest();
 
     // Progress
@@ -85,20 +117,11 @@ function uploadVideo(file) {
 
     // Completado
     xhr.addEventListener('load', () => {
+        const data = xhr.responseText ? JSON.parse(xhr.responseText) : {};
         if (xhr.status === 200) {
-            const response = JSON.parse(xhr.responseText);
-            progressText.textContent = 'Video subido. Procesando con YOLO...';
-            progressFill.style.width = '100%';
-
-            // Verificar cuando el video esté listo
-            checkVideoStatus(response.output_filename, response.total_frames || 0);
-
-            // Refrescar historial
-            loadHistory();
+            onVideoJobStarted(data, 'Video subido');
         } else {
-            const errorMsg = xhr.responseText ? JSON.parse(xhr.responseText).error : 'Error desconocido';
-            alert('Error al subir video: ' + errorMsg);
-            uploadProgress.style.display = 'none';
+            showUploadError(xhr.status, data, xhr.getResponseHeader('Retry-After'));
         }
     });
 
@@ -112,6 +135,169 @@ function uploadVideo(file) {
     xhr.send(formData);
 }
 
+// El servidor aceptó el video y empezó a procesarlo
+function onVideoJobStarted(job, prefix) {
+    progressText.textContent = job.eta_seconds
+        ? `${prefix}. Procesando con YOLO (tiempo estimado: ${formatEta(job.eta_seconds)})...`
+        : `${prefix}. Procesando con YOLO...`;
+    progressFill.style.width = '100%';
+
+    // Verificar cuando el video esté listo
+    checkVideoStatus(job.output_filename, job.total_frames || 0);
+
+    // Refrescar historial
+    loadHistory();
+}
+
+function showUploadError(status, data, retryAfter) {
+    if (status === 429 || status === 503) {
+        // Servidor saturado: avisar cuándo reintentar
+        const seconds = parseInt(retryAfter || data.retry_after || '0', 10);
+        alert(`${data.error}.\nPuedes reintentar en ${formatEta(seconds)}.`);
+    } else {
+        alert('Error al subir video: ' + (data.error || 'Error desconocido'));
+    }
+    uploadProgress.style.display = 'none';
+}
+
+// ==================== SUBIDA POR PARTES ====================
+
+const CHUNKED_UPLOAD_THRESHOLD = 16 * 1024 * 1024;
+const CHUNK_MAX_RETRIES = 6;
+
+// Porcentaje subido mientras el video ya se procesa (null si no aplica)
+let backgroundUploadPercent = null;
+
+function uploadError(response, data) {
+    const error = new Error(data.error || 'Error desconocido');
+    error.status = response.status;
+    error.data = data;
+    error.retryAfter = response.headers.get('Retry-After');
+    return error;
+}
+
+// SHA-256 del trozo (crypto.subtle solo existe en contextos seguros)
+async function sha256Hex(buffer) {
+    if (!(window.crypto && crypto.subtle)) return null;
+    const digest = await crypto.subtle.digest('SHA-256', buffer);
+    return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+}
+
+// La sesión se recuerda por archivo para continuar tras un corte o recarga
+function uploadResumeKey(file) {
+    return `upload:${file.name}:${file.size}:${file.lastModified}`;
+}
+
+async function openUploadSession(file, options) {
+    const key = uploadResumeKey(file);
+    const savedId = localStorage.getItem(key);
+    if (savedId) {
+        const resp = await fetch(`/uploads/${savedId}`);
+        if (resp.ok) {
+            const session = await resp.json();
+            if (session.status === 'receiving') return session;
+        }
+        localStorage.removeItem(key);
+    }
+    const resp = await fetch('/uploads', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ filename: file.name, size: file.size, parallel: options.parallel, annotate: options.annotate })
+    });
+    const data = await resp.json();
+    if (!resp.ok) throw uploadError(resp, data);
+    localStorage.setItem(key, data.upload_id);
+    return data;
+}
+
+async function uploadVideoChunked(file, options) {
+    const key = uploadResumeKey(file);
+    const session = await openUploadSession(file, options);
+    let offset = session.offset;
+    let jobStarted = !!session.output_filename;
+    let retries = 0;
+
+    if (jobStarted) {
+        // Reanudación de una subida cuyo procesamiento ya había empezado
+        checkVideoStatus(session.output_filename);
+    }
+
+    // Al final se envía un trozo vacío si el servidor aún no admitió el video
+    let complete = false;
+    while (!complete) {
+        const buffer = await file.slice(offset, offset + session.chunk_size).arrayBuffer();
+        const checksum = await sha256Hex(buffer);
+        let resp;
+        let data;
+        try {
+            resp = await fetch(`${session.upload_url}?offset=${offset}`, {
+                method: 'PUT',
+                headers: checksum ? { 'X-Chunk-SHA256': checksum } : {},
+                body: buffer
+            });
+            data = await resp.json();
+        } catch (e) {
+            // Corte de red: esperar y preguntar al servidor desde dónde seguir
+            if (++retries > CHUNK_MAX_RETRIES) throw e;
+            progressText.textContent = `Conexión interrumpida, reintentando (${retries}/${CHUNK_MAX_RETRIES})...`;
+            await new Promise(resolve => setTimeout(resolve, 1000 * 2 ** retries));
+            try {
+                const state = await fetch(`/uploads/${session.upload_id}`);
+                if (state.ok) offset = (await state.json()).offset;
+            } catch (_) { /* se reintenta en la siguiente vuelta */ }
+            continue;
+        }
+
+        if (resp.status === 409 && data.status === 'receiving') {
+            offset = data.offset;  // el servidor guardó otra cantidad: continuar desde ahí
+            continue;
+        }
+        if ((resp.status === 429 || resp.status === 503) && data.upload_id) {
+            // Cola llena: lo subido se conserva, esperar y continuar desde el offset guardado
+            const seconds = parseInt(resp.headers.get('Retry-After') || data.retry_after || '5', 10);
+            progressText.textContent = `${data.error}. Reintentando en ${formatEta(seconds)}...`;
+            await new Promise(resolve => setTimeout(resolve, seconds * 1000));
+            offset = data.offset;
+            continue;
+        }
+        if (resp.status === 400 && checksum && retries < CHUNK_MAX_RETRIES && /checksum/i.test(data.error || '')) {
+            retries++;  // trozo dañado en el camino: reenviarlo
+            continue;
+        }
+        if (!resp.ok) {
+            localStorage.removeItem(key);
+            throw uploadError(resp, data);
+        }
+
+        retries = 0;
+        offset = data.offset;
+        complete = !!data.complete;
+        const percent = Math.round((offset / file.size) * 100);
+        if (data.job && !jobStarted) {
+            // El procesamiento empezó con lo ya recibido
+            jobStarted = true;
+            backgroundUploadPercent = percent;
+            onVideoJobStarted(data.job, 'Análisis iniciado mientras se sube');
+        } else if (jobStarted) {
+            backgroundUploadPercent = percent;
+        } else {
+            progressFill.style.width = percent + '%';
+            progressText.textContent = `Subiendo: ${percent}%`;
+        }
+    }
+    localStorage.removeItem(key);
+    backgroundUploadPercent = null;
+}
+
+// Segundos -> texto legible ("45 s", "3 min", "1 h 20 min")
+function formatEta(seconds) {
+    seconds = Math.max(0, Math.round(seconds));
+    if (seconds < 60) return `${seconds} s`;
+    const minutes = Math.round(seconds / 60);
+    if (minutes < 60) return `${minutes} min`;
+    return `${Math.floor(minutes / 60)} h ${minutes % 60} min`;
+}
+
 // Actualizar sessionId cuando se carga un video
 function updateVideoSessionId(filename) {
     const liveStream = document.getElementById('liveStream');
@@ -125,34 +311,60 @@ function updateVideoSessionId(filename) {
     }
 }
 
-function startLiveStream(streamUrl, filename) {
-    const liveProcessingDiv = document.getElementById('liveProcessing');
+// HLS con hls.js (si está vendorizado) o nativo (Safari)
+function canPlayHls() {
     const liveStream = document.getElementById('liveStream');
-    const processingPlaceholder = document.getElementById('processingPlaceholder');
+    return !!((window.Hls && Hls.isSupported()) ||
+        (liveStream && liveStream.canPlayType('application/vnd.apple.mpegurl')));
+}
 
+function showLiveProcessing(filename) {
     // Mostrar contenedor de stream en tiempo real
-    liveProcessingDiv.style.display = 'block';
-    processingPlaceholder.style.display = 'block';
+    document.getElementById('liveProcessing').style.display = 'block';
+    document.getElementById('processingPlaceholder').style.display = 'block';
 
     // Actualizar session ID
     if (filename) {
         updateVideoSessionId(filename);
     }
+}
 
-    // Iniciar stream después de un pequeño delay para asegurar que el servidor esté listo
-    setTimeout(() => {
-        liveStream.src = streamUrl + '?' + new Date().getTime();
-        liveStream.classList.add('active');
-        liveStream.onload = () => {
-            processingPlaceholder.style.display = 'none';
-        };
-        liveStream.onerror = () => {
-            console.log('Esperando frames del stream...');
-        };
-    }, 500);
+function startLiveStream(playlistUrl, filename) {
+    const liveStream = document.getElementById('liveStream');
+    const processingPlaceholder = document.getElementById('processingPlaceholder');
+
+    showLiveProcessing(filename);
+    liveStream.onloadeddata = () => {
+        processingPlaceholder.style.display = 'none';
+    };
+
+    // Playlist HLS creciente: hls.js donde no hay soporte nativo
+    if (window.Hls && Hls.isSupported()) {
+        liveHls = new Hls({ manifestLoadingMaxRetry: 10 });
+        liveHls.loadSource(playlistUrl);
+        liveHls.attachMedia(liveStream);
+    } else {
+        liveStream.src = playlistUrl;
+    }
+    liveStream.classList.add('active');
+    liveStream.play().catch(() => { });
+}
+
+// Sin HLS: frames anotados del trabajo en curso como MJPEG
+function startLivePreview(previewUrl, filename) {
+    const livePreview = document.getElementById('livePreview');
+    const processingPlaceholder = document.getElementById('processingPlaceholder');
+
+    showLiveProcessing(filename);
+    livePreview.onload = () => {
+        processingPlaceholder.style.display = 'none';
+    };
+    livePreview.src = previewUrl;
+    livePreview.classList.add('active');
 }
 
 function checkVideoStatus(filename, totalFrames = 0) {
+    let liveStarted = false;
     const interval = setInterval(() => {
         fetch(`/check_video/${filename}`)
             .then(response => response.json())
@@ -175,9 +387,21 @@ function checkVideoStatus(filename, totalFrames = 0) {
                     const total = data.total_frames || totalFrames;
 
                     progressFill.style.width = progress + '%';
+                    showQuickLook(data.quick_look);
+
+                    // Reproducir la parte ya procesada en cuanto exista el primer segmento
+                    if (!liveStarted && data.playlist_url && canPlayHls()) {
+                        liveStarted = true;
+                        startLiveStream(data.playlist_url, filename);
+                    } else if (!liveStarted && data.preview_url && !canPlayHls()) {
+                        liveStarted = true;
+                        startLivePreview(data.preview_url, filename);
+                    }
 
                     if (total > 0) {
-                        progressText.textContent = `Procesando: ${processed}/${total} frames (${progress}%)`;
+                        const eta = data.eta_seconds ? ` · faltan ~${formatEta(data.eta_seconds)}` : '';
+                        const upload = backgroundUploadPercent !== null ? ` · subida ${backgroundUploadPercent}%` : '';
+                        progressText.textContent = `Procesando: ${processed}/${total} frames (${progress}%)${eta}${upload}`;
                     } else {
                         progressText.textContent = `Procesando video con YOLO...`;
                     }
@@ -189,14 +413,53 @@ function checkVideoStatus(filename, totalFrames = 0) {
     }, 2000); // Verificar cada 2 segundos
 }
 
+// Resumen de la primera pasada (frames muestreados) mientras avanza la completa
+function showQuickLook(summary) {
+    const container = document.getElementById('quickLook');
+    if (!container || !summary || container.dataset.samples === String(summary.samples)) return;
+    container.dataset.samples = String(summary.samples);
+
+    const classesEl = document.getElementById('quickLookClasses');
+    classesEl.innerHTML = '';
+    if (!summary.classes.length) {
+        classesEl.innerHTML = '<span class="quick-look-badge">Ninguno detectado en la muestra</span>';
+    }
+    summary.classes.forEach(c => {
+        const badge = document.createElement('span');
+        badge.className = 'quick-look-badge';
+        badge.textContent = `${c.class} · ${Math.round(c.presence * 100)}% de la muestra · desde ${formatEta(c.first_seen_seconds)}`;
+        classesEl.appendChild(badge);
+    });
+
+    const strip = document.getElementById('quickLookStrip');
+    if (summary.strip_url) {
+        strip.src = summary.strip_url;
+        strip.style.display = 'block';
+    } else {
+        strip.style.display = 'none';
+    }
+    container.style.display = 'block';
+}
+
 function stopLiveStream() {
     const liveStream = document.getElementById('liveStream');
     const liveProcessingDiv = document.getElementById('liveProcessing');
 
+    if (liveHls) {
+        liveHls.destroy();
+        liveHls = null;
+    }
     if (liveStream) {
-        liveStream.src = '';
+        liveStream.pause();
+        liveStream.removeAttribute('src');
+        liveStream.load();
         liveStream.classList.remove('active');
     }
+    const livePreview = document.getElementById('livePreview');
+    if (livePreview) {
+        livePreview.removeAttribute('src');  // cierra la conexión MJPEG
+        livePreview.classList.remove('active');
+    }
 
     // Ocultar después de un delay para que se vea el último frame
     setTimeout(() => {
@@ -239,7 +502,7 @@ function showProcessedVideo(videoUrl, filename, fps = null) {
     loadHistory();
 }
 
-function startProcessedOverlayUpdater(mediaEl, canvasEl, sessionId) {
+function startProcessedOverlayUpdater(mediaEl, canvasEl, sessionId, trackUrl = null) {
     stopProcessedOverlayUpdater();
     if (!mediaEl || !canvasEl) return;
 
@@ -253,11 +516,24 @@ function startProcessedOverlayUpdater(mediaEl, canvasEl, sessionId) {
     mediaEl.addEventListener('seeked', updateOverlay);
     mediaEl.addEventListener('play', updateOverlay);
 
-    // También actualizar periódicamente como respaldo
-    processedOverlayInterval = setInterval(updateOverlay, 500);
-
     // Guardar referencias para limpieza
     mediaEl._overlayUpdateFn = updateOverlay;
+
+    // Con la pista precargada se redibuja en cada frame de animación sin
+    // pedir nada al servidor; sin pista, consulta periódica como respaldo
+    loadDetectionTrack(sessionId, trackUrl).then(track => {
+        if (mediaEl._overlayUpdateFn !== updateOverlay) return; // se cambió de video
+        if (track) {
+            const tick = () => {
+                if (!mediaEl.paused) updateOverlay();
+                processedOverlayFrame = requestAnimationFrame(tick);
+            };
+            processedOverlayFrame = requestAnimationFrame(tick);
+        } else {
+            processedOverlayInterval = setInterval(updateOverlay, 500);
+        }
+        updateOverlay();
+    });
 }
 
 function stopProcessedOverlayUpdater() {
@@ -265,6 +541,10 @@ function stopProcessedOverlayUpdater() {
         clearInterval(processedOverlayInterval);
         processedOverlayInterval = null;
     }
+    if (processedOverlayFrame) {
+        cancelAnimationFrame(processedOverlayFrame);
+        processedOverlayFrame = null;
+    }
 
     // Limpiar event listeners del video anterior
     const detectedVideo = document.getElementById('detectedVideo');
@@ -278,23 +558,25 @@ function stopProcessedOverlayUpdater() {
 
 // ==================== HISTORIAL ====================
 
-async function loadHistory() {
+async function loadHistory(append = false) {
     try {
-        const res = await fetch('/history');
-        const history = await res.json();
-        renderHistory(history);
+        const { items, nextCursor } = await fetchHistoryPage('/history', append ? historyNextCursor : null);
+        historyNextCursor = nextCursor;
+        renderHistory(items, append);
+        const moreBtn = document.getElementById('historyMoreBtn');
+        if (moreBtn) moreBtn.style.display = nextCursor ? 'inline-block' : 'none';
     } catch (e) {
         console.error('Error al cargar historial', e);
     }
 }
 
-function renderHistory(history) {
+function renderHistory(history, append = false) {
     const historyList = document.getElementById('historyList');
     if (!historyList) return;
 
-    historyList.innerHTML = '';
+    if (!append) historyList.innerHTML = '';
 
-    if (!history || history.length === 0) {
+    if (!append && (!history || history.length === 0)) {
         const p = document.createElement('p');
         p.className = 'history-empty';
         p.textContent = 'Sin videos procesados aún.';
@@ -306,6 +588,11 @@ function renderHistory(history) {
         const row = document.createElement('div');
         row.className = 'history-item';
 
+        // Miniatura ligera en lugar del video completo
+        if (item.thumbnail_url) {
+            row.appendChild(createHistoryThumbnail(item.thumbnail_url));
+        }
+
         const info = document.createElement('div');
         info.className = 'history-info';
         const name = document.createElement('div');
@@ -335,6 +622,7 @@ function renderHistory(history) {
                 const downloadBtn = document.getElementById('downloadBtn');
                 if (detectedVideo && downloadBtn && processedVideoDiv) {
                     const cacheBuster = `${item.url}?t=${Date.now()}`;
+                    detectedVideo.poster = item.poster_url || '';
                     detectedVideo.src = cacheBuster;
                     detectedVideo.dataset.filename = item.output_filename;
                     detectedVideo.dataset.fps = item.fps || 30;
@@ -351,7 +639,7 @@ function renderHistory(history) {
                     if (overlay) {
                         detectedVideo.onloadedmetadata = () => {
                             drawDetectionsOnElement(detectedVideo, overlay, item.output_filename);
-                            startProcessedOverlayUpdater(detectedVideo, overlay, item.output_filename);
+                            startProcessedOverlayUpdater(detectedVideo, overlay, item.output_filename, item.track_url);
                         };
                         // También redibujar al tiempo cambiar
                         detectedVideo.ontimeupdate = () => {
@@ -488,7 +776,12 @@ document.addEventListener('DOMContentLoaded', () => {
 
     const refreshHistoryBtn = document.getElementById('refreshHistoryBtn');
     if (refreshHistoryBtn) {
-        refreshHistoryBtn.addEventListener('click', loadHistory);
+        refreshHistoryBtn.addEventListener('click', () => loadHistory());
+    }
+
+    const historyMoreBtn = document.getElementById('historyMoreBtn');
+    if (historyMoreBtn) {
+        historyMoreBtn.addEventListener('click', () => loadHistory(true));
     }
 
     // Inicializar chatbot para videos